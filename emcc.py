@@ -23,6 +23,7 @@ emcc can be influenced by a few environment variables:
 from tools.toolchain_profiler import ToolchainProfiler
 
 import base64
+import concurrent.futures
 import json
 import logging
 import os
@@ -173,6 +174,34 @@ def save_intermediate_with_wasm(name, wasm_binary):
   building.save_intermediate(wasm_binary, name + '.wasm')
 
 
+# Link steps that are independent of each other and spend most of their time
+# waiting on subprocesses (node, closure, binaryen) can be overlapped by
+# running them on helper threads.
+background_tasks = None
+
+
+def run_in_background(func, *args):
+  """Starts func(*args) on a helper thread and returns a Future for its result.
+  With EMCC_CORES=1 the function is run right away instead."""
+  global background_tasks
+  if shared.get_num_cores() == 1:
+    future = concurrent.futures.Future()
+    try:
+      future.set_result(func(*args))
+    except BaseException as e:
+      future.set_exception(e)
+    return future
+  if not background_tasks:
+    background_tasks = concurrent.futures.ThreadPoolExecutor(max_workers=shared.get_num_cores())
+  return background_tasks.submit(func, *args)
+
+
+def wait_for_background_tasks(*tasks):
+  """Cancels the given tasks that have not started yet, and waits for the
+  others to finish, ignoring their results. Used to clean up after a failure."""
+  concurrent.futures.wait([task for task in tasks if task and not task.cancel()])
+
+
 def base64_encode(b):
   b64 = base64.b64encode(b)
   return b64.decode('ascii')
@@ -609,6 +638,18 @@ def make_js_executable(script):
     pass # can fail if e.g. writing the executable to /dev/null
 
 
+def emit_pthread_worker_js(target, settings_dict=None):
+  target_dir = os.path.dirname(os.path.abspath(target))
+  worker_output = os.path.join(target_dir, settings.PTHREAD_WORKER_FILE)
+  with open(worker_output, 'w') as f:
+    f.write(shared.read_and_preprocess(shared.path_from_root('src', 'worker.js'), expand_macros=True, settings_dict=settings_dict))
+
+  # Minify the worker.js file in optimized builds
+  if (settings.OPT_LEVEL >= 1 or settings.SHRINK_LEVEL >= 1) and not settings.DEBUG_LEVEL:
+    minified_worker = building.acorn_optimizer(worker_output, ['minifyWhitespace'], return_output=True)
+    write_file(worker_output, minified_worker)
+
+
 def do_split_module(wasm_file):
   os.rename(wasm_file, wasm_file + '.orig')
   args = ['--instrument']
@@ -2498,18 +2539,38 @@ def phase_post_link(options, state, in_wasm, wasm_target, target):
 
   phase_emscript(options, in_wasm, wasm_target, memfile)
 
-  phase_source_transforms(options, target)
+  # After emscript, the JS and the wasm are processed independently until
+  # phase_binaryen needs both of them (for metadce and minification of the
+  # exports). Run wasm-opt on the wasm while the JS-only steps run here.
+  wasm_opt_task = run_in_background(phase_wasm_opt, options, wasm_target)
+
+  # worker.js only depends on the settings, so it can be generated while the
+  # wasm is being optimized
+  state.worker_js_task = None
+  if settings.USE_PTHREADS and options.oformat != OFormat.WASM:
+    # The main thread keeps changing the settings, so the worker is
+    # preprocessed with a copy of them.
+    state.worker_js_task = run_in_background(emit_pthread_worker_js, target, dict(settings.dict()))
 
-  if memfile and not settings.MINIMAL_RUNTIME:
-    # MINIMAL_RUNTIME doesn't use `var memoryInitializer` but instead expects Module['mem'] to
-    # be loaded before the module.  See src/postamble_minimal.js.
-    phase_memory_initializer(memfile)
+  try:
+    phase_source_transforms(options, target)
 
-  phase_binaryen(target, options, wasm_target)
+    if memfile and not settings.MINIMAL_RUNTIME:
+      # MINIMAL_RUNTIME doesn't use `var memoryInitializer` but instead expects Module['mem'] to
+      # be loaded before the module.  See src/postamble_minimal.js.
+      phase_memory_initializer(memfile)
 
-  # If we are not emitting any JS then we are all done now
-  if options.oformat != OFormat.WASM:
-    phase_final_emitting(options, state, target, wasm_target, memfile)
+    intermediate_debug_info = wasm_opt_task.result()
+    phase_binaryen(target, options, wasm_target, intermediate_debug_info)
+
+    # If we are not emitting any JS then we are all done now
+    if options.oformat != OFormat.WASM:
+      phase_final_emitting(options, state, target, wasm_target, memfile)
+  except BaseException:
+    # Do not exit while wasm-opt is still writing wasm_target, or worker.js is
+    # still being written.
+    wait_for_background_tasks(wasm_opt_task, state.worker_js_task)
+    raise
 
 
 @ToolchainProfiler.profile_block('emscript')
@@ -2601,17 +2662,6 @@ def phase_final_emitting(options, state, target, wasm_target, memfile):
   # src = re.sub(r'\n+[ \n]*\n+', '\n', src)
   # write_file(final_js, src)
 
-  if settings.USE_PTHREADS:
-    target_dir = os.path.dirname(os.path.abspath(target))
-    worker_output = os.path.join(target_dir, settings.PTHREAD_WORKER_FILE)
-    with open(worker_output, 'w') as f:
-      f.write(shared.read_and_preprocess(shared.path_from_root('src', 'worker.js'), expand_macros=True))
-
-    # Minify the worker.js file in optimized builds
-    if (settings.OPT_LEVEL >= 1 or settings.SHRINK_LEVEL >= 1) and not settings.DEBUG_LEVEL:
-      minified_worker = building.acorn_optimizer(worker_output, ['minifyWhitespace'], return_output=True)
-      write_file(worker_output, minified_worker)
-
   # track files that will need native eols
   generated_text_files_with_native_eols = []
 
@@ -2659,19 +2709,36 @@ def phase_final_emitting(options, state, target, wasm_target, memfile):
 
   target_basename = unsuffixed_basename(target)
 
-  # If we were asked to also generate HTML, do that
-  if options.oformat == OFormat.HTML:
-    generate_html(target, options, js_target, target_basename,
-                  wasm_target, memfile)
-  elif settings.PROXY_TO_WORKER:
-    generate_worker_js(target, js_target, target_basename)
+  # Splitting the module only touches the wasm, so it can run while the HTML
+  # is generated and minified (unless the wasm gets embedded in the HTML).
+  split_module_task = None
+  if settings.SPLIT_MODULE:
+    diagnostics.warning('experimental', 'The SPLIT_MODULE setting is experimental and subject to change')
+    if settings.SINGLE_FILE:
+      do_split_module(wasm_target)
+    else:
+      split_module_task = run_in_background(do_split_module, wasm_target)
+
+  try:
+    # If we were asked to also generate HTML, do that
+    if options.oformat == OFormat.HTML:
+      generate_html(target, options, js_target, target_basename,
+                    wasm_target, memfile)
+    elif settings.PROXY_TO_WORKER:
+      generate_worker_js(target, js_target, target_basename)
+  except BaseException:
+    # Do not leave the module splitting running after a failure.
+    wait_for_background_tasks(split_module_task)
+    raise
 
   if embed_memfile() and memfile:
     shared.try_delete(memfile)
 
-  if settings.SPLIT_MODULE:
-    diagnostics.warning('experimental', 'The SPLIT_MODULE setting is experimental and subject to change')
-    do_split_module(wasm_target)
+  if split_module_task:
+    split_module_task.result()
+
+  if state.worker_js_task:
+    state.worker_js_task.result()
 
   for f in generated_text_files_with_native_eols:
     tools.line_endings.convert_line_endings_in_file(f, os.linesep, options.output_eol)
@@ -3026,9 +3093,10 @@ def parse_args(newargs):
   return options, settings_changes, user_js_defines, newargs
 
 
-@ToolchainProfiler.profile_block('binaryen')
-def phase_binaryen(target, options, wasm_target):
-  global final_js
+@ToolchainProfiler.profile_block('wasm_opt')
+def phase_wasm_opt(options, wasm_target):
+  """Runs the binaryen passes that only need the wasm, and not the JS. Returns
+  the number of reasons to keep intermediate debug info for phase_binaryen."""
   logger.debug('using binaryen')
   if settings.GENERATE_SOURCE_MAP and not settings.SOURCE_MAP_BASE:
     logger.warning("Wasm source map won't be usable in a browser without --source-map-base")
@@ -3080,6 +3148,14 @@ def phase_binaryen(target, options, wasm_target):
     building.save_intermediate(wasm_target, 'pre-strip.wasm')
     building.strip(wasm_target, wasm_target, debug=strip_debug, producers=strip_producers)
 
+  return intermediate_debug_info
+
+
+@ToolchainProfiler.profile_block('binaryen')
+def phase_binaryen(target, options, wasm_target, intermediate_debug_info):
+  global final_js
+  debug_info = settings.DEBUG_LEVEL >= 2 or options.profiling_funcs
+
   if settings.EVAL_CTORS:
     building.save_intermediate(wasm_target, 'pre-ctors.wasm')
     building.eval_ctors(final_js, wasm_target, debug_info=intermediate_debug_info)
@@ -3132,46 +3208,61 @@ def phase_binaryen(target, options, wasm_target):
   def preprocess_wasm2js_script():
     return read_and_preprocess(shared.path_from_root('src', 'wasm2js.js'), expand_macros=True)
 
-  def run_closure_compiler():
-    global final_js
-    final_js = building.closure_compiler(final_js, pretty=not minify_whitespace(),
-                                         extra_closure_args=options.closure_args)
-    save_intermediate_with_wasm('closure', wasm_target)
+  def run_closure_compiler(js_file):
+    return building.closure_compiler(js_file, pretty=not minify_whitespace(),
+                                     extra_closure_args=options.closure_args)
 
+  # With WASM=2 the wasm2js fallback is built from its own template, so closure
+  # on the main JS can run at the same time. The closure output only replaces
+  # final_js on this thread, once the task is done.
+  closure_task = None
   if final_js and options.use_closure_compiler:
-    run_closure_compiler()
+    if settings.WASM2JS and settings.WASM == 2:
+      closure_task = run_in_background(run_closure_compiler, final_js)
+    else:
+      final_js = run_closure_compiler(final_js)
+      save_intermediate_with_wasm('closure', wasm_target)
 
   symbols_file = None
   if options.emit_symbol_map:
     symbols_file = shared.replace_or_append_suffix(target, '.symbols')
 
   if settings.WASM2JS:
-    symbols_file_js = None
-    if settings.WASM == 2:
-      wasm2js_template = wasm_target + '.js'
-      with open(wasm2js_template, 'w') as f:
-        f.write(preprocess_wasm2js_script())
-      # generate secondary file for JS symbols
-      if options.emit_symbol_map:
-        symbols_file_js = shared.replace_or_append_suffix(wasm2js_template, '.symbols')
-    else:
-      wasm2js_template = final_js
-      if options.emit_symbol_map:
-        symbols_file_js = shared.replace_or_append_suffix(target, '.symbols')
-
-    wasm2js = building.wasm2js(wasm2js_template,
-                               wasm_target,
-                               opt_level=settings.OPT_LEVEL,
-                               minify_whitespace=minify_whitespace(),
-                               use_closure_compiler=options.use_closure_compiler,
-                               debug_info=debug_info,
-                               symbols_file=symbols_file,
-                               symbols_file_js=symbols_file_js)
-
-    shared.configuration.get_temp_files().note(wasm2js)
-
-    if settings.WASM == 2:
-      safe_copy(wasm2js, wasm2js_template)
+    try:
+      symbols_file_js = None
+      if settings.WASM == 2:
+        wasm2js_template = wasm_target + '.js'
+        with open(wasm2js_template, 'w') as f:
+          f.write(preprocess_wasm2js_script())
+        # generate secondary file for JS symbols
+        if options.emit_symbol_map:
+          symbols_file_js = shared.replace_or_append_suffix(wasm2js_template, '.symbols')
+      else:
+        wasm2js_template = final_js
+        if options.emit_symbol_map:
+          symbols_file_js = shared.replace_or_append_suffix(target, '.symbols')
+
+      wasm2js = building.wasm2js(wasm2js_template,
+                                 wasm_target,
+                                 opt_level=settings.OPT_LEVEL,
+                                 minify_whitespace=minify_whitespace(),
+                                 use_closure_compiler=options.use_closure_compiler,
+                                 debug_info=debug_info,
+                                 symbols_file=symbols_file,
+                                 symbols_file_js=symbols_file_js)
+
+      shared.configuration.get_temp_files().note(wasm2js)
+
+      if settings.WASM == 2:
+        safe_copy(wasm2js, wasm2js_template)
+
+      if closure_task:
+        final_js = closure_task.result()
+        save_intermediate_with_wasm('closure', wasm_target)
+    except BaseException:
+      # Do not leave closure running after a failure.
+      wait_for_background_tasks(closure_task)
+      raise
 
     if settings.WASM != 2:
       final_js = wasm2js
@@ -0,0 +1,69 @@
+/*
+ * Copyright 2021 The Emscripten Authors.  All rights reserved.
+ * Emscripten is available under two separate licenses, the MIT license and the
+ * University of Illinois/NCSA Open Source License.  Both these licenses can be
+ * found in the LICENSE file.
+ */
+
+#include <assert.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <string.h>
+#include <string>
+#include <thread>
+#include <unistd.h>
+#include <vector>
+#include "pthreadfs.h"
+
+// Each thread appends to the same file and syncs after every write, so that
+// the calls to fsync() can be coalesced.
+void threadMain(int id) {
+  int fd = open("persistent/fsync_barrier", O_WRONLY | O_APPEND);
+  assert(fd >= 0);
+  for (int i = 0; i < 10; i++) {
+    std::string line = std::to_string(id) + "\n";
+    assert(write(fd, line.data(), line.size()) == line.size());
+    assert(fsync(fd) == 0);
+  }
+  close(fd);
+}
+
+#define THREADS 8
+
+int main() {
+  int fd = open("persistent/fsync_barrier", O_RDWR | O_CREAT | O_TRUNC | O_APPEND, 0777);
+  assert(fd >= 0);
+
+  std::vector<std::thread> threads;
+  for (int i = 0; i < THREADS; i++) {
+    threads.emplace_back(threadMain, i);
+  }
+  for (auto& thread : threads) {
+    thread.join();
+  }
+
+  assert(write(fd, "end\n", 4) == 4);
+  assert(fdatasync(fd) == 0);
+  assert(pthreadfs_barrier() == 0);
+  assert(lseek(fd, 0, SEEK_CUR) == THREADS * 10 * 2 + 4);
+
+  // No append was lost: every thread wrote its 10 lines, followed by the line
+  // of the main thread.
+  char contents[THREADS * 10 * 2 + 4 + 1] = {0};
+  assert(pread(fd, contents, sizeof(contents), 0) == THREADS * 10 * 2 + 4);
+  int lines[THREADS] = {0};
+  for (int i = 0; i < THREADS * 10; i++) {
+    assert(contents[2 * i] >= '0' && contents[2 * i] < '0' + THREADS);
+    assert(contents[2 * i + 1] == '\n');
+    lines[contents[2 * i] - '0']++;
+  }
+  for (int i = 0; i < THREADS; i++) {
+    assert(lines[i] == 10);
+  }
+  assert(strcmp(contents + THREADS * 10 * 2, "end\n") == 0);
+
+  close(fd);
+  unlink("persistent/fsync_barrier");
+  puts("success");
+  return 0;
+}
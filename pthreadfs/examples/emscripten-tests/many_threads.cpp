@@ -0,0 +1,62 @@
+/*
+ * Copyright 2021 The Emscripten Authors.  All rights reserved.
+ * Emscripten is available under two separate licenses, the MIT license and the
+ * University of Illinois/NCSA Open Source License.  Both these licenses can be
+ * found in the LICENSE file.
+ */
+
+#include <assert.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+
+#include "pthreadfs.h"
+
+#define FILENAME "persistent/many_threads"
+
+// More threads than request slots, so that some calls wait for a slot while
+// the slot's previous call is still running.
+#define NUM_THREADS (PTHREADFS_RING_SIZE + 32)
+#define READS_PER_THREAD 20
+
+static int fd;
+static pthread_barrier_t barrier;
+
+static void* threadMain(void* arg) {
+  long id = (long)arg;
+  pthread_barrier_wait(&barrier);
+  for (int i = 0; i < READS_PER_THREAD; i++) {
+    long position = (id + i) % NUM_THREADS;
+    unsigned char c = 0;
+    assert(pread(fd, &c, 1, position) == 1);
+    assert(c == position);
+  }
+  return NULL;
+}
+
+int main() {
+  fd = open(FILENAME, O_RDWR | O_CREAT | O_TRUNC, 0777);
+  assert(fd >= 0);
+  unsigned char data[NUM_THREADS];
+  for (int i = 0; i < NUM_THREADS; i++) {
+    data[i] = i;
+  }
+  assert(write(fd, data, NUM_THREADS) == NUM_THREADS);
+
+  pthread_barrier_init(&barrier, NULL, NUM_THREADS);
+  pthread_t threads[NUM_THREADS];
+  for (long i = 0; i < NUM_THREADS; i++) {
+    assert(pthread_create(&threads[i], NULL, threadMain, (void*)i) == 0);
+  }
+  for (int i = 0; i < NUM_THREADS; i++) {
+    pthread_join(threads[i], NULL);
+  }
+  pthread_barrier_destroy(&barrier);
+
+  close(fd);
+  unlink(FILENAME);
+  puts("success");
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,119 @@
+/*
+ * Copyright 2021 The Emscripten Authors.  All rights reserved.
+ * Emscripten is available under two separate licenses, the MIT license and the
+ * University of Illinois/NCSA Open Source License.  Both these licenses can be
+ * found in the LICENSE file.
+ */
+
+#include <assert.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include "pthreadfs.h"
+
+// MEMFS_ASYNC stores files in chunks of 64 KiB.
+#define CHUNK_SIZE (64 * 1024)
+#define FOLDER "persistent/memfs_async"
+#define FILENAME FOLDER "/file"
+#define MAPPED FOLDER "/mapped"
+
+static off_t file_size(int fd) {
+  struct stat st;
+  assert(fstat(fd, &st) == 0);
+  return st.st_size;
+}
+
+int main() {
+  // Mount an in-memory file system in the PThreadFS folder.
+  EM_PTHREADFS_ASM(
+    await PThreadFS.mkdir('/persistent/memfs_async');
+    await PThreadFS.mount(MEMFS_ASYNC, {}, '/persistent/memfs_async');
+  );
+
+  int fd = open(FILENAME, O_RDWR | O_CREAT | O_TRUNC, 0777);
+  assert(fd >= 0);
+
+  // A write across the boundary of the first two chunks.
+  char data[100];
+  for (int i = 0; i < 100; i++) {
+    data[i] = 'a' + i % 26;
+  }
+  assert(pwrite(fd, data, 100, CHUNK_SIZE - 50) == 100);
+  assert(file_size(fd) == CHUNK_SIZE + 50);
+  char in[100];
+  assert(pread(fd, in, 100, CHUNK_SIZE - 50) == 100);
+  assert(memcmp(in, data, 100) == 0);
+
+  // The hole before the write reads as zeros.
+  char zeros[100] = {0};
+  assert(pread(fd, in, 100, 0) == 100);
+  assert(memcmp(in, zeros, 100) == 0);
+
+  // A write spanning several chunks.
+  size_t large_size = 3 * CHUNK_SIZE + 7;
+  char* large = (char*)malloc(large_size);
+  char* large_in = (char*)malloc(large_size);
+  for (size_t i = 0; i < large_size; i++) {
+    large[i] = i % 251;
+  }
+  assert(pwrite(fd, large, large_size, 2 * CHUNK_SIZE + 3) == large_size);
+  assert(pread(fd, large_in, large_size, 2 * CHUNK_SIZE + 3) == large_size);
+  assert(memcmp(large, large_in, large_size) == 0);
+
+  // Truncating into the second chunk keeps the data before the new end.
+  assert(ftruncate(fd, CHUNK_SIZE + 10) == 0);
+  assert(file_size(fd) == CHUNK_SIZE + 10);
+  assert(pread(fd, in, 100, CHUNK_SIZE - 50) == 60);
+  assert(memcmp(in, data, 60) == 0);
+
+  // Growing the file again reads zeros after the old end, also in the part of
+  // the second chunk that was truncated.
+  assert(ftruncate(fd, 4 * CHUNK_SIZE) == 0);
+  assert(file_size(fd) == 4 * CHUNK_SIZE);
+  assert(pread(fd, in, 100, CHUNK_SIZE - 50) == 100);
+  assert(memcmp(in, data, 60) == 0);
+  assert(memcmp(in + 60, zeros, 40) == 0);
+  assert(pread(fd, large_in, large_size, 2 * CHUNK_SIZE + 3) == 2 * CHUNK_SIZE - 3);
+  for (size_t i = 0; i < 2 * CHUNK_SIZE - 3; i++) {
+    assert(large_in[i] == 0);
+  }
+
+  // Appending after the hole.
+  assert(lseek(fd, 0, SEEK_END) == 4 * CHUNK_SIZE);
+  assert(write(fd, data, 100) == 100);
+  assert(file_size(fd) == 4 * CHUNK_SIZE + 100);
+  close(fd);
+
+  // Map the bytes across the chunk boundary, and copy the mapping to another
+  // file. mmap() is not proxied to PThreadFS, so this calls the file system
+  // directly.
+  // clang-format off
+  EM_PTHREADFS_ASM(
+    var stream = await PThreadFS.open('/persistent/memfs_async/file', 'r');
+    var mapping = MEMFS_ASYNC.stream_ops.mmap(stream, 0, 100, 65536 - 50, 1 /* PROT_READ */, 2 /* MAP_PRIVATE */);
+    await PThreadFS.writeFile('/persistent/memfs_async/mapped', HEAPU8.slice(mapping.ptr, mapping.ptr + 100));
+    await PThreadFS.close(stream);
+  );
+  // clang-format on
+  fd = open(MAPPED, O_RDONLY);
+  assert(fd >= 0);
+  assert(read(fd, in, 100) == 100);
+  assert(memcmp(in, data, 60) == 0);
+  assert(memcmp(in + 60, zeros, 40) == 0);
+  close(fd);
+
+  free(large);
+  free(large_in);
+  unlink(MAPPED);
+  unlink(FILENAME);
+  EM_PTHREADFS_ASM(
+    await PThreadFS.unmount('/persistent/memfs_async');
+    await PThreadFS.rmdir('/persistent/memfs_async');
+  );
+  puts("success");
+  return EXIT_SUCCESS;
+}
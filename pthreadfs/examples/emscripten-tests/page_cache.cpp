@@ -0,0 +1,100 @@
+/*
+ * Copyright 2021 The Emscripten Authors.  All rights reserved.
+ * Emscripten is available under two separate licenses, the MIT license and the
+ * University of Illinois/NCSA Open Source License.  Both these licenses can be
+ * found in the LICENSE file.
+ */
+
+// Linked with -jsDPTHREADFS_PAGE_CACHE_PAGES=8, see the Makefile.
+
+#include <assert.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#include "pthreadfs.h"
+
+#define PAGE_SIZE 4096
+#define CACHE_PAGES 8
+#define FILE_PAGES (2 * CACHE_PAGES)
+#define FILENAME1 "persistent/page_cache1"
+#define FILENAME2 "persistent/page_cache2"
+#define STATS "persistent/page_cache_stats"
+
+// Writes parts of all pages of a file, so that dirty pages are evicted.
+static void writePages(int fd, char c) {
+  char data[1000];
+  memset(data, c, sizeof(data));
+  for (int page = 0; page < FILE_PAGES; page++) {
+    assert(pwrite(fd, data, sizeof(data), page * PAGE_SIZE + 100) == sizeof(data));
+  }
+}
+
+static void checkPages(int fd, char c, int pages) {
+  char expected[PAGE_SIZE] = {0};
+  memset(expected + 100, c, 1000);
+  char in[PAGE_SIZE];
+  for (int page = 0; page < pages; page++) {
+    assert(pread(fd, in, PAGE_SIZE, page * PAGE_SIZE) == (page < FILE_PAGES - 1 ? PAGE_SIZE : 1100));
+    assert(memcmp(in, expected, page < FILE_PAGES - 1 ? PAGE_SIZE : 1100) == 0);
+  }
+}
+
+int main() {
+  int fd1 = open(FILENAME1, O_RDWR | O_CREAT | O_TRUNC, 0777);
+  int fd2 = open(FILENAME2, O_RDWR | O_CREAT | O_TRUNC, 0777);
+  assert(fd1 >= 0 && fd2 >= 0);
+
+  // Each file has more pages than the cache, and evicts dirty pages of both.
+  writePages(fd1, 'a');
+  writePages(fd2, 'b');
+  writePages(fd1, 'c');
+  checkPages(fd1, 'c', FILE_PAGES);
+  checkPages(fd2, 'b', FILE_PAGES);
+
+  // Truncating in the middle of a cached page, and growing the file again.
+  writePages(fd1, 'd');
+  assert(ftruncate(fd1, 3 * PAGE_SIZE + 600) == 0);
+  assert(ftruncate(fd1, FILE_PAGES * PAGE_SIZE) == 0);
+  char in[PAGE_SIZE];
+  char zeros[PAGE_SIZE] = {0};
+  assert(pread(fd1, in, PAGE_SIZE, 3 * PAGE_SIZE) == PAGE_SIZE);
+  assert(in[599] == 'd' && memcmp(in + 600, zeros, PAGE_SIZE - 600) == 0);
+  assert(pread(fd1, in, PAGE_SIZE, 10 * PAGE_SIZE) == PAGE_SIZE);
+  assert(memcmp(in, zeros, PAGE_SIZE) == 0);
+
+  // The data is persisted when the files are closed.
+  assert(fsync(fd2) == 0);
+  close(fd1);
+  close(fd2);
+  fd2 = open(FILENAME2, O_RDONLY);
+  assert(fd2 >= 0);
+  checkPages(fd2, 'b', FILE_PAGES);
+  close(fd2);
+
+  // The cache was used, unless PThreadFS runs without access handles.
+  // clang-format off
+  EM_PTHREADFS_ASM(
+    var stats = typeof FSAFS !== 'undefined' && FSAFS.PAGE_CACHE_PAGES ? FSAFS.pageCacheStats : null;
+    await PThreadFS.writeFile('/persistent/page_cache_stats',
+      stats ? `${stats.hits} ${stats.misses} ${stats.evictions} ${stats.writeBacks}` : 'none');
+  );
+  // clang-format on
+  FILE* f = fopen(STATS, "r");
+  assert(f);
+  int hits, misses, evictions, writeBacks;
+  if (fscanf(f, "%d %d %d %d", &hits, &misses, &evictions, &writeBacks) == 4) {
+    assert(hits > 0 && misses > 0 && evictions > 0 && writeBacks > 0);
+  } else {
+    puts("PThreadFS does not use the page cache");
+  }
+  fclose(f);
+
+  unlink(FILENAME1);
+  unlink(FILENAME2);
+  unlink(STATS);
+  puts("success");
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,68 @@
+/*
+ * Copyright 2021 The Emscripten Authors.  All rights reserved.
+ * Emscripten is available under two separate licenses, the MIT license and the
+ * University of Illinois/NCSA Open Source License.  Both these licenses can be
+ * found in the LICENSE file.
+ */
+
+#include <assert.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/uio.h>
+#include <unistd.h>
+
+#define FILENAME "persistent/readv_writev"
+
+int main() {
+  int fd = open(FILENAME, O_RDWR | O_CREAT | O_TRUNC, 0777);
+  assert(fd >= 0);
+
+  // Buffers that are adjacent in memory, and some that are not.
+  char adjacent[8] = {'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'};
+  char separate1[] = "123";
+  char separate2[] = "XYZ";
+  struct iovec out[] = {
+    {adjacent, 4}, {adjacent + 4, 4}, {separate1, 3}, {NULL, 0}, {separate2, 3}};
+  assert(writev(fd, out, 5) == 14);
+  assert(lseek(fd, 0, SEEK_CUR) == 14);
+
+  // A large write goes to the file buffer by buffer.
+  size_t large_size = 256 * 1024;
+  char* large = (char*)malloc(large_size);
+  memset(large, 'L', large_size);
+  struct iovec out_large[] = {{separate1, 3}, {large, large_size}};
+  assert(writev(fd, out_large, 2) == 3 + large_size);
+
+  char in1[5] = {0};
+  char in2[10] = {0};
+  struct iovec in[] = {{in1, 4}, {in2, 9}};
+  assert(lseek(fd, 0, SEEK_SET) == 0);
+  assert(readv(fd, in, 2) == 13);
+  assert(strcmp(in1, "abcd") == 0);
+  assert(strcmp(in2, "efgh123XY") == 0);
+  assert(lseek(fd, 0, SEEK_CUR) == 13);
+
+  // The buffers of pwritev and preadv follow each other in the file.
+  assert(pwritev(fd, out + 2, 3, 2) == 6);
+  memset(in1, 0, sizeof(in1));
+  memset(in2, 0, sizeof(in2));
+  assert(preadv(fd, in, 2, 0) == 13);
+  assert(strcmp(in1, "ab12") == 0);
+  assert(strcmp(in2, "3XYZ123XY") == 0);
+  assert(lseek(fd, 0, SEEK_CUR) == 13);
+
+  // Reads stop at the end of the file.
+  char tail[8] = {0};
+  struct iovec in_tail[] = {{tail, 2}, {in2, 4}};
+  assert(preadv(fd, in_tail, 2, 14 + 3 + large_size - 3) == 3);
+  assert(strcmp(tail, "LL") == 0);
+  assert(in2[0] == 'L');
+
+  free(large);
+  close(fd);
+  unlink(FILENAME);
+  puts("success");
+  return EXIT_SUCCESS;
+}
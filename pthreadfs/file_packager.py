@@ -21,7 +21,7 @@ data downloads.
 
 Usage:
 
-  file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--use-preload-plugins] [--no-node]
+  file_packager TARGET [--preload A [B..]] [--embed C [D..]] [--exclude E [F..]]] [--js-output=OUTPUT.js] [--no-force] [--use-preload-cache] [--indexedDB-name=EM_PRELOAD_CACHE] [--separate-metadata] [--lz4] [--use-preload-plugins] [--no-node] [--manifest=FILE] [--chunk-size=N] [--lazy] [--prefetch G [H..]] [--binary-metadata]
 
   --preload  ,
   --embed    See emcc --help for more details on those options.
@@ -41,8 +41,15 @@ Usage:
 
   --indexedDB-name Use specified IndexedDB database name (Default: 'EM_PRELOAD_CACHE')
 
+  --chunk-size=N With --use-preload-cache, caches the package in IndexedDB as content-addressed chunks of N bytes. On later
+                 loads only the chunks whose content changed are downloaded (using HTTP range requests, several at a time),
+                 instead of the whole package.
+
   --separate-metadata Stores package metadata separately. Only applicable when preloading and js-output file is specified.
 
+  --binary-metadata With --separate-metadata, stores the metadata in a compact binary format instead of JSON, which is
+                    smaller and faster to decode for packages with many files.
+
   --lz4 Uses LZ4. This compresses the data using LZ4 when this utility is run, then the client decompresses chunks on the fly, avoiding storing
         the entire decompressed data in memory at once. See LZ4 in src/settings.js, you must build the main program with that flag.
 
@@ -53,6 +60,17 @@ Usage:
 
   --use_pthreadfs Whether to create a file compatible with PThreadFS
 
+  --lazy Only download the preloaded files listed with --prefetch up front. The other files are created as lazy files
+         (see FS.createLazyFile), whose contents are fetched with HTTP range requests when they are first read. This
+         requires synchronous XHRs, so it only works in web workers: elsewhere the whole package is downloaded as usual.
+
+  --prefetch G [H..] With --lazy, specifies patterns (see --exclude) of destination paths that are downloaded up front.
+
+  --manifest=FILE Records the content hash and location in TARGET of every packaged file in FILE. When FILE exists from a
+                  previous run, files whose size and modification time did not change are not hashed again, and the parts
+                  of an existing TARGET that are still valid are kept instead of being written again (if nothing changed,
+                  TARGET is not touched at all).
+
 Notes:
 
   * The file packager generates unix-style file paths. So if you are on windows and a file is accessed at
@@ -60,7 +78,10 @@ Notes:
 """
 
 import base64
+import concurrent.futures
+import hashlib
 import os
+import struct
 import sys
 import shutil
 import random
@@ -70,7 +91,7 @@ import ctypes
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import posixpath
-from tools import shared, utils
+from tools import shared, config
 from subprocess import PIPE
 import fnmatch
 import json
@@ -94,7 +115,26 @@ DDS_HEADER_SIZE = 128
 # to work around silly av false positives
 AV_WORKAROUND = 0
 
+# Must match CHUNK_SIZE in third_party/mini-lz4.js
+LZ4_CHUNK_SIZE = 2048
+# With --lz4, packages larger than this are split into pieces of at least this
+# size which are compressed in parallel
+LZ4_MIN_PIECE_SIZE = 16 * 1024 * 1024
+
+# Files are copied into the bundle and base64-encoded in blocks of this size, so
+# that memory usage does not depend on the size of the largest file. (Must be a
+# multiple of 3 so that base64 blocks can be concatenated.)
+COPY_BLOCK_SIZE = 3 * 1024 * 1024
+
+# Bump this when the format of the --manifest file changes
+MANIFEST_VERSION = 1
+
+# 'EMPK' and the format version at the start of --binary-metadata files
+BINARY_METADATA_MAGIC = 0x4b504d45
+BINARY_METADATA_VERSION = 1
+
 excluded_patterns = []
+prefetch_patterns = []
 new_data_files = []
 
 
@@ -103,6 +143,189 @@ def base64_encode(b):
   return b64.decode('ascii')
 
 
+def base64_encode_file(filename):
+  parts = []
+  with open(filename, 'rb') as f:
+    while True:
+      block = f.read(COPY_BLOCK_SIZE)
+      if not block:
+        break
+      parts.append(base64_encode(block))
+  return ''.join(parts)
+
+
+def append_file(data, filename, size):
+  """Appends the first `size` bytes of the file `filename` to the open file
+  `data`, without reading the whole file into memory. Uses copy_file_range
+  where available, so the data does not pass through userspace at all.
+  Returns the number of bytes that could not be copied (if the file shrank)."""
+  remaining = size
+  with open(filename, 'rb') as f:
+    if hasattr(os, 'copy_file_range'):
+      data.flush()
+      try:
+        while remaining:
+          copied = os.copy_file_range(f.fileno(), data.fileno(), remaining)
+          if not copied:
+            return remaining
+          remaining -= copied
+        return 0
+      except OSError:
+        # not supported between these file systems, continue from where we
+        # are with a regular copy
+        f.seek(size - remaining)
+    while remaining:
+      block = f.read(min(remaining, COPY_BLOCK_SIZE))
+      if not block:
+        break
+      data.write(block)
+      remaining -= len(block)
+  return remaining
+
+
+def hash_file(filename):
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    while True:
+      block = f.read(COPY_BLOCK_SIZE)
+      if not block:
+        break
+      h.update(block)
+  return h.hexdigest()
+
+
+def hash_files(data_files, manifest):
+  """Sets the 'size', 'mtime' and 'hash' of each file. Hashes from the
+  previous manifest are reused for files whose size and mtime did not change,
+  the others are hashed in parallel (hashlib releases the GIL)."""
+  known = {}
+  if manifest:
+    known = {f['srcpath']: f for f in manifest['files']}
+  to_hash = []
+  for file_ in data_files:
+    st = os.stat(file_['srcpath'])
+    file_['size'] = st.st_size
+    file_['mtime'] = st.st_mtime_ns
+    old = known.get(os.path.abspath(file_['srcpath']))
+    if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime_ns:
+      file_['hash'] = old['hash']
+    else:
+      to_hash.append(file_)
+  with concurrent.futures.ThreadPoolExecutor(shared.get_num_cores()) as executor:
+    for file_, digest in zip(to_hash, executor.map(hash_file, [f['srcpath'] for f in to_hash])):
+      file_['hash'] = digest
+
+
+def read_manifest(filename):
+  if not os.path.isfile(filename):
+    return None
+  try:
+    with open(filename) as f:
+      manifest = json.load(f)
+  except ValueError:
+    return None
+  if manifest.get('version') != MANIFEST_VERSION:
+    return None
+  return manifest
+
+
+def write_manifest(filename, data_files, data_target, lz4_meta):
+  manifest = {
+    'version': MANIFEST_VERSION,
+    'data_size': os.path.getsize(data_target),
+    'lz4': lz4_meta,
+    'files': [{
+      'srcpath': os.path.abspath(file_['srcpath']),
+      'dstpath': file_['dstpath'],
+      'size': file_['size'],
+      'mtime': file_['mtime'],
+      'hash': file_['hash'],
+      'start': file_['data_start'],
+      'end': file_['data_end'],
+    } for file_ in data_files],
+  }
+  with open(filename, 'w') as f:
+    json.dump(manifest, f, separators=(',', ':'))
+
+
+def reusable_files(manifest, data_files, data_target, lz4):
+  """Returns how many leading files of the existing TARGET, as described by
+  the previous manifest, are unchanged and at the same location in the new
+  package, so that their bytes can be kept in place."""
+  if not manifest or not os.path.isfile(data_target):
+    return 0
+  if os.path.getsize(data_target) != manifest['data_size']:
+    return 0
+  if (manifest['lz4'] is not None) != lz4:
+    return 0
+  count = 0
+  for old, new in zip(manifest['files'], data_files):
+    if old['hash'] != new['hash'] or old['start'] != new['data_start'] or old['end'] != new['data_end']:
+      break
+    count += 1
+  if lz4 and (count != len(data_files) or count != len(manifest['files'])):
+    # the compressed data can only be reused as a whole
+    return 0
+  return count
+
+
+def hash_chunks(data_target, chunk_size):
+  """Returns the content hashes of the consecutive chunk_size pieces of the
+  package, which is how the chunks are addressed in the cache."""
+  def hash_chunk(offset):
+    with open(data_target, 'rb') as f:
+      f.seek(offset)
+      return hashlib.sha256(f.read(chunk_size)).hexdigest()[:32]
+
+  offsets = range(0, os.path.getsize(data_target), chunk_size)
+  with concurrent.futures.ThreadPoolExecutor(shared.get_num_cores()) as executor:
+    return list(executor.map(hash_chunk, offsets))
+
+
+def encode_binary_metadata(metadata):
+  """Encodes the metadata for --binary-metadata. All fields are little-endian
+  and 4-byte aligned, so they can be used as typed arrays directly:
+
+    u32 magic, version, file count N, length of extra
+    extra: the metadata other than the files, as UTF-8 JSON (space-padded to 4 bytes),
+           including the list of file hashes if there are any
+    u32[N] start of each file in the package
+    u32[N] end of each file in the package
+    u32[N] end of the name of each file, in UTF-16 code units
+    u8[N]  audio flag of each file
+    the names of all files, concatenated, as UTF-8
+  """
+  files = metadata['files']
+  extra = {k: v for k, v in metadata.items() if k != 'files'}
+  if files and 'hash' in files[0]:
+    extra['file_hashes'] = [file_['hash'] for file_ in files]
+  extra = json.dumps(extra, separators=(',', ':')).encode('utf-8')
+  extra += b' ' * (-len(extra) % 4)
+  name_ends = []
+  name_end = 0
+  for file_ in files:
+    name_end += len(file_['filename'].encode('utf-16-le')) // 2
+    name_ends.append(name_end)
+  count = len(files)
+  return b''.join([
+    struct.pack('<4I', BINARY_METADATA_MAGIC, BINARY_METADATA_VERSION, count, len(extra)),
+    extra,
+    struct.pack('<%dI' % count, *[file_['start'] for file_ in files]),
+    struct.pack('<%dI' % count, *[file_['end'] for file_ in files]),
+    struct.pack('<%dI' % count, *name_ends),
+    bytes([file_['audio'] for file_ in files]),
+    ''.join(file_['filename'] for file_ in files).encode('utf-8'),
+  ])
+
+
+def get_package_uuid(data_files, lz4):
+  """Derives the package UUID from the content and layout of the package, so
+  that the caches keyed on it stay valid across rebuilds with identical data."""
+  layout = [lz4] + [[f['dstpath'], f['data_start'], f['data_end'], f['hash']] for f in data_files]
+  digest = hashlib.sha256(json.dumps(layout).encode('utf-8')).digest()
+  return uuid.UUID(bytes=digest[:16], version=4)
+
+
 def has_hidden_attribute(filepath):
   """Win32 code to test whether the given file has the hidden property set."""
 
@@ -163,6 +386,59 @@ def add(mode, rootpathsrc, rootpathdst):
     dirnames.extend(new_dirnames)
 
 
+def lz4_compress_package(data_target):
+  """Compresses the package in place with tools/lz4-compress.js, and returns
+  the compression metadata as JSON. The data is compressed in independent
+  LZ4_CHUNK_SIZE chunks, so the package can be split on chunk boundaries into
+  pieces that separate node processes compress in parallel."""
+  temp = data_target + '.orig'
+  shutil.move(data_target, temp)
+  size = os.path.getsize(temp)
+  num_pieces = max(1, min(shared.get_num_cores(), size // LZ4_MIN_PIECE_SIZE))
+  piece_size = -(-size // num_pieces)
+  piece_size += -piece_size % LZ4_CHUNK_SIZE
+  lz4_compress = shared.path_from_root('tools', 'lz4-compress.js')
+  mini_lz4 = shared.path_from_root('third_party', 'mini-lz4.js')
+
+  if num_pieces == 1:
+    meta = shared.run_js_tool(lz4_compress, [mini_lz4, temp, data_target], stdout=PIPE)
+    os.unlink(temp)
+    return meta
+
+  pieces = []
+  for start in range(0, size, piece_size):
+    pieces.append((start, min(start + piece_size, size), '%s.%d' % (temp, len(pieces))))
+  commands = [config.NODE_JS + [lz4_compress, mini_lz4, temp, output, str(start), str(end)]
+              for start, end, output in pieces]
+  metas = shared.run_multiple_processes(commands, pipe_stdout=True)
+  os.unlink(temp)
+
+  # Stitch the pieces together, in the same layout that compressPackage in
+  # mini-lz4.js uses for a single piece.
+  compressed_data = {
+    'data': None,
+    'cachedIndexes': [-1, -1],
+    'cachedChunks': [None, None],
+    'offsets': [],
+    'sizes': [],
+    'successes': [],
+  }
+  total = 0
+  with open(data_target, 'wb') as data:
+    for (start, end, output), meta in zip(pieces, metas):
+      meta = json.loads(meta)
+      compressed_data['offsets'] += [total + offset for offset in meta['offsets']]
+      compressed_data['sizes'] += meta['sizes']
+      compressed_data['successes'] += meta['successes']
+      append_file(data, output, meta['cachedOffset'])
+      total += meta['cachedOffset']
+      os.unlink(output)
+    # room for the two cached decompressed chunks
+    data.write(bytes(2 * LZ4_CHUNK_SIZE))
+  compressed_data['cachedOffset'] = total
+  return json.dumps(compressed_data)
+
+
 def main():
   data_files = []
   export_name = 'Module'
@@ -177,15 +453,20 @@ def main():
   # offline cache instead.
   use_preload_cache = False
   indexeddb_name = 'EM_PRELOAD_CACHE'
+  # If set, the package is cached in chunks of this size, see --chunk-size
+  chunk_size = None
+  lazy = False
   use_pthreadfs = False
   # If set to True, the package metadata is stored separately from js-output
   # file which makes js-output file immutable to the package content changes.
   # If set to False, the package metadata is stored inside the js-output file
   # which makes js-output file to mutate on each invocation of this packager tool.
   separate_metadata = False
+  binary_metadata = False
   lz4 = False
   use_preload_plugins = False
   support_node = True
+  manifest = None
 
   for arg in sys.argv[2:]:
     if arg == '--preload':
@@ -201,9 +482,21 @@ def main():
     elif arg == '--use-preload-cache':
       use_preload_cache = True
       leading = ''
+    elif arg == '--lazy':
+      lazy = True
+      leading = ''
+    elif arg == '--prefetch':
+      leading = 'prefetch'
     elif arg == '--use_pthreadfs':
       use_pthreadfs = True
       leading = ''
+    elif arg.startswith('--chunk-size'):
+      try:
+        chunk_size = int(arg.split('=', 1)[1])
+      except (IndexError, ValueError):
+        print('error: --chunk-size requires a number of bytes, as in --chunk-size=N', file=sys.stderr)
+        return 1
+      leading = ''
     elif arg.startswith('--indexedDB-name'):
       indexeddb_name = arg.split('=', 1)[1] if '=' in arg else None
       leading = ''
@@ -213,6 +506,9 @@ def main():
     elif arg == '--separate-metadata':
       separate_metadata = True
       leading = ''
+    elif arg == '--binary-metadata':
+      binary_metadata = True
+      leading = ''
     elif arg == '--lz4':
       lz4 = True
       leading = ''
@@ -225,6 +521,9 @@ def main():
     elif arg.startswith('--js-output'):
       jsoutput = arg.split('=', 1)[1] if '=' in arg else None
       leading = ''
+    elif arg.startswith('--manifest'):
+      manifest = arg.split('=', 1)[1] if '=' in arg else None
+      leading = ''
     elif arg.startswith('--export-name'):
       if '=' in arg:
         export_name = arg.split('=', 1)[1]
@@ -261,6 +560,8 @@ def main():
         return 1
     elif leading == 'exclude':
       excluded_patterns.append(arg)
+    elif leading == 'prefetch':
+      prefetch_patterns.append(arg)
     else:
       print('Unknown parameter:', arg, file=sys.stderr)
       return 1
@@ -282,6 +583,24 @@ def main():
           file=sys.stderr)
     return 1
 
+  if chunk_size is not None and (not use_preload_cache or chunk_size <= 0):
+    print('error: --chunk-size must be positive, and requires --use-preload-cache',
+          file=sys.stderr)
+    return 1
+
+  if lazy and (use_pthreadfs or use_preload_cache or lz4):
+    print('error: --lazy is incompatible with --use_pthreadfs, --use-preload-cache and --lz4',
+          file=sys.stderr)
+    return 1
+
+  if binary_metadata and not separate_metadata:
+    print('error: --binary-metadata requires --separate-metadata', file=sys.stderr)
+    return 1
+
+  if prefetch_patterns and not lazy:
+    print('error: --prefetch requires --lazy', file=sys.stderr)
+    return 1
+
   if use_pthreadfs and lz4:
     print('error: --use_pthreadfs should is incompatible with --lz4',
           file=sys.stderr)
@@ -401,41 +720,95 @@ let loading_script =
 
   metadata = {'files': []}
 
-  # Set up folders
-  partial_dirs = []
+  if lazy:
+    # Put the files to prefetch at the start of the package, so that they can
+    # be downloaded with a single request
+    def is_prefetched(file_):
+      return file_['mode'] == 'preload' and any(fnmatch.fnmatch(file_['dstpath'], p) for p in prefetch_patterns)
+
+    data_files.sort(key=lambda file_: not is_prefetched(file_))
+
+  # Set up folders. The tree is emitted as a flat list of (parent, name)
+  # pairs, where parent is the index of an earlier pair (or -1 for the root),
+  # and created by a single loop at runtime.
+  dir_indexes = {}
+  dir_tree = []
   for file_ in data_files:
     dirname = os.path.dirname(file_['dstpath'])
     dirname = dirname.lstrip('/') # absolute paths start with '/', remove that
-    if dirname != '':
+    if dirname != '' and dirname not in dir_indexes:
       parts = dirname.split('/')
+      parent = -1
       for i in range(len(parts)):
         partial = '/'.join(parts[:i + 1])
-        if partial not in partial_dirs:
-          partial_dirs.append(partial)
-          if use_pthreadfs:
-            code += ('''await PThreadFS.createPath(%s, %s, true, true);\n'''
-                    % (json.dumps('/' + '/'.join(parts[:i])), json.dumps(parts[i])))
-          else:
-            code += ('''Module['FS_createPath'](%s, %s, true, true);\n'''
-                    % (json.dumps('/' + '/'.join(parts[:i])), json.dumps(parts[i])))
+        index = dir_indexes.get(partial)
+        if index is None:
+          index = dir_indexes[partial] = len(dir_tree) // 2
+          dir_tree += [parent, parts[i]]
+        parent = index
+  if dir_tree:
+    code += '''
+      var dirTree = %s;
+      var dirPaths = [];
+      for (var i = 0; i < dirTree.length; i += 2) {
+        var parent = dirTree[i] < 0 ? '' : dirPaths[dirTree[i]];
+        %s('/' + parent, dirTree[i + 1], true, true);
+        dirPaths.push(parent ? parent + '/' + dirTree[i + 1] : dirTree[i + 1]);
+      }
+    ''' % (json.dumps(dir_tree, separators=(',', ':')),
+           'await PThreadFS.createPath' if use_pthreadfs else "Module['FS_createPath']")
   if use_pthreadfs:
     code += '''await PThreadFS.createPath("/", METADATA_FOLDER, true, true);'''
   if has_preloaded:
     # Bundle all datafiles into one archive. Avoids doing lots of simultaneous
     # XHRs which has overhead.
+    lz4_meta = None
+    previous_manifest = read_manifest(manifest) if manifest else None
+    hash_files(data_files, previous_manifest)
     start = 0
-    with open(data_target, 'wb') as data:
-      for file_ in data_files:
-        file_['data_start'] = start
-        with open(file_['srcpath'], 'rb') as f:
-          curr = f.read()
-        file_['data_end'] = start + len(curr)
-        if AV_WORKAROUND:
-            curr += '\x00'
-        start += len(curr)
-        data.write(curr)
-
-    # TODO: sha256sum on data_target
+    # files with identical contents are stored once, and all of them point at
+    # the same bytes
+    stored = {}
+    for file_ in data_files:
+      key = (file_['hash'], file_['size'])
+      if key in stored:
+        file_['data_start'], file_['data_end'] = stored[key]
+        file_['duplicate'] = True
+        continue
+      stored[key] = (start, start + file_['size'])
+      file_['duplicate'] = False
+      file_['data_start'] = start
+      file_['data_end'] = start + file_['size']
+      start += file_['size']
+      if AV_WORKAROUND:
+        start += 1
+
+    kept = reusable_files(previous_manifest, data_files, data_target, lz4)
+    data_up_to_date = kept == len(data_files) and (lz4 or previous_manifest['data_size'] == start)
+    if DEBUG and len(stored) < len(data_files):
+      print('storing %d duplicate files only once' % (len(data_files) - len(stored)),
+            file=sys.stderr)
+    if DEBUG and kept:
+      print('reusing %d of %d files from existing %s' % (kept, len(data_files), data_target),
+            file=sys.stderr)
+    if not data_up_to_date:
+      with open(data_target, 'r+b' if kept else 'wb') as data:
+        if kept:
+          # duplicates point back into the kept bytes, so the first file that
+          # owns its range marks where the new data starts
+          keep_size = next((f['data_start'] for f in data_files[kept:] if not f['duplicate']), start)
+          data.truncate(keep_size)
+          data.seek(keep_size)
+        for file_ in data_files[kept:]:
+          if file_['duplicate']:
+            continue
+          if append_file(data, file_['srcpath'], file_['size']):
+            print('error: file "%s" changed while it was being packaged' % file_['srcpath'],
+                  file=sys.stderr)
+            return 1
+          if AV_WORKAROUND:
+            data.write(b'\x00')
+
     if start > 256 * 1024 * 1024:
       print('warning: file packager is creating an asset bundle of %d MB. '
             'this is very large, and browsers might have trouble loading it. '
@@ -472,6 +845,7 @@ let loading_script =
           }
           DataRequest.prototype = {
             requests: {},
+            owned: {},
             open: function(mode, name) {
               this.name = name;
               this.requests[name] = this;
@@ -480,6 +854,11 @@ let loading_script =
             send: function() {},
             onload: function() {
               var byteArray = this.byteArray.subarray(this.start, this.end);
+              // identical files share their bytes in the package, but only one
+              // of them may own them, as MEMFS writes into owned data in place
+              var range = this.start + ':' + this.end;
+              if (this.owned[range]) byteArray = byteArray.slice();
+              this.owned[range] = true;
               this.finish(byteArray);
             },
             finish: function(byteArray) {
@@ -494,51 +873,18 @@ let loading_script =
               for (var i = 0; i < files.length; ++i) {
                 new DataRequest(files[i]['start'], files[i]['end'], files[i]['audio']).open('GET', files[i]['filename']);
               }
+        ''' if not lazy else '''
+              var files = metadata['files'];
+              for (var i = 0; i < files.length; ++i) {
+                if (files[i]['end'] > PREFETCH_SIZE) {
+                  var name = files[i]['filename'];
+                  var slash = name.lastIndexOf('/');
+                  Module['FS_createLazyFile'](name.slice(0, slash) || '/', name.slice(slash + 1), REMOTE_PACKAGE_NAME, true, true, files[i]['start'], files[i]['end']);
+                } else {
+                  new DataRequest(files[i]['start'], files[i]['end'], files[i]['audio']).open('GET', files[i]['filename']);
+                }
+              }
         ''')
-      else:
-        code += '''
-        /** @constructor */
-      function DataRequest(start, end, audio) {
-        this.start = start;
-        this.end = end;
-        this.audio = audio;
-      }
-      DataRequest.prototype = {
-        requests : {},
-        open : function(mode, name) {
-          this.name = name;
-          this.requests[name] = this;
-        },
-        send : function() {},
-        onload : async function() {
-          var byteArray = this.byteArray.subarray(this.start, this.end);
-          await this.finish(byteArray);
-        },
-        finish : async function(byteArray) {
-          var that = this;
-
-          // Remove potential old versions of this file.
-          // TODO: Consider only removing if the file exists, for performance.
-          try {
-            await PThreadFS.unlink(this.name);
-          }
-          catch (e) {
-            // Emitting an error will spam the console with unnecessary messages.
-            // console.log("Removing " + this.name + " failed with message " + e);
-          }
-          await PThreadFS.createDataFile(this.name, null, byteArray, true, true,
-            true); // canOwn this data in the filesystem, it is a slide into the heap that will
-                   // never change
-
-          this.requests[this.name] = null;
-        }
-      };
-
-        var files = metadata['files'];
-        for (var i = 0; i < files.length; ++i) {
-          new DataRequest(files[i]['start'], files[i]['end'], files[i]['audio']).open('GET', files[i]['filename']);
-        }
-      '''
 
   counter = 0
   for file_ in data_files:
@@ -547,7 +893,7 @@ let loading_script =
     basename = os.path.basename(filename)
     if file_['mode'] == 'embed':
       # Embed
-      data = base64_encode(utils.read_binary(file_['srcpath']))
+      data = base64_encode_file(file_['srcpath'])
       code += '''var fileData%d = '%s';\n''' % (counter, data)
       code += ('''Module['FS_createDataFile']('%s', '%s', decodeBase64(fileData%d), true, true, false);\n'''
                % (dirname, basename, counter))
@@ -561,55 +907,51 @@ let loading_script =
         'end': file_['data_end'],
         'audio': 1 if filename[-4:] in AUDIO_SUFFIXES else 0,
       })
+      if use_pthreadfs:
+        # lets the loader skip files that are already in persistent storage
+        metadata['files'][-1]['hash'] = file_['hash'][:32]
     else:
       assert 0
 
   if has_preloaded:
     if not lz4:
       # Get the big archive and split it up
-      use_data = '''
+      if not use_pthreadfs:
+        use_data = '''
         // Reuse the bytearray from the XHR as the source for file reads.
         DataRequest.prototype.byteArray = byteArray;
     '''
-      use_data += '''
+        use_data += '''
         var files = metadata['files'];
-        let promises = [];
         for (var i = 0; i < files.length; ++i) {
-          promises.push(DataRequest.prototype.requests[files[i].filename].onload());
+          %sDataRequest.prototype.requests[files[i].filename].onload();
         }
-        await Promise.all(promises);
-      '''
-      if not use_pthreadfs:
+      ''' % ('if (files[i].end <= PREFETCH_SIZE) ' if lazy else '')
         use_data += ("          Module['removeRunDependency']('datafile_%s');\n"
                     % shared.JS.escape_for_js_string(data_target))
       else:
-        use_data += '''
-        let metadata_file = METADATA_FOLDER + PACKAGE_UUID;
-        try {
-          await PThreadFS.create(metadata_file);
-        }      
-        catch (e) {
-          console.log("Writing package UUID failed, no caching");
-        }
+        use_data = '''
+        await PThreadFS.importFiles(files, byteArray);
         '''
 
     else:
       # LZ4FS usage
-      temp = data_target + '.orig'
-      shutil.move(data_target, temp)
-      meta = shared.run_js_tool(shared.path_from_root('tools', 'lz4-compress.js'),
-                                [shared.path_from_root('third_party', 'mini-lz4.js'),
-                                temp, data_target], stdout=PIPE)
-      os.unlink(temp)
+      if data_up_to_date:
+        lz4_meta = previous_manifest['lz4']
+      else:
+        lz4_meta = lz4_compress_package(data_target)
       use_data = '''
             var compressedData = %s;
             compressedData['data'] = byteArray;
             assert(typeof Module['LZ4'] === 'object', 'LZ4 not present - was your app build with  -s LZ4=1  ?');
             Module['LZ4'].loadPackage({ 'metadata': metadata, 'compressedData': compressedData }, %s);
             Module['removeRunDependency']('datafile_%s');
-      ''' % (meta, "true" if use_preload_plugins else "false", shared.JS.escape_for_js_string(data_target))
+      ''' % (lz4_meta, "true" if use_preload_plugins else "false", shared.JS.escape_for_js_string(data_target))
+
+    if manifest:
+      write_manifest(manifest, data_files, data_target, lz4_meta)
 
-    package_uuid = uuid.uuid4()
+    package_uuid = get_package_uuid(data_files, lz4)
     package_name = data_target
     remote_package_size = os.path.getsize(package_name)
     remote_package_name = os.path.basename(package_name)
@@ -632,12 +974,29 @@ let loading_script =
            shared.JS.escape_for_js_string(remote_package_name))
     if use_pthreadfs:
       ret += "let METADATA_FOLDER = '/persistent/EM_CA/';\n"
+    if binary_metadata and remote_package_size >= 2 ** 32:
+      print('error: --binary-metadata does not support packages of 4GB or more', file=sys.stderr)
+      return 1
     metadata['remote_package_size'] = remote_package_size
     metadata['package_uuid'] = str(package_uuid)
+    if chunk_size:
+      metadata['chunk_size'] = chunk_size
+      metadata['chunks'] = hash_chunks(data_target, chunk_size)
     ret += '''
       var REMOTE_PACKAGE_SIZE = metadata['remote_package_size'];
       var PACKAGE_UUID = metadata['package_uuid'];
     '''
+    if lazy:
+      prefetch_size = 0
+      for file_ in data_files:
+        if file_['mode'] == 'preload' and is_prefetched(file_):
+          prefetch_size = max(prefetch_size, file_['data_end'])
+      metadata['prefetch_size'] = prefetch_size
+      ret += '''
+      // Lazy files need synchronous XHRs, which only work in workers
+      var LAZY_LOADING = typeof XMLHttpRequest !== 'undefined' && typeof importScripts === 'function';
+      var PREFETCH_SIZE = LAZY_LOADING ? metadata['prefetch_size'] : REMOTE_PACKAGE_SIZE;
+    '''
 
     if use_preload_cache:
       code += r'''
@@ -802,6 +1161,145 @@ let loading_script =
           }
         }
       '''
+      if chunk_size:
+        code += r'''
+        var PACKAGE_CHUNK_SIZE = metadata['chunk_size'];
+        var PACKAGE_CHUNKS = metadata['chunks'];
+        var MAX_CHUNK_FETCHES = 4;
+
+        function fetchChunkRange(packageName, start, end, callback, errback) {
+          var xhr = new XMLHttpRequest();
+          xhr.open('GET', packageName, true);
+          xhr.responseType = 'arraybuffer';
+          xhr.setRequestHeader('Range', 'bytes=' + start + '-' + (end - 1));
+          xhr.onerror = function(event) {
+            errback(new Error("NetworkError for: " + packageName));
+          };
+          xhr.onload = function(event) {
+            if (xhr.status == 206 || xhr.status == 200 || (xhr.status == 0 && xhr.response)) {
+              // a 200 means the server ignored the range and sent the whole package
+              callback(xhr.response, xhr.status == 206 ? start : 0);
+            } else {
+              errback(new Error(xhr.statusText + " : " + xhr.responseURL));
+            }
+          };
+          xhr.send(null);
+        }
+
+        /* Assemble the package from the chunks in the cache, downloading (and
+           caching) only the chunks that are not there yet. Chunks are addressed
+           by the hash of their content, so chunks that did not change between
+           versions of the package are reused. Each package has its own chunks,
+           so that dropping those of an old version does not affect others. */
+        function fetchChunkedPackage(db, packageName, remotePackageName, packageSize, callback, errback) {
+          function chunkKey(hash) {
+            return 'chunk/' + packageName + '/' + hash;
+          }
+          var packageData = new Uint8Array(packageSize);
+          var chunkCount = PACKAGE_CHUNKS.length;
+          var missing = [];
+          var checked = 0;
+          var failed = false;
+          function fail(error) {
+            if (!failed) {
+              failed = true;
+              errback(error);
+            }
+          }
+          var transaction = db.transaction([PACKAGE_STORE_NAME, METADATA_STORE_NAME], IDB_RO);
+          var packages = transaction.objectStore(PACKAGE_STORE_NAME);
+          var oldChunks = [];
+          var getMetadata = transaction.objectStore(METADATA_STORE_NAME).get('metadata/' + packageName);
+          getMetadata.onsuccess = function(event) {
+            if (event.target.result && event.target.result['chunks']) oldChunks = event.target.result['chunks'];
+          };
+          PACKAGE_CHUNKS.forEach(function(hash, i) {
+            var getRequest = packages.get(chunkKey(hash));
+            getRequest.onsuccess = function(event) {
+              if (event.target.result) {
+                packageData.set(new Uint8Array(event.target.result), i * PACKAGE_CHUNK_SIZE);
+              } else {
+                missing.push(i);
+              }
+            };
+            getRequest.onerror = fail;
+          });
+          transaction.oncomplete = function() {
+            Module.preloadResults[PACKAGE_NAME] = {fromCache: missing.length == 0};
+            downloadMissing();
+          };
+          transaction.onerror = fail;
+
+          function storeChunk(i) {
+            var start = i * PACKAGE_CHUNK_SIZE;
+            var chunk = packageData.slice(start, start + PACKAGE_CHUNK_SIZE).buffer;
+            var putRequest = db.transaction([PACKAGE_STORE_NAME], IDB_RW).objectStore(PACKAGE_STORE_NAME).put(chunk, chunkKey(PACKAGE_CHUNKS[i]));
+            putRequest.onerror = function(error) {
+              console.error('failed to cache package chunk', error);
+            };
+          }
+
+          function finish() {
+            // Record the chunks of this version, and drop the ones only the
+            // previous version used.
+            var transaction = db.transaction([PACKAGE_STORE_NAME, METADATA_STORE_NAME], IDB_RW);
+            var packages = transaction.objectStore(PACKAGE_STORE_NAME);
+            var current = {};
+            PACKAGE_CHUNKS.forEach(function(hash) {
+              current[hash] = true;
+            });
+            oldChunks.forEach(function(hash) {
+              if (!current[hash]) packages.delete(chunkKey(hash));
+            });
+            transaction.objectStore(METADATA_STORE_NAME).put({
+              'uuid': PACKAGE_UUID,
+              'chunks': PACKAGE_CHUNKS
+            }, 'metadata/' + packageName);
+            transaction.onerror = function(error) {
+              console.error('failed to update package cache metadata', error);
+            };
+            callback(packageData.buffer);
+          }
+
+          function downloadMissing() {
+            var next = 0;
+            var pending = 0;
+            var loaded = 0;
+            var total = missing.length;
+            if (!total) return finish();
+            function fetchNext() {
+              if (failed) return;
+              if (next == missing.length) {
+                if (!pending) finish();
+                return;
+              }
+              var i = missing[next++];
+              var start = i * PACKAGE_CHUNK_SIZE;
+              var end = Math.min(start + PACKAGE_CHUNK_SIZE, packageSize);
+              pending++;
+              fetchChunkRange(remotePackageName, start, end, function(response, offset) {
+                pending--;
+                if (offset == 0 && response.byteLength == packageSize) {
+                  // we got everything at once
+                  packageData.set(new Uint8Array(response));
+                  storeChunk(i);
+                  missing.slice(next).forEach(storeChunk);
+                  next = missing.length;
+                } else {
+                  packageData.set(new Uint8Array(response), start);
+                  storeChunk(i);
+                }
+                loaded++;
+                if (Module['setStatus']) Module['setStatus']('Downloading data... (' + loaded + '/' + total + ' chunks)');
+                fetchNext();
+              }, fail);
+            }
+            for (var j = 0; j < MAX_CHUNK_FETCHES; j++) {
+              fetchNext();
+            }
+          }
+        }
+      '''
     elif use_pthreadfs:
       code += r'''
 
@@ -815,6 +1313,47 @@ let loading_script =
           return false;
         }
       }
+
+      // The hashes of the files of the version of this package that is in
+      // persistent storage, so that updates only need to write the difference.
+      let package_record = METADATA_FOLDER + 'package_' + encodeURIComponent(PACKAGE_NAME);
+
+      async function readPackageRecord() {
+        try {
+          return JSON.parse(await PThreadFS.readFile(package_record, {encoding: 'utf8'}));
+        }
+        catch (e) {
+          return {'uuid': null, 'files': {}};
+        }
+      }
+
+      // The size of a file in persistent storage, or -1 if it does not exist.
+      async function storedFileSize(name) {
+        try {
+          return (await PThreadFS.stat(name)).size;
+        }
+        catch (e) {
+          return -1;
+        }
+      }
+
+      async function writePackageRecord(old_record, hashes) {
+        try {
+          await PThreadFS.writeFile(package_record, JSON.stringify({'uuid': PACKAGE_UUID, 'files': hashes}));
+          await PThreadFS.create(METADATA_FOLDER + PACKAGE_UUID);
+        }
+        catch (e) {
+          console.log("Writing package UUID failed, no caching");
+          return;
+        }
+        if (old_record['uuid']) {
+          try {
+            await PThreadFS.unlink(METADATA_FOLDER + old_record['uuid']);
+          }
+          catch (e) {
+          }
+        }
+      }
       '''
 
     if not use_pthreadfs:
@@ -833,12 +1372,24 @@ let loading_script =
             return;
           }
         '''
+      # in lazy mode only the start of the package (with the prefetched files)
+      # is fetched
+      range_code = ''
+      if lazy:
+        range_code = r'''
+        if (!packageSize) {
+          callback(new ArrayBuffer(0));
+          return;
+        }
+        if (packageSize < REMOTE_PACKAGE_SIZE) xhr.setRequestHeader('Range', 'bytes=0-' + (packageSize - 1));
+        '''
       ret += r'''
       function fetchRemotePackage(packageName, packageSize, callback, errback) {
         %(node_support_code)s
         var xhr = new XMLHttpRequest();
         xhr.open('GET', packageName, true);
         xhr.responseType = 'arraybuffer';
+        %(range_code)s
         xhr.onprogress = function(event) {
           var url = packageName;
           var size = packageSize;
@@ -886,7 +1437,7 @@ let loading_script =
       function handleError(error) {
         console.error('package error:', error);
       };
-      ''' % {'node_support_code': node_support_code}
+      ''' % {'node_support_code': node_support_code, 'range_code': range_code}
 
       code += r'''
         function processPackageData(arrayBuffer) {
@@ -942,7 +1493,7 @@ let loading_script =
     };
       ''' % {'node_support_code': node_support_code}
       code += r'''
-      async function processPackageData(arrayBuffer) {
+      async function processPackageData(arrayBuffer, files) {
         assert(arrayBuffer, 'Loading data file failed.');
         assert(arrayBuffer instanceof ArrayBuffer, 'bad input to processPackageData');
         var byteArray = new Uint8Array(arrayBuffer);
@@ -958,7 +1509,19 @@ let loading_script =
           console.error('falling back to default preload behavior');
           fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE, processPackageData, handleError);
         };
+      '''
+    if use_preload_cache and chunk_size:
+      code += r'''
+        openDatabase(
+          function(db) {
+            fetchChunkedPackage(db, PACKAGE_PATH + PACKAGE_NAME, REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE, processPackageData, preloadFallback);
+          }
+        , preloadFallback);
 
+        if (Module['setStatus']) Module['setStatus']('Downloading...');
+      '''
+    elif use_preload_cache:
+      code += r'''
         openDatabase(
           function(db) {
             checkCachedPackage(db, PACKAGE_PATH + PACKAGE_NAME,
@@ -988,9 +1551,35 @@ let loading_script =
       code += '''
       let is_cached = await checkCachedPackage(REMOTE_PACKAGE_NAME);
       if (!is_cached) {
-        console.log("not cached, downloading package " + REMOTE_PACKAGE_NAME);
-        let package = await fetchRemotePackage(REMOTE_PACKAGE_NAME);
-        await processPackageData(package);
+        let record = await readPackageRecord();
+        let old_hashes = record['files'];
+        let hashes = {};
+        let changed = [];
+        for (let file of metadata['files']) {
+          hashes[file['filename']] = file['hash'];
+          // Files that were removed, truncated or extended since the previous
+          // version was imported are written again.
+          if (old_hashes[file['filename']] !== file['hash'] ||
+              await storedFileSize(file['filename']) !== file['end'] - file['start']) {
+            changed.push(file);
+          }
+        }
+        for (let name in old_hashes) {
+          if (!(name in hashes)) {
+            try {
+              await PThreadFS.unlink(name);
+            }
+            catch (e) {
+            }
+          }
+        }
+        if (changed.length) {
+          console.log("not cached, downloading package " + REMOTE_PACKAGE_NAME + " to update " +
+                      changed.length + " of " + metadata['files'].length + " files");
+          let package = await fetchRemotePackage(REMOTE_PACKAGE_NAME);
+          await processPackageData(package, changed);
+        }
+        await writePackageRecord(record, hashes);
       }
       else {
         console.log("using cached package " + REMOTE_PACKAGE_NAME);
@@ -1005,7 +1594,7 @@ let loading_script =
         var fetchedCallback = null;
         var fetched = Module['getPreloadedPackage'] ? Module['getPreloadedPackage'](REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE) : null;
 
-        if (!fetched) fetchRemotePackage(REMOTE_PACKAGE_NAME, REMOTE_PACKAGE_SIZE, function(data) {
+        if (!fetched) fetchRemotePackage(REMOTE_PACKAGE_NAME, %s, function(data) {
           if (fetchedCallback) {
             fetchedCallback(data);
             fetchedCallback = null;
@@ -1013,7 +1602,7 @@ let loading_script =
             fetched = data;
           }
         }, handleError);
-      '''
+      ''' % ('PREFETCH_SIZE' if lazy else 'REMOTE_PACKAGE_SIZE')
 
       code += r'''
         Module.preloadResults[PACKAGE_NAME] = {fromCache: false};
@@ -1048,15 +1637,50 @@ let loading_script =
     await runWithFS();
     '''
 
-  if separate_metadata:
-      _metadata_template = '''
-    Module['removeRunDependency']('%(metadata_file)s');
+  if separate_metadata and binary_metadata:
+      # see encode_binary_metadata for the format
+      _metadata_decoder = '''
+   function decodeMetadata(buffer) {
+    var header = new Uint32Array(buffer, 0, 4);
+    if (header[0] !== %(magic)d || header[1] !== %(version)d) throw 'bad package metadata file';
+    var count = header[2];
+    var decoder = new TextDecoder('utf-8');
+    var metadata = JSON.parse(decoder.decode(new Uint8Array(buffer, 16, header[3])));
+    var offset = 16 + header[3];
+    var starts = new Uint32Array(buffer, offset, count);
+    var ends = new Uint32Array(buffer, offset + 4 * count, count);
+    var nameEnds = new Uint32Array(buffer, offset + 8 * count, count);
+    var audio = new Uint8Array(buffer, offset + 12 * count, count);
+    var names = decoder.decode(new Uint8Array(buffer, offset + 13 * count));
+    var hashes = metadata['file_hashes'];
+    delete metadata['file_hashes'];
+    var files = metadata['files'] = new Array(count);
+    var nameStart = 0;
+    for (var i = 0; i < count; i++) {
+     files[i] = {
+      'filename': names.slice(nameStart, nameEnds[i]),
+      'start': starts[i],
+      'end': ends[i],
+      'audio': audio[i]
+     };
+     if (hashes) files[i]['hash'] = hashes[i];
+     nameStart = nameEnds[i];
+    }
+    return metadata;
    }
-
-   function runMetaWithFS() {
-    Module['addRunDependency']('%(metadata_file)s');
-    var REMOTE_METADATA_NAME = Module['locateFile'] ? Module['locateFile']('%(metadata_file)s', '') : '%(metadata_file)s';
-    var xhr = new XMLHttpRequest();
+''' % {'magic': BINARY_METADATA_MAGIC, 'version': BINARY_METADATA_VERSION}
+      _metadata_request = '''
+    xhr.responseType = 'arraybuffer';
+    xhr.onreadystatechange = function() {
+     if (xhr.readyState === 4 && xhr.status === 200) {
+       loadPackage(decodeMetadata(xhr.response));
+     }
+    }
+    xhr.open('GET', REMOTE_METADATA_NAME, true);
+'''
+  else:
+      _metadata_decoder = ''
+      _metadata_request = '''
     xhr.onreadystatechange = function() {
      if (xhr.readyState === 4 && xhr.status === 200) {
        loadPackage(JSON.parse(xhr.responseText));
@@ -1064,7 +1688,17 @@ let loading_script =
     }
     xhr.open('GET', REMOTE_METADATA_NAME, true);
     xhr.overrideMimeType('application/json');
-    xhr.send(null);
+'''
+
+  if separate_metadata:
+      _metadata_template = '''
+    Module['removeRunDependency']('%(metadata_file)s');
+   }
+%(metadata_decoder)s
+   function runMetaWithFS() {
+    Module['addRunDependency']('%(metadata_file)s');
+    var REMOTE_METADATA_NAME = Module['locateFile'] ? Module['locateFile']('%(metadata_file)s', '') : '%(metadata_file)s';
+    var xhr = new XMLHttpRequest();%(metadata_request)s    xhr.send(null);
    }
 
    if (Module['calledRun']) {
@@ -1073,13 +1707,15 @@ let loading_script =
     if (!Module['preRun']) Module['preRun'] = [];
     Module["preRun"].push(runMetaWithFS);
    }
-  ''' % {'metadata_file': os.path.basename(jsoutput + '.metadata')}
+  ''' % {'metadata_file': os.path.basename(jsoutput + '.metadata'),
+         'metadata_decoder': _metadata_decoder,
+         'metadata_request': _metadata_request}
 
   else:
       _metadata_template = '''
    };
-   await loadPackage(%s);
-  ''' % json.dumps(metadata)
+   %sloadPackage(%s);
+  ''' % ('await ' if use_pthreadfs else '', json.dumps(metadata))
 
   if not use_pthreadfs:
     ret += '''%s
@@ -1113,7 +1749,10 @@ let loading_script =
       else:
         with open(jsoutput, 'w') as f:
           f.write(ret)
-      if separate_metadata:
+      if separate_metadata and binary_metadata:
+        with open(jsoutput + '.metadata', 'wb') as f:
+          f.write(encode_binary_metadata(metadata))
+      elif separate_metadata:
         with open(jsoutput + '.metadata', 'w') as f:
           json.dump(metadata, f, separators=(',', ':'))
 
@@ -52,10 +52,10 @@ function createWasiWrapper(name, args, wrappers) {
   if (args.length > 0) {
     full_args = full_args + ',' + args.join(',');
   }
-  let full_args_with_resume = full_args + ',resume';
+  let full_args_with_resume = full_args + ',call,resume';
   let wrapper = `function(${full_args_with_resume}) {`;
   wrapper += `_fd_${name}_async(${full_args}).then((res) => {`;
-  wrapper += 'wasmTable.get(resume)(res);});}'
+  wrapper += 'wasmTable.get(resume)(call, res);});}'
   wrappers[`__fd_${name}_async`] = eval('(' + wrapper + ')');
   // Additional backends must register a dependency here.
   wrappers[`__fd_${name}_async__deps`] = [`fd_${name}_async`, '$ASYNCSYSCALLS', '$FSAFS'];
@@ -63,14 +63,14 @@ function createWasiWrapper(name, args, wrappers) {
 
 function createSyscallWrapper(name, args, wrappers) {
   let full_args = '';
-  let full_args_with_resume = 'resume';
+  let full_args_with_resume = 'call, resume';
   if (args.length > 0) {
     full_args = args.join(',');
-    full_args_with_resume = full_args + ', resume';
+    full_args_with_resume = full_args + ', call, resume';
   }
   let wrapper = `function(${full_args_with_resume}) {`;
   wrapper += `_${name}_async(${full_args}).then((res) => {`;
-  wrapper += 'wasmTable.get(resume)(res);});}'
+  wrapper += 'wasmTable.get(resume)(call, res);});}'
   wrappers[`__sys_${name}_async`] = eval('(' + wrapper + ')');
   // Additional backends must register a dependency here.
   wrappers[`__sys_${name}_async__deps`] = [`${name}_async`, '$ASYNCSYSCALLS', '$FSAFS'];
@@ -84,13 +84,13 @@ for (x of SyscallsFunctions) {
 }
 
 SyscallWrappers['utime_sync'] =
-  function(folder_ref, resume) {
+  function(folder_ref, call, resume) {
   let folder = UTF8ToString(folder_ref);
 
   PThreadFS.init(folder).then(async () => {
     // Load packaged data added during --pre-js.
     await PThreadFS.loadAvailablePackages();
-    wasmTable.get(resume)();
+    wasmTable.get(resume)(call);
   });
 }
 
@@ -111,7 +111,7 @@ SyscallWrappers['utime_sync'] = function(path, times) {
   return setFileTime(path, time);
 };
 
-SyscallWrappers['utime_async'] = function(path, times, resume) {
+SyscallWrappers['utime_async'] = function(path, times, call, resume) {
   var time;
   if (times) {
     // NOTE: We don't keep track of access timestamps.
@@ -122,23 +122,23 @@ SyscallWrappers['utime_async'] = function(path, times, resume) {
   path = UTF8ToString(path);
   try {
     PThreadFS.utime(path, time, time).then(() => {
-      wasmTable.get(resume)(0);
+      wasmTable.get(resume)(call, 0);
     });
   } catch (e) {
     if (!(e instanceof PThreadFS.ErrnoError)) throw e + ' : ' + stackTrace();
     setErrNo(e.errno);
-    wasmTable.get(resume)(-1);
+    wasmTable.get(resume)(call, -1);
   }
 };
 
 SyscallWrappers['pthreadfs_init'] =
-  function(folder_ref, resume) {
+  function(folder_ref, call, resume) {
   let folder = UTF8ToString(folder_ref);
 
   PThreadFS.init(folder).then(async () => {
     // Load packaged data added during --pre-js.
     await PThreadFS.loadAvailablePackages();
-    wasmTable.get(resume)();
+    wasmTable.get(resume)(call);
   });
 }
 
@@ -313,26 +313,80 @@ var SyscallsLibrary = {
       }
       return 0;
     },
-    doReadv: async function(stream, iov, iovcnt, offset) {
-      var ret = 0;
+    // Buffers that are not adjacent in memory are copied into a single buffer
+    // of up to this many bytes, so that they are read or written at once.
+    GATHER_LIMIT: 64 * 1024,
+    // Returns the buffers of an iovec array as [ptr, len] pairs, with buffers
+    // that are adjacent in memory merged.
+    getIovecRuns: function(iov, iovcnt) {
+      var runs = [];
       for (var i = 0; i < iovcnt; i++) {
         var ptr = {{{ makeGetValue('iov', 'i*8', 'i32') }}};
         var len = {{{ makeGetValue('iov', 'i*8 + 4', 'i32') }}};
+        if (len == 0) continue;
+        var last = runs[runs.length - 1];
+        if (last && last[0] + last[1] == ptr) {
+          last[1] += len;
+        } else {
+          runs.push([ptr, len]);
+        }
+      }
+      return runs;
+    },
+    getRunsLength: function(runs) {
+      var total = 0;
+      for (var i = 0; i < runs.length; i++) {
+        total += runs[i][1];
+      }
+      return total;
+    },
+    doReadv: async function(stream, iov, iovcnt, offset) {
+      var runs = ASYNCSYSCALLS.getIovecRuns(iov, iovcnt);
+      var total = ASYNCSYSCALLS.getRunsLength(runs);
+      if (runs.length > 1 && total <= ASYNCSYSCALLS.GATHER_LIMIT) {
+        var buffer = new Uint8Array(total);
+        var ret = await PThreadFS.read(stream, buffer, 0, total, offset);
+        if (ret < 0) return -1;
+        var pos = 0;
+        for (var i = 0; i < runs.length && pos < ret; i++) {
+          var len = Math.min(runs[i][1], ret - pos);
+          HEAPU8.set(buffer.subarray(pos, pos + len), runs[i][0]);
+          pos += len;
+        }
+        return ret;
+      }
+      var ret = 0;
+      for (var i = 0; i < runs.length; i++) {
+        var ptr = runs[i][0];
+        var len = runs[i][1];
         var curr = await PThreadFS.read(stream, {{{ heapAndOffset('HEAP8', 'ptr') }}}, len, offset);
         if (curr < 0) return -1;
         ret += curr;
         if (curr < len) break; // nothing more to read
+        if (offset !== undefined) offset += curr;
       }
       return ret;
     },
     doWritev: async function(stream, iov, iovcnt, offset) {
+      var runs = ASYNCSYSCALLS.getIovecRuns(iov, iovcnt);
+      var total = ASYNCSYSCALLS.getRunsLength(runs);
+      if (runs.length > 1 && total <= ASYNCSYSCALLS.GATHER_LIMIT) {
+        var buffer = new Uint8Array(total);
+        var pos = 0;
+        for (var i = 0; i < runs.length; i++) {
+          buffer.set(HEAPU8.subarray(runs[i][0], runs[i][0] + runs[i][1]), pos);
+          pos += runs[i][1];
+        }
+        return await PThreadFS.write(stream, buffer, 0, total, offset);
+      }
       var ret = 0;
-      for (var i = 0; i < iovcnt; i++) {
-        var ptr = {{{ makeGetValue('iov', 'i*8', 'i32') }}};
-        var len = {{{ makeGetValue('iov', 'i*8 + 4', 'i32') }}};
+      for (var i = 0; i < runs.length; i++) {
+        var ptr = runs[i][0];
+        var len = runs[i][1];
         var curr = await PThreadFS.write(stream, {{{ heapAndOffset('HEAP8', 'ptr') }}}, len, offset);
         if (curr < 0) return -1;
         ret += curr;
+        if (offset !== undefined) offset += curr;
       }
       return ret;
     },
@@ -642,8 +696,10 @@ var SyscallsLibrary = {
     },
     fdatasync_async : async function(fd) {
       var stream = await ASYNCSYSCALLS.getStreamFromFD(fd);
-      //TODO(rstz): Consider implementing this, since Storage Foundation supports flush().
-      return 0; 
+      if (stream.stream_ops && stream.stream_ops.fsync) {
+        return await stream.stream_ops.fsync(stream);
+      }
+      return 0;
     },
     poll_async : async function(fds, nfds, timeout) {
       var nonzero = 0;
@@ -2078,17 +2134,26 @@ mergeInto(LibraryManager.library, SyscallsLibrary);
       if (!stream.stream_ops.write) {
         throw new PThreadFS.ErrnoError({{{ cDefine('EINVAL') }}});
       }
+      var seeking = typeof position !== 'undefined';
+      // In append mode, the file system writes at the end of the file and sets
+      // stream.position to where the write starts. It determines the end in
+      // the same step as the write, since calls on other streams of the file
+      // may run in between.
+      var append = false;
       if (stream.seekable && stream.flags & {{{ cDefine('O_APPEND') }}}) {
-        // seek to the end before writing in append mode
-        await PThreadFS.llseek(stream, 0, {{{ cDefine('SEEK_END') }}});
+        if (seeking) {
+          // seek to the end before writing in append mode
+          await PThreadFS.llseek(stream, 0, {{{ cDefine('SEEK_END') }}});
+        } else {
+          append = true;
+        }
       }
-      var seeking = typeof position !== 'undefined';
       if (!seeking) {
         position = stream.position;
       } else if (!stream.seekable) {
         throw new PThreadFS.ErrnoError({{{ cDefine('ESPIPE') }}});
       }
-      var bytesWritten = await stream.stream_ops.write(stream, buffer, offset, length, position, canOwn);
+      var bytesWritten = await stream.stream_ops.write(stream, buffer, offset, length, position, canOwn, append);
       if (!seeking) stream.position += bytesWritten;
       try {
         if (stream.path && PThreadFS.trackingDelegate['onWriteToFile']) PThreadFS.trackingDelegate['onWriteToFile'](stream.path);
@@ -2378,6 +2443,41 @@ mergeInto(LibraryManager.library, SyscallsLibrary);
       }
       return node;
     },
+    IMPORT_CONCURRENCY: 16,
+    // Writes a batch of files, e.g. the contents of a file package. `files` is a
+    // list of {'filename', 'start', 'end'} entries describing byte ranges of
+    // `data`. Each file is written with a single open, write and close (which
+    // flushes), replacing any previous version, and at most `concurrency` files
+    // are written at the same time.
+    importFiles: async function(files, data, concurrency) {
+      concurrency = concurrency || PThreadFS.IMPORT_CONCURRENCY;
+      var next = 0;
+      async function importNext() {
+        while (next < files.length) {
+          var file = files[next++];
+          await PThreadFS.importFile(file['filename'], data.subarray(file['start'], file['end']));
+        }
+      }
+      var workers = [];
+      for (var i = 0; i < Math.min(concurrency, files.length); i++) {
+        workers.push(importNext());
+      }
+      await Promise.all(workers);
+    },
+    importFile: async function(path, data) {
+      var mode = PThreadFS.getMode(true, true);
+      // Truncate through the open stream rather than with O_TRUNC, so that the
+      // backend only has to open the file once.
+      var stream = await PThreadFS.open(path, {{{ cDefine('O_CREAT') | cDefine('O_WRONLY') }}}, mode);
+      try {
+        if (data.length) {
+          await PThreadFS.write(stream, data, 0, data.length, 0);
+        }
+        await PThreadFS.ftruncate(stream.fd, data.length);
+      } finally {
+        await PThreadFS.close(stream);
+      }
+    },
     createDevice: async function(parent, name, input, output) {
       var path = PATH.join2(typeof parent === 'string' ? parent : PThreadFS.getPath(parent), name);
       var mode = PThreadFS.getMode(!!input, !!output);
@@ -2435,7 +2535,7 @@ mergeInto(LibraryManager.library, SyscallsLibrary);
     // Makes sure a file's contents are loaded. Returns whether the file has
     // been loaded successfully. No-op for files that have been loaded already.
     forceLoadFile: function(obj) {
-      if (obj.isDevice || obj.isFolder || obj.link || obj.contents) return true;
+      if (obj.isDevice || obj.isFolder || obj.link || obj.usedBytes) return true;
       if (typeof XMLHttpRequest !== 'undefined') {
         throw new Error("Lazy loading should have been performed (contents set) in createLazyFile, but it was not. Lazy loading only works in web workers. Use --embed-file or --preload-file in emcc on the main thread.");
       } else if (read_) {
@@ -2443,8 +2543,7 @@ mergeInto(LibraryManager.library, SyscallsLibrary);
         try {
           // WARNING: Can't read binary files in V8's d8 or tracemonkey's js, as
           //          read() will try to parse UTF8.
-          obj.contents = intArrayFromString(read_(obj.url), true);
-          obj.usedBytes = obj.contents.length;
+          MEMFS_ASYNC.setFileData(obj, new Uint8Array(intArrayFromString(read_(obj.url), true)));
         } catch (e) {
           throw new PThreadFS.ErrnoError({{{ cDefine('EIO') }}});
         }
@@ -2649,11 +2748,9 @@ mergeInto(LibraryManager.library, {
       } else if (PThreadFS.isFile(node.mode)) {
         node.node_ops = MEMFS_ASYNC.ops_table.file.node;
         node.stream_ops = MEMFS_ASYNC.ops_table.file.stream;
-        node.usedBytes = 0; // The actual number of bytes used in the typed array, as opposed to contents.length which gives the whole capacity.
-        // When the byte data of the file is populated, this will point to either a typed array, or a normal JS array. Typed arrays are preferred
-        // for performance, and used by default. However, typed arrays are not resizable like normal JS arrays are, so there is a small disk size
-        // penalty involved for appending file writes that continuously grow a file similar to std::vector capacity vs used -scheme.
-        node.contents = null; 
+        node.usedBytes = 0; // The size of the file.
+        // The chunks holding the byte data of the file, see CHUNK_SIZE.
+        node.contents = [];
       } else if (PThreadFS.isLink(node.mode)) {
         node.node_ops = MEMFS_ASYNC.ops_table.link.node;
         node.stream_ops = MEMFS_ASYNC.ops_table.link.stream;
@@ -2670,50 +2767,81 @@ mergeInto(LibraryManager.library, {
       return node;
     },
 
-    // Given a file node, returns its file data converted to a typed array.
-    getFileDataAsTypedArray: function(node) {
-      if (!node.contents) return new Uint8Array(0);
-      if (node.contents.subarray) return node.contents.subarray(0, node.usedBytes); // Make sure to not return excess unused bytes.
-      return new Uint8Array(node.contents);
-    },
+    // File data is stored in chunks of up to CHUNK_SIZE bytes, so that files
+    // grow without copying their data. Entry i of node.contents holds the bytes
+    // from i * CHUNK_SIZE on. An entry may be shorter than CHUNK_SIZE, or
+    // missing for a hole in a sparse file; the bytes it does not cover are
+    // zero.
+    CHUNK_SIZE: 64 * 1024,
 
-    // Allocates a new backing store for the given node so that it can fit at least newSize amount of bytes.
-    // May allocate more, to provide automatic geometric increase and amortized linear performance appending writes.
-    // Never shrinks the storage.
-    expandFileStorage: function(node, newCapacity) {
-#if CAN_ADDRESS_2GB
-      newCapacity >>>= 0;
-#endif
-      var prevCapacity = node.contents ? node.contents.length : 0;
-      if (prevCapacity >= newCapacity) return; // No need to expand, the storage was already large enough.
-      // Don't expand strictly to the given requested limit if it's only a very small increase, but instead geometrically grow capacity.
-      // For small filesizes (<1MB), perform size*2 geometric increase, but for large sizes, do a much more conservative size*1.125 increase to
-      // avoid overshooting the allocation cap by a very large margin.
-      var CAPACITY_DOUBLING_MAX = 1024 * 1024;
-      newCapacity = Math.max(newCapacity, (prevCapacity * (prevCapacity < CAPACITY_DOUBLING_MAX ? 2.0 : 1.125)) >>> 0);
-      if (prevCapacity != 0) newCapacity = Math.max(newCapacity, 256); // At minimum allocate 256b for each file when expanding.
-      var oldContents = node.contents;
-      node.contents = new Uint8Array(newCapacity); // Allocate new storage.
-      if (node.usedBytes > 0) node.contents.set(oldContents.subarray(0, node.usedBytes), 0); // Copy old data over to the new storage.
-    },
-
-    // Performs an exact resize of the backing file storage to the given size, if the size is not exactly this, the storage is fully reallocated.
+    // Given a file node, returns its file data as a typed array. This is a view
+    // of the file data if it is stored in a single chunk.
+    getFileDataAsTypedArray: function(node) {
+      var first = node.contents[0];
+      if (node.contents.length == 1 && first && first.length >= node.usedBytes) {
+        return first.subarray(0, node.usedBytes);
+      }
+      var data = new Uint8Array(node.usedBytes);
+      MEMFS_ASYNC.readFileData(node, data, 0, node.usedBytes, 0);
+      return data;
+    },
+
+    // Makes the given typed array the data of a file, without copying it.
+    setFileData: function(node, data) {
+      node.contents = [];
+      for (var start = 0; start < data.length; start += MEMFS_ASYNC.CHUNK_SIZE) {
+        node.contents.push(data.subarray(start, start + MEMFS_ASYNC.CHUNK_SIZE));
+      }
+      node.usedBytes = data.length;
+    },
+
+    // Returns the chunk with the given index, grown to at least minLength
+    // bytes. Chunks grow geometrically for amortized linear performance of
+    // appending writes, which copies at most CHUNK_SIZE bytes at a time.
+    getChunk: function(node, index, minLength) {
+      var chunk = node.contents[index];
+      if (chunk && chunk.length >= minLength) return chunk;
+      var prevLength = chunk ? chunk.length : 0;
+      var grown = new Uint8Array(Math.min(MEMFS_ASYNC.CHUNK_SIZE, Math.max(minLength, prevLength * 2, 256)));
+      if (chunk) grown.set(chunk);
+      node.contents[index] = grown;
+      return grown;
+    },
+
+    // Copies `length` bytes of file data from `position` on to the typed array
+    // `buffer` at `offset`.
+    readFileData: function(node, buffer, offset, length, position) {
+      var done = 0;
+      while (done < length) {
+        var index = Math.floor((position + done) / MEMFS_ASYNC.CHUNK_SIZE);
+        var start = position + done - index * MEMFS_ASYNC.CHUNK_SIZE;
+        var count = Math.min(MEMFS_ASYNC.CHUNK_SIZE - start, length - done);
+        var chunk = node.contents[index];
+        var available = chunk ? Math.max(0, Math.min(count, chunk.length - start)) : 0;
+        if (available) buffer.set(chunk.subarray(start, start + available), offset + done);
+        if (available < count) buffer.fill(0, offset + done + available, offset + done + count);
+        done += count;
+      }
+    },
+
+    // Sets the size of a file. Growing a file leaves a hole, which does not
+    // take up memory until it is written to.
     resizeFileStorage: function(node, newSize) {
 #if CAN_ADDRESS_2GB
       newSize >>>= 0;
 #endif
       if (node.usedBytes == newSize) return;
-      if (newSize == 0) {
-        node.contents = null; // Fully decommit when requesting a resize to zero.
-        node.usedBytes = 0;
-      } else {
-        var oldContents = node.contents;
-        node.contents = new Uint8Array(newSize); // Allocate new storage.
-        if (oldContents) {
-          node.contents.set(oldContents.subarray(0, Math.min(newSize, node.usedBytes))); // Copy old data over to the new storage.
+      if (newSize < node.usedBytes) {
+        var count = Math.ceil(newSize / MEMFS_ASYNC.CHUNK_SIZE);
+        node.contents.length = count; // Fully decommit the chunks past the end.
+        var lastLength = newSize - (count - 1) * MEMFS_ASYNC.CHUNK_SIZE;
+        var last = node.contents[count - 1];
+        if (last && last.length > lastLength) {
+          // The bytes past the end must read as zeros if the file grows again.
+          node.contents[count - 1] = last.subarray(0, lastLength);
         }
-        node.usedBytes = newSize;
       }
+      node.usedBytes = newSize;
     },
 
     node_ops: {
@@ -2820,17 +2948,12 @@ mergeInto(LibraryManager.library, {
     },
     stream_ops: {
       read: function(stream, buffer, offset, length, position) {
-        var contents = stream.node.contents;
         if (position >= stream.node.usedBytes) return 0;
         var size = Math.min(stream.node.usedBytes - position, length);
 #if ASSERTIONS
         assert(size >= 0);
 #endif
-        if (size > 8 && contents.subarray) { // non-trivial, and typed array
-          buffer.set(contents.subarray(position, position + size), offset);
-        } else {
-          for (var i = 0; i < size; i++) buffer[offset + i] = contents[position + i];
-        }
+        MEMFS_ASYNC.readFileData(stream.node, buffer, offset, size, position);
         return size;
       },
 
@@ -2840,7 +2963,7 @@ mergeInto(LibraryManager.library, {
       //         canOwn=true will not take ownership of the portion outside the bytes addressed by the view. This means that
       //         with canOwn=true, creating a copy of the bytes is avoided, but the caller shouldn't touch the passed in range
       //         of bytes anymore since their contents now represent file data inside the filesystem.
-      write: function(stream, buffer, offset, length, position, canOwn) {
+      write: function(stream, buffer, offset, length, position, canOwn, append) {
 #if ASSERTIONS
         // The data buffer should be a typed array view
         assert(!(buffer instanceof ArrayBuffer));
@@ -2855,37 +2978,32 @@ mergeInto(LibraryManager.library, {
         }
 #endif // ALLOW_MEMORY_GROWTH
 
+        if (append) {
+          position = stream.position = stream.node.usedBytes;
+        }
         if (!length) return 0;
         var node = stream.node;
         node.timestamp = Date.now();
 
-        if (buffer.subarray && (!node.contents || node.contents.subarray)) { // This write is from a typed array to a typed array?
-          if (canOwn) {
+        if (!buffer.subarray) { // The source data did not come as a typed array.
+          buffer = new Uint8Array(buffer);
+        }
+        if (canOwn) {
 #if ASSERTIONS
-            assert(position === 0, 'canOwn must imply no weird position inside the file');
+          assert(position === 0, 'canOwn must imply no weird position inside the file');
 #endif
-            node.contents = buffer.subarray(offset, offset + length);
-            node.usedBytes = length;
-            return length;
-          } else if (node.usedBytes === 0 && position === 0) { // If this is a simple first write to an empty file, do a fast set since we don't need to care about old data.
-            node.contents = buffer.slice(offset, offset + length);
-            node.usedBytes = length;
-            return length;
-          } else if (position + length <= node.usedBytes) { // Writing to an already allocated and used subrange of the file?
-            node.contents.set(buffer.subarray(offset, offset + length), position);
-            return length;
-          }
+          MEMFS_ASYNC.setFileData(node, buffer.subarray(offset, offset + length));
+          return length;
         }
 
-        // Appending to an existing file and we need to reallocate, or source data did not come as a typed array.
-        MEMFS_ASYNC.expandFileStorage(node, position+length);
-        if (node.contents.subarray && buffer.subarray) {
-          // Use typed array write which is available.
-          node.contents.set(buffer.subarray(offset, offset + length), position);
-        } else {
-          for (var i = 0; i < length; i++) {
-           node.contents[position + i] = buffer[offset + i]; // Or fall back to manual write if not.
-          }
+        var done = 0;
+        while (done < length) {
+          var index = Math.floor((position + done) / MEMFS_ASYNC.CHUNK_SIZE);
+          var start = position + done - index * MEMFS_ASYNC.CHUNK_SIZE;
+          var count = Math.min(MEMFS_ASYNC.CHUNK_SIZE - start, length - done);
+          var chunk = MEMFS_ASYNC.getChunk(node, index, start + count);
+          chunk.set(buffer.subarray(offset + done, offset + done + count), start);
+          done += count;
         }
         node.usedBytes = Math.max(node.usedBytes, position + length);
         return length;
@@ -2906,7 +3024,7 @@ mergeInto(LibraryManager.library, {
         return position;
       },
       allocate: function(stream, offset, length) {
-        MEMFS_ASYNC.expandFileStorage(stream.node, offset + length);
+        // Holes read as zeros, so only the size needs to change.
         stream.node.usedBytes = Math.max(stream.node.usedBytes, offset + length);
       },
       mmap: function(stream, address, length, position, prot, flags) {
@@ -2919,22 +3037,16 @@ mergeInto(LibraryManager.library, {
         }
         var ptr;
         var allocated;
-        var contents = stream.node.contents;
+        var index = Math.floor(position / MEMFS_ASYNC.CHUNK_SIZE);
+        var start = position - index * MEMFS_ASYNC.CHUNK_SIZE;
+        var chunk = stream.node.contents[index];
         // Only make a new copy when MAP_PRIVATE is specified.
-        if (!(flags & {{{ cDefine('MAP_PRIVATE') }}}) && contents.buffer === buffer) {
+        if (!(flags & {{{ cDefine('MAP_PRIVATE') }}}) && chunk && chunk.buffer === buffer && start + length <= chunk.length) {
           // We can't emulate MAP_SHARED when the file is not backed by the buffer
           // we're mapping to (e.g. the HEAP buffer).
           allocated = false;
-          ptr = contents.byteOffset;
+          ptr = chunk.byteOffset + start;
         } else {
-          // Try to avoid unnecessary slices.
-          if (position > 0 || position + length < contents.length) {
-            if (contents.subarray) {
-              contents = contents.subarray(position, position + length);
-            } else {
-              contents = Array.prototype.slice.call(contents, position, position + length);
-            }
-          }
           allocated = true;
           ptr = mmapAlloc(length);
           if (!ptr) {
@@ -2943,7 +3055,7 @@ mergeInto(LibraryManager.library, {
 #if CAN_ADDRESS_2GB
           ptr >>>= 0;
 #endif
-          HEAP8.set(contents, ptr);
+          MEMFS_ASYNC.stream_ops.read(stream, HEAP8, ptr, length, position);
         }
         return { ptr: ptr, allocated: allocated };
       },
@@ -2985,6 +3097,450 @@ mergeInto(LibraryManager.library, {
       return await node.localReference.createSyncAccessHandle({mode: "in-place"});
     },
 
+    // Runs work() once the work queued for a node before it is done, and
+    // returns its result. Calls on different file descriptors run at the same
+    // time, so this keeps the steps of e.g. opening and closing the same file
+    // from interleaving.
+    enqueue: function(node, work) {
+      let previous = node.queued;
+      let result = (async () => {
+        try {
+          await previous;
+        } catch (e) {
+          // The caller of the previous work handles its failure.
+        }
+        return await work();
+      })();
+      node.queued = result;
+      return result;
+    },
+
+    /* Page cache */
+
+    // Files opened through access handles can be cached in pages of PAGE_SIZE
+    // bytes. The cache holds at most PAGE_CACHE_PAGES pages of all files, and
+    // evicts the least recently used ones. Writes are kept in the cache until
+    // the file is synced or closed, or the page is evicted. The cache is off
+    // by default, link with e.g. -jsDPTHREADFS_PAGE_CACHE_PAGES=1024 to
+    // enable it.
+    PAGE_SIZE: 4096,
+    PAGE_CACHE_PAGES: {{{ typeof PTHREADFS_PAGE_CACHE_PAGES !== 'undefined' ? PTHREADFS_PAGE_CACHE_PAGES : 0 }}},
+    // The cached pages, least recently used first.
+    pageLRU: new Map(),
+    pageCacheStats: {hits: 0, misses: 0, evictions: 0, writeBacks: 0},
+
+    // Starts caching an open file. node.size includes the writes that are
+    // still in the cache.
+    cacheFile: function(node) {
+      node.pages = new Map();
+    },
+
+    // Writes back and drops the cached pages of a file that is being closed.
+    uncacheFile: async function(node) {
+      await FSAFS.writeBackPages(node);
+      for (let page of node.pages.values()) {
+        FSAFS.pageLRU.delete(page);
+      }
+      node.pages = null;
+    },
+
+    // Returns the page with the given index, loading it from the file on a
+    // miss. A page that is about to be overwritten entirely is not loaded,
+    // but created from `contents`. The page is pinned, which keeps it from
+    // being evicted, until the caller unpins it.
+    getPage: async function(node, index, contents) {
+      let page = node.pages.get(index);
+      if (page) {
+        FSAFS.pageCacheStats.hits++;
+      } else {
+        FSAFS.pageCacheStats.misses++;
+        // Evict the least recently used pages until there is room. Dirty pages
+        // are written back first, and stay cached while that happens. Those of
+        // other files are written back in the queue of their file, which this
+        // does not wait for. When all pages are pinned, the cache grows beyond
+        // its size by at most one page per call in flight.
+        while (!page && FSAFS.pageLRU.size >= FSAFS.PAGE_CACHE_PAGES) {
+          let victim = null;
+          for (let candidate of FSAFS.pageLRU.keys()) {
+            if (!candidate.pins) {
+              victim = candidate;
+              break;
+            }
+          }
+          if (!victim) {
+            break;
+          }
+          if (victim.dirty && victim.node !== node) {
+            FSAFS.writeBackPageInBackground(victim);
+          } else if (victim.dirty) {
+            await FSAFS.writeBackPage(victim);
+          } else {
+            FSAFS.dropPage(victim);
+            FSAFS.pageCacheStats.evictions++;
+          }
+          // Another call may have added the page in the meantime.
+          page = node.pages.get(index);
+        }
+      }
+      if (page) {
+        FSAFS.pageLRU.delete(page);
+        FSAFS.pageLRU.set(page, true);
+        page.pins++;
+        await page.loaded;
+        return page;
+      }
+      page = {node: node, index: index, data: new Uint8Array(FSAFS.PAGE_SIZE), dirty: false, loaded: null, pins: 1};
+      node.pages.set(index, page);
+      FSAFS.pageLRU.set(page, true);
+      let position = index * FSAFS.PAGE_SIZE;
+      if (contents) {
+        page.data.set(contents);
+      } else if (position < node.size) {
+        try {
+          page.loaded = node.handle.read(page.data, {at: position});
+          await page.loaded;
+        } catch (e) {
+          // A page that could not be loaded is not cached. Calls that wait
+          // for it get the same error.
+          FSAFS.dropPage(page);
+          throw e;
+        }
+      }
+      return page;
+    },
+
+    dropPage: function(page) {
+      FSAFS.pageLRU.delete(page);
+      page.node.pages.delete(page.index);
+    },
+
+    writeBackPage: async function(page) {
+      let node = page.node;
+      let position = page.index * FSAFS.PAGE_SIZE;
+      // Writes to the page while this is in flight make it dirty again. The
+      // page is pinned, so that it is not reloaded before the write is done.
+      page.dirty = false;
+      page.pins++;
+      FSAFS.pageCacheStats.writeBacks++;
+      let length = Math.max(0, Math.min(FSAFS.PAGE_SIZE, node.size - position));
+      try {
+        await node.handle.write(page.data.subarray(0, length), {at: position});
+      } finally {
+        page.pins--;
+      }
+    },
+
+    // Writes back a dirty page of a file from the queue of that file. The page
+    // stays pinned until then. If the write fails, the page stays dirty, so
+    // that the next sync of the file reports the failure.
+    writeBackPageInBackground: function(page) {
+      page.pins++;
+      FSAFS.enqueue(page.node, async () => {
+        // The file may have been synced or closed in the meantime.
+        if (page.dirty && page.node.pages) {
+          await FSAFS.writeBackPage(page);
+        }
+      }).catch((e) => {
+        page.dirty = true;
+      }).finally(() => {
+        page.pins--;
+      });
+    },
+
+    writeBackPages: async function(node) {
+      let dirty = [];
+      for (let page of node.pages.values()) {
+        if (page.dirty) {
+          dirty.push(page);
+        }
+      }
+      dirty.sort((a, b) => a.index - b.index);
+      for (let page of dirty) {
+        await FSAFS.writeBackPage(page);
+      }
+    },
+
+    readPages: async function(node, data, position) {
+      let end = Math.min(position + data.length, node.size);
+      let current = position;
+      while (current < end) {
+        let index = Math.floor(current / FSAFS.PAGE_SIZE);
+        let start = current - index * FSAFS.PAGE_SIZE;
+        let count = Math.min(FSAFS.PAGE_SIZE - start, end - current);
+        let page = await FSAFS.getPage(node, index);
+        data.set(page.data.subarray(start, start + count), current - position);
+        page.pins--;
+        current += count;
+      }
+      return Math.max(0, end - position);
+    },
+
+    writePages: async function(node, data, position) {
+      let written = 0;
+      while (written < data.length) {
+        let current = position + written;
+        let index = Math.floor(current / FSAFS.PAGE_SIZE);
+        let start = current - index * FSAFS.PAGE_SIZE;
+        let count = Math.min(FSAFS.PAGE_SIZE - start, data.length - written);
+        let contents = data.subarray(written, written + count);
+        let page = await FSAFS.getPage(node, index, count == FSAFS.PAGE_SIZE ? contents : null);
+        page.data.set(contents, start);
+        page.dirty = true;
+        page.pins--;
+        node.size = Math.max(node.size, current + count);
+        written += count;
+      }
+      return written;
+    },
+
+    // Drops the pages past the new end of a file. A page that is pinned by a
+    // call in flight is zeroed and kept instead, and is not written back past
+    // the end of the file.
+    truncatePages: function(node, size) {
+      for (let page of node.pages.values()) {
+        let position = page.index * FSAFS.PAGE_SIZE;
+        if (position >= size && !page.pins) {
+          FSAFS.dropPage(page);
+        } else if (position >= size) {
+          page.data.fill(0);
+          page.dirty = false;
+        } else if (position + FSAFS.PAGE_SIZE > size) {
+          page.data.fill(0, size - position);
+        }
+      }
+      node.size = size;
+    },
+
+    /* Main thread access */
+
+    // Access handles are not available on the main thread. There, the contents
+    // of an open file are read from its blob once and kept in node.fileData,
+    // and writes go to a writable that stays open until the file is synced or
+    // closed. Writes are applied to node.fileData as well, so that it does not
+    // need to be read again.
+    loadFileData: async function(node) {
+      if (!node.fileData) {
+        // The blob does not include the writes that are still pending.
+        await FSAFS.commitWritable(node);
+        let file_blob = await node.localReference.getFile();
+        node.fileData = new Uint8Array(await file_blob.arrayBuffer());
+      }
+      return node.fileData;
+    },
+
+    // Resizes node.fileData, keeping room for it to grow without copying.
+    resizeFileData: function(node, size) {
+      let fileData = node.fileData;
+      if (size <= fileData.length) {
+        fileData.fill(0, size);
+      } else if (size > fileData.buffer.byteLength) {
+        let grown = new Uint8Array(Math.max(size, fileData.buffer.byteLength * 2));
+        grown.set(fileData);
+        fileData = grown;
+      }
+      node.fileData = new Uint8Array(fileData.buffer, 0, size);
+    },
+
+    getWritable: async function(node) {
+      if (!node.writable) {
+        node.writable = node.localReference.createWritable({keepExistingData: true});
+      }
+      return await node.writable;
+    },
+
+    // Closes the writable of a file, which commits the writes made through it.
+    commitWritable: async function(node) {
+      if (node.writable) {
+        let writable = node.writable;
+        node.writable = null;
+        await (await writable).close();
+      }
+    },
+
+    /* Handle pool */
+
+    // Creating an access handle is expensive. When a file is closed, its
+    // handle can be kept open in a pool of at most HANDLE_POOL_SIZE handles, so
+    // that opening the file again reuses it. A pooled handle is closed after
+    // HANDLE_POOL_MS milliseconds, or earlier if the pool is full or the file
+    // is renamed or removed, so that other tabs and threads can open the file.
+    // The pool is off by default, link with e.g.
+    // -jsDPTHREADFS_HANDLE_POOL_SIZE=16 to enable it.
+    HANDLE_POOL_SIZE: {{{ typeof PTHREADFS_HANDLE_POOL_SIZE !== 'undefined' ? PTHREADFS_HANDLE_POOL_SIZE : 0 }}},
+    HANDLE_POOL_MS: {{{ typeof PTHREADFS_HANDLE_POOL_MS !== 'undefined' ? PTHREADFS_HANDLE_POOL_MS : 1000 }}},
+    // Maps the nodes with a pooled handle to the timeouts closing them, least
+    // recently closed first.
+    handlePool: new Map(),
+
+    poolHandle: function(node) {
+      if (FSAFS.handlePool.size >= FSAFS.HANDLE_POOL_SIZE) {
+        FSAFS.releaseHandleInBackground(FSAFS.handlePool.keys().next().value);
+      }
+      FSAFS.handlePool.set(node, setTimeout(() => FSAFS.releaseHandleInBackground(node), FSAFS.HANDLE_POOL_MS));
+    },
+
+    // Takes the handle of a node that is opened again out of the pool.
+    unpoolHandle: function(node) {
+      clearTimeout(FSAFS.handlePool.get(node));
+      FSAFS.handlePool.delete(node);
+    },
+
+    // Closes the pooled handle of a node, if it has one. The handle leaves the
+    // pool right away, and is closed once the work queued for the node is
+    // done, unless the file has been opened or the handle pooled again by then.
+    releaseHandle: async function(node) {
+      if (!FSAFS.handlePool.has(node)) {
+        return;
+      }
+      FSAFS.unpoolHandle(node);
+      await FSAFS.enqueue(node, async () => {
+        if (!node.handle || node.refcount > 0 || FSAFS.handlePool.has(node)) {
+          return;
+        }
+        let handle = node.handle;
+        node.handle = null;
+        // Opening the file again has to wait until the handle is closed.
+        node.handleClosed = (async () => {
+          try {
+            await handle.close();
+          } catch (e) {
+            console.log(`FSAFS error: Closing a pooled handle failed with ${e.name}`);
+          }
+        })();
+        await node.handleClosed;
+      });
+    },
+
+    // Releases a pooled handle without waiting for it, e.g. when it expires.
+    releaseHandleInBackground: function(node) {
+      FSAFS.releaseHandle(node).catch((e) => {
+        console.log(`FSAFS error: Releasing a pooled handle failed with ${e.name}`);
+      });
+    },
+
+    /* Syncing */
+
+    // fsync() calls for a file that arrive while it is being flushed are
+    // coalesced into a single flush, which starts when the current one is
+    // done. Link with -jsDPTHREADFS_GROUP_COMMIT_MS=<ms> to wait that long
+    // before each flush, so that more calls can join it. With
+    // -jsDPTHREADFS_WRITE_BEHIND=1, fsync() returns without waiting for the
+    // flush, and only pthreadfs_barrier() guarantees that the data written so
+    // far is persisted. Flushes are queued with the reads and writes of the
+    // file, so they never use its handle at the same time.
+    GROUP_COMMIT_MS: {{{ typeof PTHREADFS_GROUP_COMMIT_MS !== 'undefined' ? PTHREADFS_GROUP_COMMIT_MS : 0 }}},
+    WRITE_BEHIND: {{{ typeof PTHREADFS_WRITE_BEHIND !== 'undefined' ? PTHREADFS_WRITE_BEHIND : 0 }}},
+    // The files that are open.
+    openNodes: new Set(),
+    // Whether a flush in the background failed since the last barrier.
+    syncFailed: false,
+
+    flushFile: async function(node) {
+      if (ENVIRONMENT_IS_WEB) {
+        // On the main thread, writes are committed by closing the writable.
+        await FSAFS.commitWritable(node);
+      }
+      else {
+        // On worker threads, explicit flush is required.
+        if (node.pages) {
+          await FSAFS.writeBackPages(node);
+        }
+        await node.handle.flush();
+      }
+    },
+
+    // Returns a promise for a flush of the file that starts after this call.
+    syncFile: function(node) {
+      if (!node.nextSync) {
+        node.nextSync = (async () => {
+          try {
+            await node.currentSync;
+          } catch (e) {
+            // The callers of the previous flush handle its failure.
+          }
+          if (FSAFS.GROUP_COMMIT_MS) {
+            await new Promise((resolve) => setTimeout(resolve, FSAFS.GROUP_COMMIT_MS));
+          }
+          node.currentSync = node.nextSync;
+          node.nextSync = null;
+          // Reads and writes of the file wait for the flush, so that they do
+          // not use the handle at the same time.
+          await FSAFS.enqueue(node, () => FSAFS.flushFile(node));
+        })();
+      }
+      return node.nextSync;
+    },
+
+    // Waits until the flushes of the file that were started are done.
+    waitForSync: async function(node) {
+      try {
+        await (node.nextSync || node.currentSync);
+      } catch (e) {
+        FSAFS.syncFailed = true;
+      }
+    },
+
+    // Flushes all open files. Returns 0, or EIO if a flush failed, including
+    // flushes that ran in the background since the last barrier.
+    barrier: async function() {
+      try {
+        await Promise.all(Array.from(FSAFS.openNodes, (node) => FSAFS.syncFile(node)));
+      } catch (e) {
+        console.log(`FSAFS error: Flushing a file failed with ${e.name}`);
+        FSAFS.syncFailed = true;
+      }
+      let failed = FSAFS.syncFailed;
+      FSAFS.syncFailed = false;
+      return failed ? {{{ cDefine('EIO') }}} : 0;
+    },
+
+    /* Directory entries */
+
+    // Directories remember up to MISSING_NAMES names that were not found in
+    // node.missing, so that repeated lookups of them fail without asking the
+    // file system. Once a directory was read completely, node.listed is set
+    // and node.contents holds all of its entries, so that any name not in it
+    // is known to be missing. Changes made through PThreadFS keep both up to
+    // date, changes made to the origin private file system by other tabs or
+    // threads are not noticed.
+    MISSING_NAMES: 1024,
+
+    addEntry: function(parent, name, node) {
+      parent.contents[name] = node;
+      if (parent.missing) {
+        parent.missing.delete(name);
+      }
+    },
+
+    removeEntry: function(parent, name) {
+      delete parent.contents[name];
+      if (parent.listed) {
+        return;
+      }
+      if (!parent.missing) {
+        parent.missing = new Set();
+      } else if (parent.missing.size >= FSAFS.MISSING_NAMES) {
+        parent.missing.clear();
+      }
+      parent.missing.add(name);
+    },
+
+    // Creates the node for an existing file or directory.
+    createChildNode: function(parent, name, localReference) {
+      let mode = localReference.kind === 'directory' ?
+          {{{ cDefine('S_IFDIR') }}} | 511 /* 0777 */ :
+          {{{ cDefine('S_IFREG') }}} | 511 /* 0777 */;
+      var node = PThreadFS.createNode(parent, name, mode);
+      node.node_ops = FSAFS.node_ops;
+      node.stream_ops = FSAFS.stream_ops;
+      node.localReference = localReference;
+      if (localReference.kind === 'directory') {
+        node.contents = {};
+      }
+      parent.contents[name] = node;
+      return node;
+    },
+
     /* Filesystem implementation (public interface) */
 
     createNode: function (parent, name, mode, dev) {
@@ -3029,8 +3585,8 @@ mergeInto(LibraryManager.library, {
         if (PThreadFS.isDir(node.mode)) {
           attr.size = 4096;
         } else if (PThreadFS.isFile(node.mode)) {
-          if (node.handle && !ENVIRONMENT_IS_WEB){
-            attr.size = await node.handle.getSize();
+          if (node.handle) {
+            attr.size = node.size;
           }
           else {
             // Unless we already have an active handle, get the file's length
@@ -3062,18 +3618,48 @@ mergeInto(LibraryManager.library, {
           node.timestamp = attr.timestamp;
         }
         if (attr.size !== undefined) {
+          let truncated = await FSAFS.enqueue(node, async () => {
+            if (!node.handle) {
+              return false;
+            }
+            if (ENVIRONMENT_IS_WEB) {
+              let writable = await FSAFS.getWritable(node);
+              await writable.truncate(attr.size);
+              if (node.fileData) {
+                FSAFS.resizeFileData(node, attr.size);
+              }
+            }
+            else {
+              if (node.pages) {
+                FSAFS.truncatePages(node, attr.size);
+              }
+              // Keep a pooled handle from being released while it is in use.
+              let pooled = FSAFS.handlePool.has(node);
+              if (pooled) {
+                FSAFS.unpoolHandle(node);
+              }
+              try {
+                await node.handle.truncate(attr.size);
+              } finally {
+                if (pooled) {
+                  FSAFS.poolHandle(node);
+                }
+              }
+            }
+            node.size = attr.size;
+            return true;
+          });
+          if (truncated) {
+            return;
+          }
           if (ENVIRONMENT_IS_WEB) {
-            // Since Access Handles are unavailable in workers, we must use 
-            // writables instead.
+            // Since Access Handles are unavailable on the main thread, we must
+            // use writables instead.
             let wt = await node.localReference.createWritable({ keepExistingData: true});
             await wt.truncate(attr.size);
             await wt.close();
             return;
           }
-          if (node.handle) {
-            await node.handle.truncate(attr.size);
-            return;
-          }
           // On a worker without an open access handle, try three times to open an access handle.
           function timeout(ms) { return new Promise(resolve => setTimeout(resolve, ms)) };
           const number_of_tries = 3;
@@ -3111,31 +3697,28 @@ mergeInto(LibraryManager.library, {
       },
 
       lookup: async function (parent, name) {
+        if (parent.listed || (parent.missing && parent.missing.has(name))) {
+          throw PThreadFS.genericErrors[{{{ cDefine('ENOENT') }}}];
+        }
         let childLocalReference = null;
-        let mode = null;
         try {
           childLocalReference = await parent.localReference.getDirectoryHandle(name, {create: false});
-          mode = {{{ cDefine('S_IFDIR') }}} | 511 /* 0777 */
         } catch (e) {
           try {
             childLocalReference = await parent.localReference.getFileHandle(name, {create: false});
-            mode = {{{ cDefine('S_IFREG') }}} | 511 /* 0777 */
           } catch (e) {
+            FSAFS.removeEntry(parent, name);
             throw PThreadFS.genericErrors[{{{ cDefine('ENOENT') }}}];
           }
         }
-        var node = PThreadFS.createNode(parent, name, mode);
-        node.node_ops = FSAFS.node_ops;
-        node.stream_ops = FSAFS.stream_ops;
-        node.localReference = childLocalReference;
-        if (childLocalReference.kind === 'directory') {
-          node.contents = {};
-        }
-        return node;
+        return FSAFS.createChildNode(parent, name, childLocalReference);
       },
 
       mknod: async function (parent, name, mode, dev) {
         let node = FSAFS.createNode(parent, name, mode, dev);
+        if (parent.missing) {
+          parent.missing.delete(name);
+        }
         try {
           if (PThreadFS.isDir(mode)) {
             node.localReference = await parent.localReference.getDirectoryHandle(name, {create: true});
@@ -3157,6 +3740,11 @@ mergeInto(LibraryManager.library, {
           console.log('Rename error: File System Access does not support renaming directories');
           throw new PThreadFS.ErrnoError({{{ cDefine('EXDEV') }}});
         }
+        // Files with an open handle cannot be moved.
+        await FSAFS.releaseHandle(oldNode);
+        if (newName in newParentNode.contents) {
+          await FSAFS.releaseHandle(newParentNode.contents[newName]);
+        }
         try {
           await oldNode.localReference.move(newParentNode.localReference, newName);
         }
@@ -3177,20 +3765,22 @@ mergeInto(LibraryManager.library, {
           throw new PThreadFS.ErrnoError({{{ cDefine('EXDEV') }}});
         }
         // Update the internal directory cache.
-        delete oldNode.parent.contents[oldNode.name];
+        FSAFS.removeEntry(oldNode.parent, oldNode.name);
         oldNode.parent.timestamp = Date.now()
         oldNode.name = newName;
-        newParentNode.contents[newName] = oldNode;
+        FSAFS.addEntry(newParentNode, newName, oldNode);
         newParentNode.timestamp = oldNode.parent.timestamp;
         oldNode.parent = newParentNode;
       },
 
       unlink: async function(parent, name) {
+        // Files with an open handle cannot be removed.
+        if (name in parent.contents) {
+          await FSAFS.releaseHandle(parent.contents[name]);
+        }
         let res = await parent.localReference.removeEntry(name);
 
-        if ('contents' in parent) {
-          delete parent.contents[name];
-        }
+        FSAFS.removeEntry(parent, name);
         parent.timestamp = Date.now();
         return res;
       },
@@ -3208,26 +3798,31 @@ mergeInto(LibraryManager.library, {
           }
           throw new PThreadFS.ErrnoError({{{ cDefine('EINVAL') }}});
         }
-        if ('contents' in parent) {
-          delete parent.contents[name];
-        }
+        FSAFS.removeEntry(parent, name);
         parent.timestamp = Date.now();
         return res
       },
 
       readdir: async function(node) {
-        let entries = ['.', '..'];
-        // Do not use `for await` yet, since it's not supported by Emscripten's minifier.
-        // for await (let [name, handle] of node.localReference) {
-        //   entries.push(name);
-        // }
-        let it = node.localReference.values();
-        let curr = await it.next();
-        while (!curr.done) {
-          entries.push(curr.value.name);
-          curr = await it.next();
+        if (!node.listed) {
+          // Create the nodes of all entries, so that looking them up does not
+          // need to ask the file system again.
+          // Do not use `for await` yet, since it's not supported by Emscripten's minifier.
+          // for await (let [name, handle] of node.localReference) {
+          //   entries.push(name);
+          // }
+          let it = node.localReference.values();
+          let curr = await it.next();
+          while (!curr.done) {
+            if (!(curr.value.name in node.contents)) {
+              FSAFS.createChildNode(node, curr.value.name, curr.value);
+            }
+            curr = await it.next();
+          }
+          node.listed = true;
+          node.missing = null;
         }
-        return entries;
+        return ['.', '..'].concat(Object.keys(node.contents));
       },
 
       // No readlink support: Since PThreadFS does not support links, there is
@@ -3252,19 +3847,36 @@ mergeInto(LibraryManager.library, {
           throw new PThreadFS.ErrnoError({{{ cDefine('ENOSYS') }}});
         }
 
-        if (stream.node.handle) {
-          stream.handle = stream.node.handle;
-          ++stream.node.refcount;
-        } else {
-          if (ENVIRONMENT_IS_WEB) {
-            stream.handle = stream.node.localReference;
+        await FSAFS.enqueue(stream.node, async () => {
+          if (stream.node.handle) {
+            // The handle is either open, pooled, or about to be closed.
+            stream.handle = stream.node.handle;
+            ++stream.node.refcount;
+            FSAFS.unpoolHandle(stream.node);
+          } else {
+            // While the file is open, its size is tracked in node.size instead
+            // of being queried on every fstat() or lseek().
+            if (ENVIRONMENT_IS_WEB) {
+              stream.handle = stream.node.localReference;
+              stream.node.size = (await stream.handle.getFile()).size;
+            }
+            else {
+              await stream.node.handleClosed;
+              stream.handle = await FSAFS.createSyncAccessHandle(stream.node);
+              stream.node.size = await stream.handle.getSize();
+            }
+            stream.node.handle = stream.handle;
+            stream.node.refcount = 1;
           }
-          else {
-            stream.handle = await FSAFS.createSyncAccessHandle(stream.node);
+          if (stream.node.refcount == 1) {
+            FSAFS.openNodes.add(stream.node);
+            // A file that is opened again while it is being closed keeps its
+            // cached pages.
+            if (FSAFS.PAGE_CACHE_PAGES && !ENVIRONMENT_IS_WEB && !stream.node.pages) {
+              FSAFS.cacheFile(stream.node);
+            }
           }
-          stream.node.handle = stream.handle;
-          stream.node.refcount = 1;
-        }
+        });
       },
 
       close: async function (stream) {
@@ -3278,62 +3890,116 @@ mergeInto(LibraryManager.library, {
         }
 
         stream.handle = null;
-        --stream.node.refcount;
-        if (stream.node.refcount <= 0) {
-          // On the main thread, no access handle is open.
-          if (!ENVIRONMENT_IS_WEB) {
-            await stream.node.handle.close();
+        let node = stream.node;
+        let last = await FSAFS.enqueue(node, () => {
+          --node.refcount;
+          if (node.refcount > 0) {
+            return false;
           }
-          stream.node.handle = null;
+          // No fsync() or barrier starts flushing the file anymore.
+          FSAFS.openNodes.delete(node);
+          return true;
+        });
+        if (!last) {
+          return;
         }
+        await FSAFS.waitForSync(node);
+        await FSAFS.enqueue(node, async () => {
+          if (node.refcount > 0) {
+            // The file was opened again in the meantime.
+            return;
+          }
+          if (node.pages) {
+            await FSAFS.uncacheFile(node);
+          }
+          // On the main thread, no access handle is open.
+          if (ENVIRONMENT_IS_WEB) {
+            await FSAFS.commitWritable(node);
+            node.fileData = null;
+          }
+          else if (FSAFS.HANDLE_POOL_SIZE) {
+            // Closing the handle would persist the file, flushing it does
+            // the same for a pooled handle.
+            await node.handle.flush();
+            FSAFS.poolHandle(node);
+            return;
+          }
+          else {
+            await node.handle.close();
+          }
+          node.handle = null;
+        });
       },
 
       fsync: async function(stream) {
         if (stream.handle == null) {
           throw new PThreadFS.ErrnoError({{{ cDefine('EBADF') }}});
         }
-        if (!ENVIRONMENT_IS_WEB) {
-          // On worker threads, explicit flush is required. On the main thread,
-          // writables are used that flush implicitly.
-          await stream.handle.flush();
+        let sync = FSAFS.syncFile(stream.node);
+        if (FSAFS.WRITE_BEHIND) {
+          // A failure is reported by the next pthreadfs_barrier().
+          sync.catch((e) => {
+            FSAFS.syncFailed = true;
+          });
+          return 0;
         }
+        await sync;
         return 0;
       },
 
       read: async function (stream, buffer, offset, length, position) {
-        let data = buffer.subarray(offset, offset+length);
-        let readBytes;
-        if (ENVIRONMENT_IS_WEB) {
-          // On the main thread, we use file blobs instead of Access Handles.
-          let file_blob = await stream.handle.getFile();
-          let file_arraybuffer = await file_blob.arrayBuffer();
-          var file_uint8view = new Uint8Array(file_arraybuffer);
-          let read_maximum = Math.min(position + data.length, file_blob.size);
-          data.set(file_uint8view.slice(position, read_maximum));
-          readBytes = read_maximum - position;
-        }
-        else {
-          readBytes = await stream.handle.read(data, {at: position});
-        }
-        return readBytes;
+        return await FSAFS.enqueue(stream.node, async () => {
+          let data = buffer.subarray(offset, offset+length);
+          let readBytes;
+          if (ENVIRONMENT_IS_WEB) {
+            // On the main thread, we use file blobs instead of Access Handles.
+            let fileData = await FSAFS.loadFileData(stream.node);
+            let read_maximum = Math.min(position + data.length, fileData.length);
+            readBytes = Math.max(0, read_maximum - position);
+            data.set(fileData.subarray(position, position + readBytes));
+          }
+          else if (stream.node.pages) {
+            readBytes = await FSAFS.readPages(stream.node, data, position);
+          }
+          else {
+            readBytes = await stream.handle.read(data, {at: position});
+          }
+          return readBytes;
+        });
       },
 
-      write: async function (stream, buffer, offset, length, position) {
-        stream.node.timestamp = Date.now();
-        let data = buffer.subarray(offset, offset+length);
-        let writtenBytes;
-        if (ENVIRONMENT_IS_WEB) {
-          // On the main thread, we use writables instead of Access Handles.
-          // This may be really slow, since it always copies the entire file.
-          let writable = await stream.handle.createWritable({ keepExistingData: true});
-          await writable.write({type: "write", position: position, data: data});
-          await writable.close();
-          writtenBytes = data.length;
-        }
-        else {
-          writtenBytes = await stream.handle.write(data, {at: position});
-        }
-        return writtenBytes;
+      write: async function (stream, buffer, offset, length, position, canOwn, append) {
+        return await FSAFS.enqueue(stream.node, async () => {
+          if (append) {
+            // The end of the file is only known once the writes queued before
+            // are done.
+            position = stream.position = stream.node.size;
+          }
+          stream.node.timestamp = Date.now();
+          let data = buffer.subarray(offset, offset+length);
+          let writtenBytes;
+          if (ENVIRONMENT_IS_WEB) {
+            // On the main thread, we use writables instead of Access Handles.
+            let writable = await FSAFS.getWritable(stream.node);
+            await writable.write({type: "write", position: position, data: data});
+            let fileData = stream.node.fileData;
+            if (fileData) {
+              if (position + data.length > fileData.length) {
+                FSAFS.resizeFileData(stream.node, position + data.length);
+              }
+              stream.node.fileData.set(data, position);
+            }
+            writtenBytes = data.length;
+          }
+          else if (stream.node.pages) {
+            writtenBytes = await FSAFS.writePages(stream.node, data, position);
+          }
+          else {
+            writtenBytes = await stream.handle.write(data, {at: position});
+          }
+          stream.node.size = Math.max(stream.node.size, position + writtenBytes);
+          return writtenBytes;
+        });
       },
 
       llseek: async function (stream, offset, whence) {
@@ -3342,15 +4008,7 @@ mergeInto(LibraryManager.library, {
           position += stream.position;
         } else if (whence === {{{ cDefine('SEEK_END') }}}) {
           if (PThreadFS.isFile(stream.node.mode)) {
-            if (ENVIRONMENT_IS_WEB) {
-              // On the main thread, file blobs are used to determine a file's
-              // size.
-              let file_blob = await stream.handle.getFile();
-              position += file_blob.size;
-            }
-            else {
-              position += await stream.handle.getSize();
-            }
+            position += stream.node.size;
           }
         } 
 
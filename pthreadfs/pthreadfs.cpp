@@ -2,15 +2,21 @@
 
 #include <assert.h>
 #include <emscripten.h>
+#include <emscripten/threading.h>
 #include <pthread.h>
 #include <sys/stat.h>
 #include <wasi/api.h>
 
+#include <algorithm>
+#include <climits>
+#include <cmath>
 #include <functional>
 #include <iostream>
 #include <memory>
+#include <mutex>
 #include <regex>
 #include <set>
+#include <shared_mutex>
 #include <string>
 #include <thread>
 #include <utility>
@@ -21,13 +27,21 @@
 // https://github.com/emscripten-core/emscripten/pull/14666 for details.
 namespace emscripten {
 
-sync_to_async::sync_to_async() : childLock(mutex) {
-  // The child lock is associated with the mutex, which takes the lock as we
-  // connect them, and so we must free it here so that the child can use it.
-  // Only the child will lock/unlock it from now on.
-  childLock.unlock();
+// The call initializing the PThreadFS file system.
+static pthreadfs_call init_call;
 
-  // Create the thread after the lock is ready.
+sync_to_async::sync_to_async() {
+  for (uint32_t i = 0; i < RING_SIZE; i++) {
+    slot& s = slots[i];
+    s.seq.store(i);
+    s.done.store(0);
+    s.resume = [this, &s]() { finish(&s); };
+  }
+  initialized = [this]() {
+    pthreadfs_initialized = true;
+    schedule(this);
+  };
+  // Create the thread after the slots are ready.
   thread = std::make_unique<std::thread>(threadMain, this);
 }
 
@@ -41,74 +55,155 @@ sync_to_async::~sync_to_async() {
   thread->join();
 }
 
-void sync_to_async::invoke(std::function<void(sync_to_async::Callback)> newWork) {
-  // Use the invokeMutex to prevent more than one invoke being in flight at a
-  // time, so that this is usable from multiple threads safely.
-  std::lock_guard<std::mutex> invokeLock(invokeMutex);
-  // Initialize the PThreadFS file system.
-  if (!pthreadfs_initialized) {
-    {
-      std::lock_guard<std::mutex> lock(mutex);
-      work = [](sync_to_async::Callback done) {
-        g_resumeFct = [done]() { (*done)(); };
-        pthreadfs_init(PTHREADFS_FOLDER_NAME, &resumeWrapper_v);
-      };
-      finishedWork = false;
-      readyToWork = true;
-    }
-    condition.notify_one();
-
-    // Wait for it to be complete.
-    std::unique_lock<std::mutex> lock(mutex);
-    condition.wait(lock, [&]() { return finishedWork; });
-    pthreadfs_initialized = true;
-  }
-  // Send the work over.
-  {
-    std::lock_guard<std::mutex> lock(mutex);
-    work = newWork;
-    finishedWork = false;
-    readyToWork = true;
+void sync_to_async::submit(
+  long key, void (*work)(void* closure, Callback resume), void* closure) {
+  uint32_t ticket = tail.fetch_add(1);
+  slot& s = slots[ticket % RING_SIZE];
+  // Wait until the call of the previous round released the slot.
+  uint32_t seq;
+  while ((seq = s.seq.load()) != ticket) {
+    emscripten_futex_wait(&s.seq, seq, INFINITY);
   }
-  condition.notify_one();
+  s.key = key;
+  s.work = work;
+  s.closure = closure;
+  s.done.store(0);
+  // Hand the request to the thread, which may be waiting for it.
+  s.seq.store(ticket + 1);
+  emscripten_futex_wake(&s.seq, INT_MAX);
 
   // Wait for it to be complete.
-  std::unique_lock<std::mutex> lock(mutex);
-  condition.wait(lock, [&]() { return finishedWork; });
+  while (s.done.load() == 0) {
+    emscripten_futex_wait(&s.done, 0, INFINITY);
+  }
+
+  // Release the slot for the next round.
+  s.seq.store(ticket + RING_SIZE);
+  emscripten_futex_wake(&s.seq, INT_MAX);
 }
 
 void* sync_to_async::threadMain(void* arg) {
   // Prevent the pthread from shutting down too early.
   EM_ASM(runtimeKeepalivePush(););
-  emscripten_async_call(threadIter, arg, 0);
+  emscripten_async_call(schedule, arg, 0);
   return 0;
 }
 
-void sync_to_async::threadIter(void* arg) {
+void sync_to_async::schedule(void* arg) {
+  auto* parent = (sync_to_async*)arg;
+  // Pick up the requests that are ready, in the order of their tickets.
+  while (true) {
+    slot& s = parent->slots[parent->head % RING_SIZE];
+    if (s.seq.load() != parent->head + 1) {
+      break;
+    }
+    s.next = nullptr;
+    if (parent->pendingLast) {
+      parent->pendingLast->next = &s;
+    } else {
+      parent->pendingFirst = &s;
+    }
+    parent->pendingLast = &s;
+    parent->head++;
+  }
+
+  // Initialize the PThreadFS file system before anything else runs.
+  if (!parent->pthreadfs_initialized) {
+    if (parent->pendingFirst && !parent->pthreadfs_initializing) {
+      parent->pthreadfs_initializing = true;
+      init_call.resume = &parent->initialized;
+      pthreadfs_init(PTHREADFS_FOLDER_NAME, &init_call, &resumeWrapper_v);
+    }
+  } else {
+    // Take the requests that may run now off the pending list, and start them
+    // afterwards, since they may finish synchronously.
+    slot* ready[PTHREADFS_IO_CONCURRENCY];
+    int readyCount = 0;
+    slot* prev = nullptr;
+    slot* s = parent->pendingFirst;
+    while (s && !parent->exclusiveInFlight && parent->inFlight < PTHREADFS_IO_CONCURRENCY) {
+      slot* next = s->next;
+      bool start;
+      if (s->key == EXCLUSIVE_KEY) {
+        // Nothing may overtake exclusive work, so stop after it.
+        start = parent->inFlight == 0;
+        parent->exclusiveInFlight = start;
+        next = nullptr;
+      } else {
+        // Later requests with the same key wait as well, which keeps them in
+        // order.
+        start = std::find(parent->busyKeys, parent->busyKeys + parent->inFlight, s->key) ==
+                parent->busyKeys + parent->inFlight;
+        if (start) {
+          parent->busyKeys[parent->inFlight++] = s->key;
+        }
+      }
+      if (start) {
+        if (prev) {
+          prev->next = s->next;
+        } else {
+          parent->pendingFirst = s->next;
+        }
+        if (parent->pendingLast == s) {
+          parent->pendingLast = prev;
+        }
+        ready[readyCount++] = s;
+      } else {
+        prev = s;
+      }
+      s = next;
+    }
+    for (int i = 0; i < readyCount; i++) {
+      // Run the work function the user gave us. Give it a pointer to the
+      // resume function.
+      ready[i]->work(ready[i]->closure, &ready[i]->resume);
+    }
+  }
+
+  // Wait for the next request without blocking the thread, whose event loop
+  // runs the asynchronous work. The slot may still hold a call of the previous
+  // round, so wait for its current value to change, and check it again after
+  // waking up.
+  if (!parent->waiting) {
+    parent->waiting = true;
+    auto& seq = parent->slots[parent->head % RING_SIZE].seq;
+    // clang-format off
+    EM_ASM({
+      var result = Atomics.waitAsync(HEAP32, $0 >> 2, $1);
+      var wakeUp = () => wasmTable.get($2)($3);
+      if (result.async) {
+        result.value.then(wakeUp);
+      } else {
+        // The slot changed in the meantime.
+        Promise.resolve().then(wakeUp);
+      }
+    }, &seq, seq.load(), &wakeUp, parent);
+    // clang-format on
+  }
+}
+
+void sync_to_async::wakeUp(void* arg) {
   auto* parent = (sync_to_async*)arg;
-  if (parent->quit) {
+  parent->waiting = false;
+  schedule(parent);
+}
+
+void sync_to_async::finish(slot* s) {
+  if (s->key == EXCLUSIVE_KEY) {
+    exclusiveInFlight = false;
+  } else {
+    *std::find(busyKeys, busyKeys + inFlight, s->key) = busyKeys[inFlight - 1];
+    inFlight--;
+  }
+  // The caller releases the slot as soon as this is set.
+  s->done.store(1);
+  emscripten_futex_wake(&s->done, 1);
+  if (quit) {
     EM_ASM(runtimeKeepalivePop(););
     pthread_exit(0);
   }
-  // Wait until we get something to do.
-  parent->childLock.lock();
-  parent->condition.wait(parent->childLock, [&]() { return parent->readyToWork; });
-  auto work = parent->work;
-  parent->readyToWork = false;
-  // Allocate a resume function, and stash it on the parent.
-  parent->resume = std::make_unique<std::function<void()>>([parent, arg]() {
-    // We are called, so the work was finished. Notify the caller.
-    parent->finishedWork = true;
-    parent->childLock.unlock();
-    parent->condition.notify_one();
-    // Look for more work.
-    // For performance reasons, this is an asynchronous call. If a synchronous API
-    // were to be called, these chained calls would lead to an out-of-stack error.
-    threadIter(arg);
-  });
-  // Run the work function the user gave us. Give it a pointer to the resume
-  // function.
-  work(parent->resume.get());
+  // Look for more work.
+  schedule(this);
 }
 
 bool is_pthreadfs_file(std::string path) {
@@ -132,23 +227,43 @@ bool is_pthreadfs_fd_link(std::string path) {
 
 } // namespace emscripten
 
-// Static functions calling resumFct and setting the return value.
-void resumeWrapper_v() { g_resumeFct(); }
+// Static functions setting the result of the call and resuming it.
+void resumeWrapper_v(pthreadfs_call* call) { (*call->resume)(); }
 // return value long
-long resume_result_long = 0;
-void resumeWrapper_l(long retVal) {
-  resume_result_long = retVal;
-  g_resumeFct();
+void resumeWrapper_l(pthreadfs_call* call, long retVal) {
+  call->result = retVal;
+  (*call->resume)();
 }
 // return value __wasi_errno_t
-__wasi_errno_t resume_result_wasi = 0;
-void resumeWrapper_wasi(__wasi_errno_t retVal) {
-  resume_result_wasi = retVal;
-  g_resumeFct();
-}
+void resumeWrapper_wasi(pthreadfs_call* call, __wasi_errno_t retVal) {
+  call->result = retVal;
+  (*call->resume)();
+}
+
+// The file descriptors of the files opened through PThreadFS. Any thread may
+// open or close a file while others look up their file descriptors.
+class fd_set_with_lock {
+public:
+  size_t count(long fd) {
+    std::shared_lock<std::shared_mutex> lock(mutex);
+    return fds.count(fd);
+  }
+  void insert(long fd) {
+    std::unique_lock<std::shared_mutex> lock(mutex);
+    fds.insert(fd);
+  }
+  void erase(long fd) {
+    std::unique_lock<std::shared_mutex> lock(mutex);
+    fds.erase(fd);
+  }
+
+private:
+  std::set<long> fds;
+  std::shared_mutex mutex;
+};
 
 // File System Access collection
-std::set<long> fsa_file_descriptors;
+fd_set_with_lock fsa_file_descriptors;
 std::set<std::string> mounted_directories;
 
 // Wasi definitions
@@ -174,14 +289,18 @@ WASI_CAPI_DEF(
 WASI_CAPI_DEF(fdstat_get, __wasi_fdstat_t* stat) { WASI_SYNC_TO_ASYNC(fdstat_get, stat); }
 WASI_CAPI_NOARGS_DEF(close) {
   if (fsa_file_descriptors.count(fd) > 0) {
-    g_sync_to_async_helper.invoke([fd](emscripten::sync_to_async::Callback resume) {
-      g_resumeFct = [resume]() { (*resume)(); };
-      __fd_close_async(fd, &resumeWrapper_wasi);
+    // Once the file is closed, a file opened on another thread may get the
+    // same file descriptor, so it is removed from the set beforehand.
+    fsa_file_descriptors.erase(fd);
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(fd, [&call, fd](emscripten::sync_to_async::Callback resume) {
+      call.resume = resume;
+      __fd_close_async(fd, &call, &resumeWrapper_wasi);
     });
-    if (resume_result_wasi == __WASI_ERRNO_SUCCESS) {
-      fsa_file_descriptors.erase(fd);
+    if (call.result != __WASI_ERRNO_SUCCESS) {
+      fsa_file_descriptors.insert(fd);
     }
-    return resume_result_wasi;
+    return call.result;
   }
   return fd_close(fd);
 }
@@ -197,8 +316,10 @@ SYS_CAPI_DEF(open, 5, long path_ref, long flags, ...) {
     mode_t mode = va_arg(vl, mode_t);
     va_end(vl);
     SYS_SYNC_TO_ASYNC_NORETURN(open, path_ref, flags, mode);
-    fsa_file_descriptors.insert(resume_result_long);
-    return resume_result_long;
+    if (call.result >= 0) {
+      fsa_file_descriptors.insert(call.result);
+    }
+    return call.result;
   }
   va_list vl;
   va_start(vl, flags);
@@ -226,7 +347,7 @@ SYS_CAPI_DEF(rename, 38, long old_path_ref, long new_path_ref) {
   if (emscripten::is_pthreadfs_file(old_path)) {
     if (emscripten::is_pthreadfs_file(new_path)) {
       SYS_SYNC_TO_ASYNC_NORETURN(rename, old_path_ref, new_path_ref);
-      return resume_result_long;
+      return call.result;
     }
     return EXDEV;
   }
@@ -257,7 +378,7 @@ SYS_CAPI_DEF(readlink, 85, long path, long buf, long bufsize) {
   std::string pathname((char*)path);
   if (emscripten::is_pthreadfs_file(pathname) || emscripten::is_pthreadfs_fd_link(pathname)) {
     SYS_SYNC_TO_ASYNC_NORETURN(readlink, path, buf, bufsize);
-    return resume_result_long;
+    return call.result;
   }
   return SYNC_JS_SYSCALL(readlink)(path, buf, bufsize);
 }
@@ -280,23 +401,26 @@ SYS_CAPI_DEF(ftruncate64, 194, long fd, long low, long high) {
 SYS_CAPI_DEF(truncate64, 193, long path, long zero, long low, long high) {
   std::string pathname((char*)path);
   if (emscripten::is_pthreadfs_file(pathname)) {
-    g_sync_to_async_helper.invoke([path, low, high](emscripten::sync_to_async::Callback resume) {
-      g_resumeFct = [resume]() { (*resume)(); };
-      __sys_truncate64_async(path, low, high, &resumeWrapper_l);
-    });
-    return resume_result_long;
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(emscripten::sync_to_async::PATH_KEY,
+      [&call, path, low, high](emscripten::sync_to_async::Callback resume) {
+        call.resume = resume;
+        __sys_truncate64_async(path, low, high, &call, &resumeWrapper_l);
+      });
+    return call.result;
   }
   return SYNC_JS_SYSCALL(truncate64)(path, zero, low, high);
 }
 
 SYS_CAPI_DEF(ftruncate64, 194, long fd, long zero, long low, long high) {
   if (fsa_file_descriptors.count(fd) > 0) {
-    g_sync_to_async_helper.invoke(
-      [fd, low, high](emscripten::sync_to_async::Callback resume) {
-        g_resumeFct = [resume]() { (*resume)(); };
-        __sys_ftruncate64_async(fd, low, high, &resumeWrapper_l);
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(fd,
+      [&call, fd, low, high](emscripten::sync_to_async::Callback resume) {
+        call.resume = resume;
+        __sys_ftruncate64_async(fd, low, high, &call, &resumeWrapper_l);
       });
-    return resume_result_long;
+    return call.result;
   }
   return SYNC_JS_SYSCALL(ftruncate64)(fd, zero, low, high);
 }
@@ -305,11 +429,13 @@ SYS_CAPI_DEF(ftruncate64, 194, long fd, long zero, long low, long high) {
 SYS_CAPI_DEF(stat64, 195, long path, long buf) {
   std::string pathname((char*)path);
   if (emscripten::is_pthreadfs_file(pathname)) {
-    g_sync_to_async_helper.invoke([path, buf](emscripten::sync_to_async::Callback resume) {
-      g_resumeFct = [resume]() { (*resume)(); };
-      __sys_stat64_async(path, buf, &resumeWrapper_l);
-    });
-    return resume_result_long;
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(emscripten::sync_to_async::PATH_KEY,
+      [&call, path, buf](emscripten::sync_to_async::Callback resume) {
+        call.resume = resume;
+        __sys_stat64_async(path, buf, &call, &resumeWrapper_l);
+      });
+    return call.result;
   }
   return SYNC_JS_SYSCALL(stat64)(path, buf);
 }
@@ -317,22 +443,26 @@ SYS_CAPI_DEF(stat64, 195, long path, long buf) {
 SYS_CAPI_DEF(lstat64, 196, long path, long buf) {
   std::string pathname((char*)path);
   if (emscripten::is_pthreadfs_file(pathname)) {
-    g_sync_to_async_helper.invoke([path, buf](emscripten::sync_to_async::Callback resume) {
-      g_resumeFct = [resume]() { (*resume)(); };
-      __sys_lstat64_async(path, buf, &resumeWrapper_l);
-    });
-    return resume_result_long;
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(emscripten::sync_to_async::PATH_KEY,
+      [&call, path, buf](emscripten::sync_to_async::Callback resume) {
+        call.resume = resume;
+        __sys_lstat64_async(path, buf, &call, &resumeWrapper_l);
+      });
+    return call.result;
   }
   return SYNC_JS_SYSCALL(lstat64)(path, buf);
 }
 
 SYS_CAPI_DEF(fstat64, 197, long fd, long buf) {
   if (fsa_file_descriptors.count(fd) > 0) {
-    g_sync_to_async_helper.invoke([fd, buf](emscripten::sync_to_async::Callback resume) {
-      g_resumeFct = [resume]() { (*resume)(); };
-      __sys_fstat64_async(fd, buf, &resumeWrapper_l);
-    });
-    return resume_result_long;
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(fd,
+      [&call, fd, buf](emscripten::sync_to_async::Callback resume) {
+        call.resume = resume;
+        __sys_fstat64_async(fd, buf, &call, &resumeWrapper_l);
+      });
+    return call.result;
   }
   return SYNC_JS_SYSCALL(fstat64)(fd, buf);
 }
@@ -361,11 +491,13 @@ SYS_CAPI_DEF(fcntl64, 221, long fd, long cmd, ...) {
     va_start(vl, cmd);
     int varargs = va_arg(vl, int);
     va_end(vl);
-    g_sync_to_async_helper.invoke([fd, cmd, varargs](emscripten::sync_to_async::Callback resume) {
-      g_resumeFct = [resume]() { (*resume)(); };
-      __sys_fcntl64_async(fd, cmd, varargs, &resumeWrapper_l);
-    });
-    return resume_result_long;
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(fd,
+      [&call, fd, cmd, varargs](emscripten::sync_to_async::Callback resume) {
+        call.resume = resume;
+        __sys_fcntl64_async(fd, cmd, varargs, &call, &resumeWrapper_l);
+      });
+    return call.result;
   }
   va_list vl;
   va_start(vl, cmd);
@@ -390,18 +522,17 @@ SYS_CAPI_DEF(
 long utime(long path_ref, long times) {
   std::string path((char*)path_ref);
   if (emscripten::is_pthreadfs_file(path)) {
-    g_sync_to_async_helper.invoke(
-      [path_ref, times](emscripten::sync_to_async::Callback resume) {
-        g_resumeFct = [resume]() { (*resume)(); };
-        utime_async(path_ref, times, &resumeWrapper_l);
+    pthreadfs_call call;
+    g_sync_to_async_helper.invoke(emscripten::sync_to_async::PATH_KEY,
+      [&call, path_ref, times](emscripten::sync_to_async::Callback resume) {
+        call.resume = resume;
+        utime_async(path_ref, times, &call, &resumeWrapper_l);
       });
-    return resume_result_long;
+    return call.result;
   }
   return utime_sync(path_ref, times);
 }
 
-// Define global variables to be populated by resume;
-std::function<void()> g_resumeFct;
 emscripten::sync_to_async g_sync_to_async_helper __attribute__((init_priority(102)));
 
 // Other helper code
@@ -412,17 +543,36 @@ void emscripten_init_pthreadfs() {
 }
 
 void pthreadfs_load_package(const char* package_path) {
-  g_sync_to_async_helper.invoke([package_path](emscripten::sync_to_async::Callback resume) {
-    g_resumeFct = [resume]() { (*resume)(); };
+  pthreadfs_call call;
+  g_sync_to_async_helper.invoke([&call, package_path](emscripten::sync_to_async::Callback resume) {
+    call.resume = resume;
     // clang-format off
     EM_ASM({
       (async() => {
           console.log(`Loading package ${UTF8ToString($1)}`);
           importScripts(UTF8ToString($1));
           await PThreadFS.loadAvailablePackages();
-          wasmTable.get($0)(); 
-      })(); 
-    }, &resumeWrapper_v, package_path);
+          wasmTable.get($0)($2);
+      })();
+    }, &resumeWrapper_v, package_path, &call);
+    // clang-format on
+  });
+}
+
+int pthreadfs_barrier() {
+  pthreadfs_call call;
+  // Work without a key runs on its own, so the writes in flight are done
+  // before the barrier starts.
+  g_sync_to_async_helper.invoke([&call](emscripten::sync_to_async::Callback resume) {
+    call.resume = resume;
+    // clang-format off
+    EM_ASM({
+      (async() => {
+          let res = await FSAFS.barrier();
+          wasmTable.get($0)($1, res);
+      })();
+    }, &resumeWrapper_l, &call);
     // clang-format on
   });
+  return call.result;
 }
@@ -6,9 +6,11 @@
 #include <emscripten/threading.h>
 #include <pthread.h>
 
+#include <atomic>
 #include <functional>
 #include <memory>
 #include <thread>
+#include <type_traits>
 #include <utility>
 #include <wasi/api.h>
 
@@ -21,6 +23,19 @@
 #endif // PTHREADFS_FOLDER
 #define PTHREADFS_FOLDER_NAME STR(PTHREADFS_FOLDER)
 
+// The maximal number of calls that the PThreadFS thread works on at the same
+// time. Calls on the same file descriptor are always run one after the other.
+#ifndef PTHREADFS_IO_CONCURRENCY
+#define PTHREADFS_IO_CONCURRENCY 8
+#endif // PTHREADFS_IO_CONCURRENCY
+
+// The number of request slots shared with the PThreadFS thread. Threads
+// making a call while all slots are in use wait for one to be free. Must be a
+// power of two.
+#ifndef PTHREADFS_RING_SIZE
+#define PTHREADFS_RING_SIZE 64
+#endif // PTHREADFS_RING_SIZE
+
 // Emscripten changed the names of syscalls with version 2.0.31.
 // These macros translate between the old and new names
 #if __EMSCRIPTEN_major__ > 2 || (__EMSCRIPTEN_major__==2 && __EMSCRIPTEN_tiny__ > 31)
@@ -39,18 +54,23 @@ EM_IMPORT(__syscall_##name)  long SYNC_JS_SYSCALL(name)(__VA_ARGS__);
 // clang-format will incorrectly transform the Javascript code.
 // clang-format off
 #define EM_PTHREADFS_ASM(code)                                                                     \
-  g_sync_to_async_helper.invoke([](emscripten::sync_to_async::Callback resume) {                   \
-    g_resumeFct = [resume]() { (*resume)(); };                                                     \
-    EM_ASM({ (async() => { code wasmTable.get($0)(); })(); }, &resumeWrapper_v);                   \
-  });
+  {                                                                                                \
+    pthreadfs_call call;                                                                           \
+    g_sync_to_async_helper.invoke([&call](emscripten::sync_to_async::Callback resume) {            \
+      call.resume = resume;                                                                        \
+      EM_ASM({ (async() => { code wasmTable.get($0)($1); })(); }, &resumeWrapper_v, &call);        \
+    });                                                                                            \
+  }
 // clang-format on
 
 #define WASI_JSAPI_DEF(name, ...)                                                                  \
-  extern void __fd_##name##_async(__wasi_fd_t fd, __VA_ARGS__, void (*fun)(__wasi_errno_t));       \
+  extern void __fd_##name##_async(                                                                 \
+    __wasi_fd_t fd, __VA_ARGS__, pthreadfs_call* call, void (*fun)(pthreadfs_call*, __wasi_errno_t));\
   __attribute__((__import_module__("wasi_snapshot_preview1"), __import_name__(QUOTE(fd_##name))))  \
   EM_IMPORT(fd_##name) __wasi_errno_t fd_##name(__wasi_fd_t fd, __VA_ARGS__);
 #define WASI_JSAPI_NOARGS_DEF(name)                                                                \
-  extern void __fd_##name##_async(__wasi_fd_t fd, void (*fun)(__wasi_errno_t));                    \
+  extern void __fd_##name##_async(                                                                 \
+    __wasi_fd_t fd, pthreadfs_call* call, void (*fun)(pthreadfs_call*, __wasi_errno_t));           \
   __attribute__((__import_module__("wasi_snapshot_preview1"), __import_name__(QUOTE(fd_##name))))  \
   EM_IMPORT(fd_##name) __wasi_errno_t fd_##name(__wasi_fd_t fd);
 
@@ -59,30 +79,34 @@ EM_IMPORT(__syscall_##name)  long SYNC_JS_SYSCALL(name)(__VA_ARGS__);
 
 #define WASI_SYNC_TO_ASYNC(name, ...)                                                              \
   if (fsa_file_descriptors.count(fd) > 0) {                                                        \
-    g_sync_to_async_helper.invoke([fd, __VA_ARGS__](emscripten::sync_to_async::Callback resume) {  \
-      g_resumeFct = [resume]() { (*resume)(); };                                                   \
-      __fd_##name##_async(fd, __VA_ARGS__, &resumeWrapper_wasi);                                   \
-    });                                                                                            \
-    return resume_result_wasi;                                                                     \
+    pthreadfs_call call;                                                                           \
+    g_sync_to_async_helper.invoke(                                                                 \
+      fd, [&call, fd, __VA_ARGS__](emscripten::sync_to_async::Callback resume) {                   \
+        call.resume = resume;                                                                      \
+        __fd_##name##_async(fd, __VA_ARGS__, &call, &resumeWrapper_wasi);                          \
+      });                                                                                          \
+    return call.result;                                                                            \
   }                                                                                                \
   return fd_##name(fd, __VA_ARGS__);
 #define WASI_SYNC_TO_ASYNC_NOARGS(name)                                                            \
   if (fsa_file_descriptors.count(fd) > 0) {                                                        \
-    g_sync_to_async_helper.invoke([fd](emscripten::sync_to_async::Callback resume) {               \
-      g_resumeFct = [resume]() { (*resume)(); };                                                   \
-      __fd_##name##_async(fd, &resumeWrapper_wasi);                                                \
+    pthreadfs_call call;                                                                           \
+    g_sync_to_async_helper.invoke(fd, [&call, fd](emscripten::sync_to_async::Callback resume) {    \
+      call.resume = resume;                                                                        \
+      __fd_##name##_async(fd, &call, &resumeWrapper_wasi);                                         \
     });                                                                                            \
-    return resume_result_wasi;                                                                     \
+    return call.result;                                                                            \
   }                                                                                                \
   return fd_##name(fd);
 
 // Classic Syscalls
 #define SYS_JSAPI_DEF(name, ...)                                                                   \
-  extern void __sys_##name##_async(__VA_ARGS__, void (*fun)(long));                                \
+  extern void __sys_##name##_async(                                                                \
+    __VA_ARGS__, pthreadfs_call* call, void (*fun)(pthreadfs_call*, long));                        \
   SYS_JS_DEF(name, __VA_ARGS__);
 
 #define SYS_JSAPI_NOARGS_DEF(name)                                                                 \
-  extern void __sys_##name##_async(void (*fun)(long));                                             \
+  extern void __sys_##name##_async(pthreadfs_call* call, void (*fun)(pthreadfs_call*, long));      \
   extern long SYNC_JS_SYSCALL(name)();
 
 #define SYS_DEF(name, number, ...)                                                                 \
@@ -90,35 +114,44 @@ EM_IMPORT(__syscall_##name)  long SYNC_JS_SYSCALL(name)(__VA_ARGS__);
   SYS_JSAPI_DEF(name, __VA_ARGS__)
 
 #define SYS_JSAPI(name, ...) __sys_##name##_async(__VA_ARGS__)
+// Runs a syscall on a path and stores its result in `call.result`.
 #define SYS_SYNC_TO_ASYNC_NORETURN(name, ...)                                                      \
-  g_sync_to_async_helper.invoke([__VA_ARGS__](emscripten::sync_to_async::Callback resume) {        \
-    g_resumeFct = [resume]() { (*resume)(); };                                                     \
-    SYS_JSAPI(name, __VA_ARGS__, &resumeWrapper_l);                                                \
-  });
+  pthreadfs_call call;                                                                             \
+  g_sync_to_async_helper.invoke(emscripten::sync_to_async::PATH_KEY,                              \
+    [&call, __VA_ARGS__](emscripten::sync_to_async::Callback resume) {                             \
+      call.resume = resume;                                                                        \
+      SYS_JSAPI(name, __VA_ARGS__, &call, &resumeWrapper_l);                                       \
+    });
 #define SYS_SYNC_TO_ASYNC_FD(name, ...)                                                            \
   if (fsa_file_descriptors.count(fd) > 0) {                                                        \
-    g_sync_to_async_helper.invoke([__VA_ARGS__](emscripten::sync_to_async::Callback resume) {      \
-      g_resumeFct = [resume]() { (*resume)(); };                                                   \
-      __sys_##name##_async(__VA_ARGS__, &resumeWrapper_l);                                         \
+    pthreadfs_call call;                                                                           \
+    g_sync_to_async_helper.invoke(fd, [&call, __VA_ARGS__](emscripten::sync_to_async::Callback resume) {\
+      call.resume = resume;                                                                        \
+      __sys_##name##_async(__VA_ARGS__, &call, &resumeWrapper_l);                                  \
     });                                                                                            \
-    return resume_result_long;                                                                     \
+    return call.result;                                                                            \
   }                                                                                                \
   return SYNC_JS_SYSCALL(name)(__VA_ARGS__);
 #define SYS_SYNC_TO_ASYNC_PATH(name, ...)                                                          \
   std::string pathname((char*)path);                                                               \
   if (emscripten::is_pthreadfs_file(pathname)) {                                                   \
-    g_sync_to_async_helper.invoke([__VA_ARGS__](emscripten::sync_to_async::Callback resume) {      \
-      g_resumeFct = [resume]() { (*resume)(); };                                                   \
-      __sys_##name##_async(__VA_ARGS__, &resumeWrapper_l);                                         \
-    });                                                                                            \
-    return resume_result_long;                                                                     \
+    SYS_SYNC_TO_ASYNC_NORETURN(name, __VA_ARGS__)                                                  \
+    return call.result;                                                                            \
   }                                                                                                \
   return SYNC_JS_SYSCALL(name)(__VA_ARGS__);
 
+// A call proxied to the PThreadFS thread. The asynchronous implementation
+// passes it back to the resume wrapper, which stores the result and resumes
+// the calling thread.
+struct pthreadfs_call;
+
 extern "C" {
 // Helpers
-extern void pthreadfs_init(const char* folder, void (*fun)(void));
+extern void pthreadfs_init(const char* folder, pthreadfs_call* call, void (*fun)(pthreadfs_call*));
 void pthreadfs_load_package(const char* path_to_package);
+// Waits until the data written to all open files is persisted. Returns 0, or
+// EIO if persisting a file failed since the last call.
+int pthreadfs_barrier();
 void emscripten_init_pthreadfs();
 
 // WASI
@@ -189,11 +222,13 @@ SYS_CAPI_DEF(ftruncate64, 194, long fd, long low, long high);
 SYS_JSAPI_DEF(ftruncate64, long fd, long low, long high)
 #else  // __EMSCRIPTEN_major__ > 2 || (__EMSCRIPTEN_major__==2 && __EMSCRIPTEN_tiny__ > 31)
 SYS_CAPI_DEF(truncate64, 193, long path, long zero, long low, long high);
-extern void __sys_truncate64_async(long path, long low, long high, void (*fun)(long)); 
+extern void __sys_truncate64_async(
+  long path, long low, long high, pthreadfs_call* call, void (*fun)(pthreadfs_call*, long));
 SYS_JS_DEF(truncate64, long path, long zero, long low, long high);
 
 SYS_CAPI_DEF(ftruncate64, 194, long fd, long zero, long low, long high);
-extern void __sys_ftruncate64_async(long fd, long low, long high, void (*fun)(long));
+extern void __sys_ftruncate64_async(
+  long fd, long low, long high, pthreadfs_call* call, void (*fun)(pthreadfs_call*, long));
  SYS_JS_DEF(ftruncate64, long fd, long zero, long low, long high);
 
 #endif  // __EMSCRIPTEN_major__ > 2 || (__EMSCRIPTEN_major__==2 && __EMSCRIPTEN_tiny__ > 31)
@@ -237,7 +272,8 @@ SYS_JSAPI_DEF(
 // to utime_sync in order to avoid name confusion. utime_async proxies the
 // calls to the IO thread.
 extern long utime_sync(long path_ref, long times);
-extern void utime_async(long path_ref, long times, void (*fun)(long));
+extern void utime_async(
+  long path_ref, long times, pthreadfs_call* call, void (*fun)(pthreadfs_call*, long));
 long utime(long path_ref, long times);
 } // extern "C"
 
@@ -280,35 +316,90 @@ public:
   //
   // In the async case, you would call resume() at some later time.
   //
-  // It is safe to call this method from multiple threads, as it locks itself.
-  // That is, you can create an instance of this and call it from multiple
-  // threads freely.
-  void invoke(std::function<void(Callback)> newWork);
+  // It is safe to call this method from multiple threads. Work given to
+  // invoke() runs on its own: it waits for the work in flight to finish, and no
+  // other work starts before it is done.
+  //
+  // The work is not copied: the thread runs it in place while the caller
+  // waits, so that calls do not allocate.
+  template <typename Work> void invoke(Work&& work) {
+    invoke(EXCLUSIVE_KEY, std::forward<Work>(work));
+  }
+
+  // Like invoke(), but the work may run at the same time as work with other
+  // keys, up to PTHREADFS_IO_CONCURRENCY calls at a time. Work with the same
+  // key runs in the order it was invoked, one after the other.
+  template <typename Work> void invoke(long key, Work&& work) {
+    using WorkType = typename std::remove_reference<Work>::type;
+    submit(key, [](void* closure, Callback resume) { (*(WorkType*)closure)(resume); },
+      (void*)&work);
+  }
+
+  // The key of syscalls on paths. Syscalls on file descriptors use the file
+  // descriptor as key.
+  static constexpr long PATH_KEY = -1;
 
   //==============================================================================
   // End Public API
 
 private:
+  // The key of work that runs on its own.
+  static constexpr long EXCLUSIVE_KEY = -2;
+
+  static constexpr uint32_t RING_SIZE = PTHREADFS_RING_SIZE;
+  static_assert((RING_SIZE & (RING_SIZE - 1)) == 0, "PTHREADFS_RING_SIZE must be a power of two");
+
+  // A request slot in shared memory. Each call takes a ticket, and uses the
+  // slot of its ticket once the call of the previous round released it.
+  struct slot {
+    // The ticket that may use the slot while it is free, and that ticket + 1
+    // once its request is ready.
+    std::atomic<uint32_t> seq;
+    // Set by the thread once the work is done.
+    std::atomic<uint32_t> done;
+    long key;
+    void (*work)(void* closure, Callback resume);
+    void* closure;
+    // Finishes the request in this slot. It is created once, so that calls do
+    // not allocate.
+    std::function<void()> resume;
+    // The next pending request.
+    slot* next;
+  };
+
+  void submit(long key, void (*work)(void* closure, Callback resume), void* closure);
+
   std::unique_ptr<std::thread> thread;
-  std::mutex mutex;
-  std::mutex invokeMutex;
-  std::condition_variable condition;
-  std::function<void(Callback)> work;
-  std::unique_ptr<std::function<void()>> resume;
-
-  bool readyToWork = false;
-  bool finishedWork;
+  slot slots[RING_SIZE];
+  std::atomic<uint32_t> tail{0};
+
+  // The following are only used on the thread.
+
+  // The ticket of the next request to pick up.
+  uint32_t head = 0;
+  // Requests that have not been started yet, in the order they were invoked.
+  slot* pendingFirst = nullptr;
+  slot* pendingLast = nullptr;
+  // The keys of the requests in flight.
+  long busyKeys[PTHREADFS_IO_CONCURRENCY];
+  int inFlight = 0;
+  bool exclusiveInFlight = false;
+  bool waiting = false;
   bool quit = false;
 
   bool pthreadfs_initialized = false;
-
-  // The child will be asynchronous, and therefore we cannot rely on RAII to
-  // unlock for us, we must do it manually.
-  std::unique_lock<std::mutex> childLock;
+  bool pthreadfs_initializing = false;
+  std::function<void()> initialized;
 
   static void* threadMain(void* arg);
 
-  static void threadIter(void* arg);
+  // Picks up new requests and starts the ones that may run now, then waits
+  // asynchronously for more.
+  static void schedule(void* arg);
+
+  static void wakeUp(void* arg);
+
+  void finish(slot* s);
 };
 
 // Determines if `path` is a file in the special folder PTHREADFS_FOLDER.
@@ -319,15 +410,18 @@ bool is_pthreadfs_fd_link(std::string path);
 
 } // namespace emscripten
 
-// Declare global variables to be populated by resume;
-extern std::function<void()> g_resumeFct;
 extern emscripten::sync_to_async g_sync_to_async_helper;
 
-// Static functions calling resumFct and setting corresponding the return value.
-void resumeWrapper_v();
+struct pthreadfs_call {
+  emscripten::sync_to_async::Callback resume;
+  long result;
+};
+
+// Static functions setting the result of the call and resuming it.
+void resumeWrapper_v(pthreadfs_call* call);
 
-void resumeWrapper_l(long retVal);
+void resumeWrapper_l(pthreadfs_call* call, long retVal);
 
-void resumeWrapper_wasi(__wasi_errno_t retVal);
+void resumeWrapper_wasi(pthreadfs_call* call, __wasi_errno_t retVal);
 
 #endif // PTHREADFS_H
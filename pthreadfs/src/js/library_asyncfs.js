@@ -1107,17 +1107,26 @@
       if (!stream.stream_ops.write) {
         throw new PThreadFS.ErrnoError({{{ cDefine('EINVAL') }}});
       }
+      var seeking = typeof position !== 'undefined';
+      // In append mode, the file system writes at the end of the file and sets
+      // stream.position to where the write starts. It determines the end in
+      // the same step as the write, since calls on other streams of the file
+      // may run in between.
+      var append = false;
       if (stream.seekable && stream.flags & {{{ cDefine('O_APPEND') }}}) {
-        // seek to the end before writing in append mode
-        await PThreadFS.llseek(stream, 0, {{{ cDefine('SEEK_END') }}});
+        if (seeking) {
+          // seek to the end before writing in append mode
+          await PThreadFS.llseek(stream, 0, {{{ cDefine('SEEK_END') }}});
+        } else {
+          append = true;
+        }
       }
-      var seeking = typeof position !== 'undefined';
       if (!seeking) {
         position = stream.position;
       } else if (!stream.seekable) {
         throw new PThreadFS.ErrnoError({{{ cDefine('ESPIPE') }}});
       }
-      var bytesWritten = await stream.stream_ops.write(stream, buffer, offset, length, position, canOwn);
+      var bytesWritten = await stream.stream_ops.write(stream, buffer, offset, length, position, canOwn, append);
       if (!seeking) stream.position += bytesWritten;
       try {
         if (stream.path && PThreadFS.trackingDelegate['onWriteToFile']) PThreadFS.trackingDelegate['onWriteToFile'](stream.path);
@@ -1407,6 +1416,41 @@
       }
       return node;
     },
+    IMPORT_CONCURRENCY: 16,
+    // Writes a batch of files, e.g. the contents of a file package. `files` is a
+    // list of {'filename', 'start', 'end'} entries describing byte ranges of
+    // `data`. Each file is written with a single open, write and close (which
+    // flushes), replacing any previous version, and at most `concurrency` files
+    // are written at the same time.
+    importFiles: async function(files, data, concurrency) {
+      concurrency = concurrency || PThreadFS.IMPORT_CONCURRENCY;
+      var next = 0;
+      async function importNext() {
+        while (next < files.length) {
+          var file = files[next++];
+          await PThreadFS.importFile(file['filename'], data.subarray(file['start'], file['end']));
+        }
+      }
+      var workers = [];
+      for (var i = 0; i < Math.min(concurrency, files.length); i++) {
+        workers.push(importNext());
+      }
+      await Promise.all(workers);
+    },
+    importFile: async function(path, data) {
+      var mode = PThreadFS.getMode(true, true);
+      // Truncate through the open stream rather than with O_TRUNC, so that the
+      // backend only has to open the file once.
+      var stream = await PThreadFS.open(path, {{{ cDefine('O_CREAT') | cDefine('O_WRONLY') }}}, mode);
+      try {
+        if (data.length) {
+          await PThreadFS.write(stream, data, 0, data.length, 0);
+        }
+        await PThreadFS.ftruncate(stream.fd, data.length);
+      } finally {
+        await PThreadFS.close(stream);
+      }
+    },
     createDevice: async function(parent, name, input, output) {
       var path = PATH.join2(typeof parent === 'string' ? parent : PThreadFS.getPath(parent), name);
       var mode = PThreadFS.getMode(!!input, !!output);
@@ -1464,7 +1508,7 @@
     // Makes sure a file's contents are loaded. Returns whether the file has
     // been loaded successfully. No-op for files that have been loaded already.
     forceLoadFile: function(obj) {
-      if (obj.isDevice || obj.isFolder || obj.link || obj.contents) return true;
+      if (obj.isDevice || obj.isFolder || obj.link || obj.usedBytes) return true;
       if (typeof XMLHttpRequest !== 'undefined') {
         throw new Error("Lazy loading should have been performed (contents set) in createLazyFile, but it was not. Lazy loading only works in web workers. Use --embed-file or --preload-file in emcc on the main thread.");
       } else if (read_) {
@@ -1472,8 +1516,7 @@
         try {
           // WARNING: Can't read binary files in V8's d8 or tracemonkey's js, as
           //          read() will try to parse UTF8.
-          obj.contents = intArrayFromString(read_(obj.url), true);
-          obj.usedBytes = obj.contents.length;
+          MEMFS_ASYNC.setFileData(obj, new Uint8Array(intArrayFromString(read_(obj.url), true)));
         } catch (e) {
           throw new PThreadFS.ErrnoError({{{ cDefine('EIO') }}});
         }
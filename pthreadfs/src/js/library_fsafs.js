@@ -20,6 +20,450 @@ mergeInto(LibraryManager.library, {
       return await node.localReference.createSyncAccessHandle({mode: "in-place"});
     },
 
+    // Runs work() once the work queued for a node before it is done, and
+    // returns its result. Calls on different file descriptors run at the same
+    // time, so this keeps the steps of e.g. opening and closing the same file
+    // from interleaving.
+    enqueue: function(node, work) {
+      let previous = node.queued;
+      let result = (async () => {
+        try {
+          await previous;
+        } catch (e) {
+          // The caller of the previous work handles its failure.
+        }
+        return await work();
+      })();
+      node.queued = result;
+      return result;
+    },
+
+    /* Page cache */
+
+    // Files opened through access handles can be cached in pages of PAGE_SIZE
+    // bytes. The cache holds at most PAGE_CACHE_PAGES pages of all files, and
+    // evicts the least recently used ones. Writes are kept in the cache until
+    // the file is synced or closed, or the page is evicted. The cache is off
+    // by default, link with e.g. -jsDPTHREADFS_PAGE_CACHE_PAGES=1024 to
+    // enable it.
+    PAGE_SIZE: 4096,
+    PAGE_CACHE_PAGES: {{{ typeof PTHREADFS_PAGE_CACHE_PAGES !== 'undefined' ? PTHREADFS_PAGE_CACHE_PAGES : 0 }}},
+    // The cached pages, least recently used first.
+    pageLRU: new Map(),
+    pageCacheStats: {hits: 0, misses: 0, evictions: 0, writeBacks: 0},
+
+    // Starts caching an open file. node.size includes the writes that are
+    // still in the cache.
+    cacheFile: function(node) {
+      node.pages = new Map();
+    },
+
+    // Writes back and drops the cached pages of a file that is being closed.
+    uncacheFile: async function(node) {
+      await FSAFS.writeBackPages(node);
+      for (let page of node.pages.values()) {
+        FSAFS.pageLRU.delete(page);
+      }
+      node.pages = null;
+    },
+
+    // Returns the page with the given index, loading it from the file on a
+    // miss. A page that is about to be overwritten entirely is not loaded,
+    // but created from `contents`. The page is pinned, which keeps it from
+    // being evicted, until the caller unpins it.
+    getPage: async function(node, index, contents) {
+      let page = node.pages.get(index);
+      if (page) {
+        FSAFS.pageCacheStats.hits++;
+      } else {
+        FSAFS.pageCacheStats.misses++;
+        // Evict the least recently used pages until there is room. Dirty pages
+        // are written back first, and stay cached while that happens. Those of
+        // other files are written back in the queue of their file, which this
+        // does not wait for. When all pages are pinned, the cache grows beyond
+        // its size by at most one page per call in flight.
+        while (!page && FSAFS.pageLRU.size >= FSAFS.PAGE_CACHE_PAGES) {
+          let victim = null;
+          for (let candidate of FSAFS.pageLRU.keys()) {
+            if (!candidate.pins) {
+              victim = candidate;
+              break;
+            }
+          }
+          if (!victim) {
+            break;
+          }
+          if (victim.dirty && victim.node !== node) {
+            FSAFS.writeBackPageInBackground(victim);
+          } else if (victim.dirty) {
+            await FSAFS.writeBackPage(victim);
+          } else {
+            FSAFS.dropPage(victim);
+            FSAFS.pageCacheStats.evictions++;
+          }
+          // Another call may have added the page in the meantime.
+          page = node.pages.get(index);
+        }
+      }
+      if (page) {
+        FSAFS.pageLRU.delete(page);
+        FSAFS.pageLRU.set(page, true);
+        page.pins++;
+        await page.loaded;
+        return page;
+      }
+      page = {node: node, index: index, data: new Uint8Array(FSAFS.PAGE_SIZE), dirty: false, loaded: null, pins: 1};
+      node.pages.set(index, page);
+      FSAFS.pageLRU.set(page, true);
+      let position = index * FSAFS.PAGE_SIZE;
+      if (contents) {
+        page.data.set(contents);
+      } else if (position < node.size) {
+        try {
+          page.loaded = node.handle.read(page.data, {at: position});
+          await page.loaded;
+        } catch (e) {
+          // A page that could not be loaded is not cached. Calls that wait
+          // for it get the same error.
+          FSAFS.dropPage(page);
+          throw e;
+        }
+      }
+      return page;
+    },
+
+    dropPage: function(page) {
+      FSAFS.pageLRU.delete(page);
+      page.node.pages.delete(page.index);
+    },
+
+    writeBackPage: async function(page) {
+      let node = page.node;
+      let position = page.index * FSAFS.PAGE_SIZE;
+      // Writes to the page while this is in flight make it dirty again. The
+      // page is pinned, so that it is not reloaded before the write is done.
+      page.dirty = false;
+      page.pins++;
+      FSAFS.pageCacheStats.writeBacks++;
+      let length = Math.max(0, Math.min(FSAFS.PAGE_SIZE, node.size - position));
+      try {
+        await node.handle.write(page.data.subarray(0, length), {at: position});
+      } finally {
+        page.pins--;
+      }
+    },
+
+    // Writes back a dirty page of a file from the queue of that file. The page
+    // stays pinned until then. If the write fails, the page stays dirty, so
+    // that the next sync of the file reports the failure.
+    writeBackPageInBackground: function(page) {
+      page.pins++;
+      FSAFS.enqueue(page.node, async () => {
+        // The file may have been synced or closed in the meantime.
+        if (page.dirty && page.node.pages) {
+          await FSAFS.writeBackPage(page);
+        }
+      }).catch((e) => {
+        page.dirty = true;
+      }).finally(() => {
+        page.pins--;
+      });
+    },
+
+    writeBackPages: async function(node) {
+      let dirty = [];
+      for (let page of node.pages.values()) {
+        if (page.dirty) {
+          dirty.push(page);
+        }
+      }
+      dirty.sort((a, b) => a.index - b.index);
+      for (let page of dirty) {
+        await FSAFS.writeBackPage(page);
+      }
+    },
+
+    readPages: async function(node, data, position) {
+      let end = Math.min(position + data.length, node.size);
+      let current = position;
+      while (current < end) {
+        let index = Math.floor(current / FSAFS.PAGE_SIZE);
+        let start = current - index * FSAFS.PAGE_SIZE;
+        let count = Math.min(FSAFS.PAGE_SIZE - start, end - current);
+        let page = await FSAFS.getPage(node, index);
+        data.set(page.data.subarray(start, start + count), current - position);
+        page.pins--;
+        current += count;
+      }
+      return Math.max(0, end - position);
+    },
+
+    writePages: async function(node, data, position) {
+      let written = 0;
+      while (written < data.length) {
+        let current = position + written;
+        let index = Math.floor(current / FSAFS.PAGE_SIZE);
+        let start = current - index * FSAFS.PAGE_SIZE;
+        let count = Math.min(FSAFS.PAGE_SIZE - start, data.length - written);
+        let contents = data.subarray(written, written + count);
+        let page = await FSAFS.getPage(node, index, count == FSAFS.PAGE_SIZE ? contents : null);
+        page.data.set(contents, start);
+        page.dirty = true;
+        page.pins--;
+        node.size = Math.max(node.size, current + count);
+        written += count;
+      }
+      return written;
+    },
+
+    // Drops the pages past the new end of a file. A page that is pinned by a
+    // call in flight is zeroed and kept instead, and is not written back past
+    // the end of the file.
+    truncatePages: function(node, size) {
+      for (let page of node.pages.values()) {
+        let position = page.index * FSAFS.PAGE_SIZE;
+        if (position >= size && !page.pins) {
+          FSAFS.dropPage(page);
+        } else if (position >= size) {
+          page.data.fill(0);
+          page.dirty = false;
+        } else if (position + FSAFS.PAGE_SIZE > size) {
+          page.data.fill(0, size - position);
+        }
+      }
+      node.size = size;
+    },
+
+    /* Main thread access */
+
+    // Access handles are not available on the main thread. There, the contents
+    // of an open file are read from its blob once and kept in node.fileData,
+    // and writes go to a writable that stays open until the file is synced or
+    // closed. Writes are applied to node.fileData as well, so that it does not
+    // need to be read again.
+    loadFileData: async function(node) {
+      if (!node.fileData) {
+        // The blob does not include the writes that are still pending.
+        await FSAFS.commitWritable(node);
+        let file_blob = await node.localReference.getFile();
+        node.fileData = new Uint8Array(await file_blob.arrayBuffer());
+      }
+      return node.fileData;
+    },
+
+    // Resizes node.fileData, keeping room for it to grow without copying.
+    resizeFileData: function(node, size) {
+      let fileData = node.fileData;
+      if (size <= fileData.length) {
+        fileData.fill(0, size);
+      } else if (size > fileData.buffer.byteLength) {
+        let grown = new Uint8Array(Math.max(size, fileData.buffer.byteLength * 2));
+        grown.set(fileData);
+        fileData = grown;
+      }
+      node.fileData = new Uint8Array(fileData.buffer, 0, size);
+    },
+
+    getWritable: async function(node) {
+      if (!node.writable) {
+        node.writable = node.localReference.createWritable({keepExistingData: true});
+      }
+      return await node.writable;
+    },
+
+    // Closes the writable of a file, which commits the writes made through it.
+    commitWritable: async function(node) {
+      if (node.writable) {
+        let writable = node.writable;
+        node.writable = null;
+        await (await writable).close();
+      }
+    },
+
+    /* Handle pool */
+
+    // Creating an access handle is expensive. When a file is closed, its
+    // handle can be kept open in a pool of at most HANDLE_POOL_SIZE handles, so
+    // that opening the file again reuses it. A pooled handle is closed after
+    // HANDLE_POOL_MS milliseconds, or earlier if the pool is full or the file
+    // is renamed or removed, so that other tabs and threads can open the file.
+    // The pool is off by default, link with e.g.
+    // -jsDPTHREADFS_HANDLE_POOL_SIZE=16 to enable it.
+    HANDLE_POOL_SIZE: {{{ typeof PTHREADFS_HANDLE_POOL_SIZE !== 'undefined' ? PTHREADFS_HANDLE_POOL_SIZE : 0 }}},
+    HANDLE_POOL_MS: {{{ typeof PTHREADFS_HANDLE_POOL_MS !== 'undefined' ? PTHREADFS_HANDLE_POOL_MS : 1000 }}},
+    // Maps the nodes with a pooled handle to the timeouts closing them, least
+    // recently closed first.
+    handlePool: new Map(),
+
+    poolHandle: function(node) {
+      if (FSAFS.handlePool.size >= FSAFS.HANDLE_POOL_SIZE) {
+        FSAFS.releaseHandleInBackground(FSAFS.handlePool.keys().next().value);
+      }
+      FSAFS.handlePool.set(node, setTimeout(() => FSAFS.releaseHandleInBackground(node), FSAFS.HANDLE_POOL_MS));
+    },
+
+    // Takes the handle of a node that is opened again out of the pool.
+    unpoolHandle: function(node) {
+      clearTimeout(FSAFS.handlePool.get(node));
+      FSAFS.handlePool.delete(node);
+    },
+
+    // Closes the pooled handle of a node, if it has one. The handle leaves the
+    // pool right away, and is closed once the work queued for the node is
+    // done, unless the file has been opened or the handle pooled again by then.
+    releaseHandle: async function(node) {
+      if (!FSAFS.handlePool.has(node)) {
+        return;
+      }
+      FSAFS.unpoolHandle(node);
+      await FSAFS.enqueue(node, async () => {
+        if (!node.handle || node.refcount > 0 || FSAFS.handlePool.has(node)) {
+          return;
+        }
+        let handle = node.handle;
+        node.handle = null;
+        // Opening the file again has to wait until the handle is closed.
+        node.handleClosed = (async () => {
+          try {
+            await handle.close();
+          } catch (e) {
+            console.log(`FSAFS error: Closing a pooled handle failed with ${e.name}`);
+          }
+        })();
+        await node.handleClosed;
+      });
+    },
+
+    // Releases a pooled handle without waiting for it, e.g. when it expires.
+    releaseHandleInBackground: function(node) {
+      FSAFS.releaseHandle(node).catch((e) => {
+        console.log(`FSAFS error: Releasing a pooled handle failed with ${e.name}`);
+      });
+    },
+
+    /* Syncing */
+
+    // fsync() calls for a file that arrive while it is being flushed are
+    // coalesced into a single flush, which starts when the current one is
+    // done. Link with -jsDPTHREADFS_GROUP_COMMIT_MS=<ms> to wait that long
+    // before each flush, so that more calls can join it. With
+    // -jsDPTHREADFS_WRITE_BEHIND=1, fsync() returns without waiting for the
+    // flush, and only pthreadfs_barrier() guarantees that the data written so
+    // far is persisted. Flushes are queued with the reads and writes of the
+    // file, so they never use its handle at the same time.
+    GROUP_COMMIT_MS: {{{ typeof PTHREADFS_GROUP_COMMIT_MS !== 'undefined' ? PTHREADFS_GROUP_COMMIT_MS : 0 }}},
+    WRITE_BEHIND: {{{ typeof PTHREADFS_WRITE_BEHIND !== 'undefined' ? PTHREADFS_WRITE_BEHIND : 0 }}},
+    // The files that are open.
+    openNodes: new Set(),
+    // Whether a flush in the background failed since the last barrier.
+    syncFailed: false,
+
+    flushFile: async function(node) {
+      if (ENVIRONMENT_IS_WEB) {
+        // On the main thread, writes are committed by closing the writable.
+        await FSAFS.commitWritable(node);
+      }
+      else {
+        // On worker threads, explicit flush is required.
+        if (node.pages) {
+          await FSAFS.writeBackPages(node);
+        }
+        await node.handle.flush();
+      }
+    },
+
+    // Returns a promise for a flush of the file that starts after this call.
+    syncFile: function(node) {
+      if (!node.nextSync) {
+        node.nextSync = (async () => {
+          try {
+            await node.currentSync;
+          } catch (e) {
+            // The callers of the previous flush handle its failure.
+          }
+          if (FSAFS.GROUP_COMMIT_MS) {
+            await new Promise((resolve) => setTimeout(resolve, FSAFS.GROUP_COMMIT_MS));
+          }
+          node.currentSync = node.nextSync;
+          node.nextSync = null;
+          // Reads and writes of the file wait for the flush, so that they do
+          // not use the handle at the same time.
+          await FSAFS.enqueue(node, () => FSAFS.flushFile(node));
+        })();
+      }
+      return node.nextSync;
+    },
+
+    // Waits until the flushes of the file that were started are done.
+    waitForSync: async function(node) {
+      try {
+        await (node.nextSync || node.currentSync);
+      } catch (e) {
+        FSAFS.syncFailed = true;
+      }
+    },
+
+    // Flushes all open files. Returns 0, or EIO if a flush failed, including
+    // flushes that ran in the background since the last barrier.
+    barrier: async function() {
+      try {
+        await Promise.all(Array.from(FSAFS.openNodes, (node) => FSAFS.syncFile(node)));
+      } catch (e) {
+        console.log(`FSAFS error: Flushing a file failed with ${e.name}`);
+        FSAFS.syncFailed = true;
+      }
+      let failed = FSAFS.syncFailed;
+      FSAFS.syncFailed = false;
+      return failed ? {{{ cDefine('EIO') }}} : 0;
+    },
+
+    /* Directory entries */
+
+    // Directories remember up to MISSING_NAMES names that were not found in
+    // node.missing, so that repeated lookups of them fail without asking the
+    // file system. Once a directory was read completely, node.listed is set
+    // and node.contents holds all of its entries, so that any name not in it
+    // is known to be missing. Changes made through PThreadFS keep both up to
+    // date, changes made to the origin private file system by other tabs or
+    // threads are not noticed.
+    MISSING_NAMES: 1024,
+
+    addEntry: function(parent, name, node) {
+      parent.contents[name] = node;
+      if (parent.missing) {
+        parent.missing.delete(name);
+      }
+    },
+
+    removeEntry: function(parent, name) {
+      delete parent.contents[name];
+      if (parent.listed) {
+        return;
+      }
+      if (!parent.missing) {
+        parent.missing = new Set();
+      } else if (parent.missing.size >= FSAFS.MISSING_NAMES) {
+        parent.missing.clear();
+      }
+      parent.missing.add(name);
+    },
+
+    // Creates the node for an existing file or directory.
+    createChildNode: function(parent, name, localReference) {
+      let mode = localReference.kind === 'directory' ?
+          {{{ cDefine('S_IFDIR') }}} | 511 /* 0777 */ :
+          {{{ cDefine('S_IFREG') }}} | 511 /* 0777 */;
+      var node = PThreadFS.createNode(parent, name, mode);
+      node.node_ops = FSAFS.node_ops;
+      node.stream_ops = FSAFS.stream_ops;
+      node.localReference = localReference;
+      if (localReference.kind === 'directory') {
+        node.contents = {};
+      }
+      parent.contents[name] = node;
+      return node;
+    },
+
     /* Filesystem implementation (public interface) */
 
     createNode: function (parent, name, mode, dev) {
@@ -64,8 +508,8 @@ mergeInto(LibraryManager.library, {
         if (PThreadFS.isDir(node.mode)) {
           attr.size = 4096;
         } else if (PThreadFS.isFile(node.mode)) {
-          if (node.handle && !ENVIRONMENT_IS_WEB){
-            attr.size = await node.handle.getSize();
+          if (node.handle) {
+            attr.size = node.size;
           }
           else {
             // Unless we already have an active handle, get the file's length
@@ -97,18 +541,48 @@ mergeInto(LibraryManager.library, {
           node.timestamp = attr.timestamp;
         }
         if (attr.size !== undefined) {
+          let truncated = await FSAFS.enqueue(node, async () => {
+            if (!node.handle) {
+              return false;
+            }
+            if (ENVIRONMENT_IS_WEB) {
+              let writable = await FSAFS.getWritable(node);
+              await writable.truncate(attr.size);
+              if (node.fileData) {
+                FSAFS.resizeFileData(node, attr.size);
+              }
+            }
+            else {
+              if (node.pages) {
+                FSAFS.truncatePages(node, attr.size);
+              }
+              // Keep a pooled handle from being released while it is in use.
+              let pooled = FSAFS.handlePool.has(node);
+              if (pooled) {
+                FSAFS.unpoolHandle(node);
+              }
+              try {
+                await node.handle.truncate(attr.size);
+              } finally {
+                if (pooled) {
+                  FSAFS.poolHandle(node);
+                }
+              }
+            }
+            node.size = attr.size;
+            return true;
+          });
+          if (truncated) {
+            return;
+          }
           if (ENVIRONMENT_IS_WEB) {
-            // Since Access Handles are unavailable in workers, we must use 
-            // writables instead.
+            // Since Access Handles are unavailable on the main thread, we must
+            // use writables instead.
             let wt = await node.localReference.createWritable({ keepExistingData: true});
             await wt.truncate(attr.size);
             await wt.close();
             return;
           }
-          if (node.handle) {
-            await node.handle.truncate(attr.size);
-            return;
-          }
           // On a worker without an open access handle, try three times to open an access handle.
           function timeout(ms) { return new Promise(resolve => setTimeout(resolve, ms)) };
           const number_of_tries = 3;
@@ -146,31 +620,28 @@ mergeInto(LibraryManager.library, {
       },
 
       lookup: async function (parent, name) {
+        if (parent.listed || (parent.missing && parent.missing.has(name))) {
+          throw PThreadFS.genericErrors[{{{ cDefine('ENOENT') }}}];
+        }
         let childLocalReference = null;
-        let mode = null;
         try {
           childLocalReference = await parent.localReference.getDirectoryHandle(name, {create: false});
-          mode = {{{ cDefine('S_IFDIR') }}} | 511 /* 0777 */
         } catch (e) {
           try {
             childLocalReference = await parent.localReference.getFileHandle(name, {create: false});
-            mode = {{{ cDefine('S_IFREG') }}} | 511 /* 0777 */
           } catch (e) {
+            FSAFS.removeEntry(parent, name);
             throw PThreadFS.genericErrors[{{{ cDefine('ENOENT') }}}];
           }
         }
-        var node = PThreadFS.createNode(parent, name, mode);
-        node.node_ops = FSAFS.node_ops;
-        node.stream_ops = FSAFS.stream_ops;
-        node.localReference = childLocalReference;
-        if (childLocalReference.kind === 'directory') {
-          node.contents = {};
-        }
-        return node;
+        return FSAFS.createChildNode(parent, name, childLocalReference);
       },
 
       mknod: async function (parent, name, mode, dev) {
         let node = FSAFS.createNode(parent, name, mode, dev);
+        if (parent.missing) {
+          parent.missing.delete(name);
+        }
         try {
           if (PThreadFS.isDir(mode)) {
             node.localReference = await parent.localReference.getDirectoryHandle(name, {create: true});
@@ -192,6 +663,11 @@ mergeInto(LibraryManager.library, {
           console.log('Rename error: File System Access does not support renaming directories');
           throw new PThreadFS.ErrnoError({{{ cDefine('EXDEV') }}});
         }
+        // Files with an open handle cannot be moved.
+        await FSAFS.releaseHandle(oldNode);
+        if (newName in newParentNode.contents) {
+          await FSAFS.releaseHandle(newParentNode.contents[newName]);
+        }
         try {
           await oldNode.localReference.move(newParentNode.localReference, newName);
         }
@@ -212,20 +688,22 @@ mergeInto(LibraryManager.library, {
           throw new PThreadFS.ErrnoError({{{ cDefine('EXDEV') }}});
         }
         // Update the internal directory cache.
-        delete oldNode.parent.contents[oldNode.name];
+        FSAFS.removeEntry(oldNode.parent, oldNode.name);
         oldNode.parent.timestamp = Date.now()
         oldNode.name = newName;
-        newParentNode.contents[newName] = oldNode;
+        FSAFS.addEntry(newParentNode, newName, oldNode);
         newParentNode.timestamp = oldNode.parent.timestamp;
         oldNode.parent = newParentNode;
       },
 
       unlink: async function(parent, name) {
+        // Files with an open handle cannot be removed.
+        if (name in parent.contents) {
+          await FSAFS.releaseHandle(parent.contents[name]);
+        }
         let res = await parent.localReference.removeEntry(name);
 
-        if ('contents' in parent) {
-          delete parent.contents[name];
-        }
+        FSAFS.removeEntry(parent, name);
         parent.timestamp = Date.now();
         return res;
       },
@@ -243,26 +721,31 @@ mergeInto(LibraryManager.library, {
           }
           throw new PThreadFS.ErrnoError({{{ cDefine('EINVAL') }}});
         }
-        if ('contents' in parent) {
-          delete parent.contents[name];
-        }
+        FSAFS.removeEntry(parent, name);
         parent.timestamp = Date.now();
         return res
       },
 
       readdir: async function(node) {
-        let entries = ['.', '..'];
-        // Do not use `for await` yet, since it's not supported by Emscripten's minifier.
-        // for await (let [name, handle] of node.localReference) {
-        //   entries.push(name);
-        // }
-        let it = node.localReference.values();
-        let curr = await it.next();
-        while (!curr.done) {
-          entries.push(curr.value.name);
-          curr = await it.next();
+        if (!node.listed) {
+          // Create the nodes of all entries, so that looking them up does not
+          // need to ask the file system again.
+          // Do not use `for await` yet, since it's not supported by Emscripten's minifier.
+          // for await (let [name, handle] of node.localReference) {
+          //   entries.push(name);
+          // }
+          let it = node.localReference.values();
+          let curr = await it.next();
+          while (!curr.done) {
+            if (!(curr.value.name in node.contents)) {
+              FSAFS.createChildNode(node, curr.value.name, curr.value);
+            }
+            curr = await it.next();
+          }
+          node.listed = true;
+          node.missing = null;
         }
-        return entries;
+        return ['.', '..'].concat(Object.keys(node.contents));
       },
 
       // No readlink support: Since PThreadFS does not support links, there is
@@ -287,19 +770,36 @@ mergeInto(LibraryManager.library, {
           throw new PThreadFS.ErrnoError({{{ cDefine('ENOSYS') }}});
         }
 
-        if (stream.node.handle) {
-          stream.handle = stream.node.handle;
-          ++stream.node.refcount;
-        } else {
-          if (ENVIRONMENT_IS_WEB) {
-            stream.handle = stream.node.localReference;
+        await FSAFS.enqueue(stream.node, async () => {
+          if (stream.node.handle) {
+            // The handle is either open, pooled, or about to be closed.
+            stream.handle = stream.node.handle;
+            ++stream.node.refcount;
+            FSAFS.unpoolHandle(stream.node);
+          } else {
+            // While the file is open, its size is tracked in node.size instead
+            // of being queried on every fstat() or lseek().
+            if (ENVIRONMENT_IS_WEB) {
+              stream.handle = stream.node.localReference;
+              stream.node.size = (await stream.handle.getFile()).size;
+            }
+            else {
+              await stream.node.handleClosed;
+              stream.handle = await FSAFS.createSyncAccessHandle(stream.node);
+              stream.node.size = await stream.handle.getSize();
+            }
+            stream.node.handle = stream.handle;
+            stream.node.refcount = 1;
           }
-          else {
-            stream.handle = await FSAFS.createSyncAccessHandle(stream.node);
+          if (stream.node.refcount == 1) {
+            FSAFS.openNodes.add(stream.node);
+            // A file that is opened again while it is being closed keeps its
+            // cached pages.
+            if (FSAFS.PAGE_CACHE_PAGES && !ENVIRONMENT_IS_WEB && !stream.node.pages) {
+              FSAFS.cacheFile(stream.node);
+            }
           }
-          stream.node.handle = stream.handle;
-          stream.node.refcount = 1;
-        }
+        });
       },
 
       close: async function (stream) {
@@ -313,62 +813,116 @@ mergeInto(LibraryManager.library, {
         }
 
         stream.handle = null;
-        --stream.node.refcount;
-        if (stream.node.refcount <= 0) {
-          // On the main thread, no access handle is open.
-          if (!ENVIRONMENT_IS_WEB) {
-            await stream.node.handle.close();
+        let node = stream.node;
+        let last = await FSAFS.enqueue(node, () => {
+          --node.refcount;
+          if (node.refcount > 0) {
+            return false;
           }
-          stream.node.handle = null;
+          // No fsync() or barrier starts flushing the file anymore.
+          FSAFS.openNodes.delete(node);
+          return true;
+        });
+        if (!last) {
+          return;
         }
+        await FSAFS.waitForSync(node);
+        await FSAFS.enqueue(node, async () => {
+          if (node.refcount > 0) {
+            // The file was opened again in the meantime.
+            return;
+          }
+          if (node.pages) {
+            await FSAFS.uncacheFile(node);
+          }
+          // On the main thread, no access handle is open.
+          if (ENVIRONMENT_IS_WEB) {
+            await FSAFS.commitWritable(node);
+            node.fileData = null;
+          }
+          else if (FSAFS.HANDLE_POOL_SIZE) {
+            // Closing the handle would persist the file, flushing it does
+            // the same for a pooled handle.
+            await node.handle.flush();
+            FSAFS.poolHandle(node);
+            return;
+          }
+          else {
+            await node.handle.close();
+          }
+          node.handle = null;
+        });
       },
 
       fsync: async function(stream) {
         if (stream.handle == null) {
           throw new PThreadFS.ErrnoError({{{ cDefine('EBADF') }}});
         }
-        if (!ENVIRONMENT_IS_WEB) {
-          // On worker threads, explicit flush is required. On the main thread,
-          // writables are used that flush implicitly.
-          await stream.handle.flush();
+        let sync = FSAFS.syncFile(stream.node);
+        if (FSAFS.WRITE_BEHIND) {
+          // A failure is reported by the next pthreadfs_barrier().
+          sync.catch((e) => {
+            FSAFS.syncFailed = true;
+          });
+          return 0;
         }
+        await sync;
         return 0;
       },
 
       read: async function (stream, buffer, offset, length, position) {
-        let data = buffer.subarray(offset, offset+length);
-        let readBytes;
-        if (ENVIRONMENT_IS_WEB) {
-          // On the main thread, we use file blobs instead of Access Handles.
-          let file_blob = await stream.handle.getFile();
-          let file_arraybuffer = await file_blob.arrayBuffer();
-          var file_uint8view = new Uint8Array(file_arraybuffer);
-          let read_maximum = Math.min(position + data.length, file_blob.size);
-          data.set(file_uint8view.slice(position, read_maximum));
-          readBytes = read_maximum - position;
-        }
-        else {
-          readBytes = await stream.handle.read(data, {at: position});
-        }
-        return readBytes;
+        return await FSAFS.enqueue(stream.node, async () => {
+          let data = buffer.subarray(offset, offset+length);
+          let readBytes;
+          if (ENVIRONMENT_IS_WEB) {
+            // On the main thread, we use file blobs instead of Access Handles.
+            let fileData = await FSAFS.loadFileData(stream.node);
+            let read_maximum = Math.min(position + data.length, fileData.length);
+            readBytes = Math.max(0, read_maximum - position);
+            data.set(fileData.subarray(position, position + readBytes));
+          }
+          else if (stream.node.pages) {
+            readBytes = await FSAFS.readPages(stream.node, data, position);
+          }
+          else {
+            readBytes = await stream.handle.read(data, {at: position});
+          }
+          return readBytes;
+        });
       },
 
-      write: async function (stream, buffer, offset, length, position) {
-        stream.node.timestamp = Date.now();
-        let data = buffer.subarray(offset, offset+length);
-        let writtenBytes;
-        if (ENVIRONMENT_IS_WEB) {
-          // On the main thread, we use writables instead of Access Handles.
-          // This may be really slow, since it always copies the entire file.
-          let writable = await stream.handle.createWritable({ keepExistingData: true});
-          await writable.write({type: "write", position: position, data: data});
-          await writable.close();
-          writtenBytes = data.length;
-        }
-        else {
-          writtenBytes = await stream.handle.write(data, {at: position});
-        }
-        return writtenBytes;
+      write: async function (stream, buffer, offset, length, position, canOwn, append) {
+        return await FSAFS.enqueue(stream.node, async () => {
+          if (append) {
+            // The end of the file is only known once the writes queued before
+            // are done.
+            position = stream.position = stream.node.size;
+          }
+          stream.node.timestamp = Date.now();
+          let data = buffer.subarray(offset, offset+length);
+          let writtenBytes;
+          if (ENVIRONMENT_IS_WEB) {
+            // On the main thread, we use writables instead of Access Handles.
+            let writable = await FSAFS.getWritable(stream.node);
+            await writable.write({type: "write", position: position, data: data});
+            let fileData = stream.node.fileData;
+            if (fileData) {
+              if (position + data.length > fileData.length) {
+                FSAFS.resizeFileData(stream.node, position + data.length);
+              }
+              stream.node.fileData.set(data, position);
+            }
+            writtenBytes = data.length;
+          }
+          else if (stream.node.pages) {
+            writtenBytes = await FSAFS.writePages(stream.node, data, position);
+          }
+          else {
+            writtenBytes = await stream.handle.write(data, {at: position});
+          }
+          stream.node.size = Math.max(stream.node.size, position + writtenBytes);
+          return writtenBytes;
+        });
       },
 
       llseek: async function (stream, offset, whence) {
@@ -377,15 +931,7 @@ mergeInto(LibraryManager.library, {
           position += stream.position;
         } else if (whence === {{{ cDefine('SEEK_END') }}}) {
           if (PThreadFS.isFile(stream.node.mode)) {
-            if (ENVIRONMENT_IS_WEB) {
-              // On the main thread, file blobs are used to determine a file's
-              // size.
-              let file_blob = await stream.handle.getFile();
-              position += file_blob.size;
-            }
-            else {
-              position += await stream.handle.getSize();
-            }
+            position += stream.node.size;
           }
         } 
 
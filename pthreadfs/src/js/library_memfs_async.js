@@ -73,11 +73,9 @@ mergeInto(LibraryManager.library, {
       } else if (PThreadFS.isFile(node.mode)) {
         node.node_ops = MEMFS_ASYNC.ops_table.file.node;
         node.stream_ops = MEMFS_ASYNC.ops_table.file.stream;
-        node.usedBytes = 0; // The actual number of bytes used in the typed array, as opposed to contents.length which gives the whole capacity.
-        // When the byte data of the file is populated, this will point to either a typed array, or a normal JS array. Typed arrays are preferred
-        // for performance, and used by default. However, typed arrays are not resizable like normal JS arrays are, so there is a small disk size
-        // penalty involved for appending file writes that continuously grow a file similar to std::vector capacity vs used -scheme.
-        node.contents = null; 
+        node.usedBytes = 0; // The size of the file.
+        // The chunks holding the byte data of the file, see CHUNK_SIZE.
+        node.contents = [];
       } else if (PThreadFS.isLink(node.mode)) {
         node.node_ops = MEMFS_ASYNC.ops_table.link.node;
         node.stream_ops = MEMFS_ASYNC.ops_table.link.stream;
@@ -94,50 +92,81 @@ mergeInto(LibraryManager.library, {
       return node;
     },
 
-    // Given a file node, returns its file data converted to a typed array.
+    // File data is stored in chunks of up to CHUNK_SIZE bytes, so that files
+    // grow without copying their data. Entry i of node.contents holds the bytes
+    // from i * CHUNK_SIZE on. An entry may be shorter than CHUNK_SIZE, or
+    // missing for a hole in a sparse file; the bytes it does not cover are
+    // zero.
+    CHUNK_SIZE: 64 * 1024,
+
+    // Given a file node, returns its file data as a typed array. This is a view
+    // of the file data if it is stored in a single chunk.
     getFileDataAsTypedArray: function(node) {
-      if (!node.contents) return new Uint8Array(0);
-      if (node.contents.subarray) return node.contents.subarray(0, node.usedBytes); // Make sure to not return excess unused bytes.
-      return new Uint8Array(node.contents);
+      var first = node.contents[0];
+      if (node.contents.length == 1 && first && first.length >= node.usedBytes) {
+        return first.subarray(0, node.usedBytes);
+      }
+      var data = new Uint8Array(node.usedBytes);
+      MEMFS_ASYNC.readFileData(node, data, 0, node.usedBytes, 0);
+      return data;
     },
 
-    // Allocates a new backing store for the given node so that it can fit at least newSize amount of bytes.
-    // May allocate more, to provide automatic geometric increase and amortized linear performance appending writes.
-    // Never shrinks the storage.
-    expandFileStorage: function(node, newCapacity) {
-#if CAN_ADDRESS_2GB
-      newCapacity >>>= 0;
-#endif
-      var prevCapacity = node.contents ? node.contents.length : 0;
-      if (prevCapacity >= newCapacity) return; // No need to expand, the storage was already large enough.
-      // Don't expand strictly to the given requested limit if it's only a very small increase, but instead geometrically grow capacity.
-      // For small filesizes (<1MB), perform size*2 geometric increase, but for large sizes, do a much more conservative size*1.125 increase to
-      // avoid overshooting the allocation cap by a very large margin.
-      var CAPACITY_DOUBLING_MAX = 1024 * 1024;
-      newCapacity = Math.max(newCapacity, (prevCapacity * (prevCapacity < CAPACITY_DOUBLING_MAX ? 2.0 : 1.125)) >>> 0);
-      if (prevCapacity != 0) newCapacity = Math.max(newCapacity, 256); // At minimum allocate 256b for each file when expanding.
-      var oldContents = node.contents;
-      node.contents = new Uint8Array(newCapacity); // Allocate new storage.
-      if (node.usedBytes > 0) node.contents.set(oldContents.subarray(0, node.usedBytes), 0); // Copy old data over to the new storage.
+    // Makes the given typed array the data of a file, without copying it.
+    setFileData: function(node, data) {
+      node.contents = [];
+      for (var start = 0; start < data.length; start += MEMFS_ASYNC.CHUNK_SIZE) {
+        node.contents.push(data.subarray(start, start + MEMFS_ASYNC.CHUNK_SIZE));
+      }
+      node.usedBytes = data.length;
+    },
+
+    // Returns the chunk with the given index, grown to at least minLength
+    // bytes. Chunks grow geometrically for amortized linear performance of
+    // appending writes, which copies at most CHUNK_SIZE bytes at a time.
+    getChunk: function(node, index, minLength) {
+      var chunk = node.contents[index];
+      if (chunk && chunk.length >= minLength) return chunk;
+      var prevLength = chunk ? chunk.length : 0;
+      var grown = new Uint8Array(Math.min(MEMFS_ASYNC.CHUNK_SIZE, Math.max(minLength, prevLength * 2, 256)));
+      if (chunk) grown.set(chunk);
+      node.contents[index] = grown;
+      return grown;
+    },
+
+    // Copies `length` bytes of file data from `position` on to the typed array
+    // `buffer` at `offset`.
+    readFileData: function(node, buffer, offset, length, position) {
+      var done = 0;
+      while (done < length) {
+        var index = Math.floor((position + done) / MEMFS_ASYNC.CHUNK_SIZE);
+        var start = position + done - index * MEMFS_ASYNC.CHUNK_SIZE;
+        var count = Math.min(MEMFS_ASYNC.CHUNK_SIZE - start, length - done);
+        var chunk = node.contents[index];
+        var available = chunk ? Math.max(0, Math.min(count, chunk.length - start)) : 0;
+        if (available) buffer.set(chunk.subarray(start, start + available), offset + done);
+        if (available < count) buffer.fill(0, offset + done + available, offset + done + count);
+        done += count;
+      }
     },
 
-    // Performs an exact resize of the backing file storage to the given size, if the size is not exactly this, the storage is fully reallocated.
+    // Sets the size of a file. Growing a file leaves a hole, which does not
+    // take up memory until it is written to.
     resizeFileStorage: function(node, newSize) {
 #if CAN_ADDRESS_2GB
       newSize >>>= 0;
 #endif
       if (node.usedBytes == newSize) return;
-      if (newSize == 0) {
-        node.contents = null; // Fully decommit when requesting a resize to zero.
-        node.usedBytes = 0;
-      } else {
-        var oldContents = node.contents;
-        node.contents = new Uint8Array(newSize); // Allocate new storage.
-        if (oldContents) {
-          node.contents.set(oldContents.subarray(0, Math.min(newSize, node.usedBytes))); // Copy old data over to the new storage.
+      if (newSize < node.usedBytes) {
+        var count = Math.ceil(newSize / MEMFS_ASYNC.CHUNK_SIZE);
+        node.contents.length = count; // Fully decommit the chunks past the end.
+        var lastLength = newSize - (count - 1) * MEMFS_ASYNC.CHUNK_SIZE;
+        var last = node.contents[count - 1];
+        if (last && last.length > lastLength) {
+          // The bytes past the end must read as zeros if the file grows again.
+          node.contents[count - 1] = last.subarray(0, lastLength);
         }
-        node.usedBytes = newSize;
       }
+      node.usedBytes = newSize;
     },
 
     node_ops: {
@@ -244,17 +273,12 @@ mergeInto(LibraryManager.library, {
     },
     stream_ops: {
       read: function(stream, buffer, offset, length, position) {
-        var contents = stream.node.contents;
         if (position >= stream.node.usedBytes) return 0;
         var size = Math.min(stream.node.usedBytes - position, length);
 #if ASSERTIONS
         assert(size >= 0);
 #endif
-        if (size > 8 && contents.subarray) { // non-trivial, and typed array
-          buffer.set(contents.subarray(position, position + size), offset);
-        } else {
-          for (var i = 0; i < size; i++) buffer[offset + i] = contents[position + i];
-        }
+        MEMFS_ASYNC.readFileData(stream.node, buffer, offset, size, position);
         return size;
       },
 
@@ -264,7 +288,7 @@ mergeInto(LibraryManager.library, {
       //         canOwn=true will not take ownership of the portion outside the bytes addressed by the view. This means that
       //         with canOwn=true, creating a copy of the bytes is avoided, but the caller shouldn't touch the passed in range
       //         of bytes anymore since their contents now represent file data inside the filesystem.
-      write: function(stream, buffer, offset, length, position, canOwn) {
+      write: function(stream, buffer, offset, length, position, canOwn, append) {
 #if ASSERTIONS
         // The data buffer should be a typed array view
         assert(!(buffer instanceof ArrayBuffer));
@@ -279,37 +303,32 @@ mergeInto(LibraryManager.library, {
         }
 #endif // ALLOW_MEMORY_GROWTH
 
+        if (append) {
+          position = stream.position = stream.node.usedBytes;
+        }
         if (!length) return 0;
         var node = stream.node;
         node.timestamp = Date.now();
 
-        if (buffer.subarray && (!node.contents || node.contents.subarray)) { // This write is from a typed array to a typed array?
-          if (canOwn) {
+        if (!buffer.subarray) { // The source data did not come as a typed array.
+          buffer = new Uint8Array(buffer);
+        }
+        if (canOwn) {
 #if ASSERTIONS
-            assert(position === 0, 'canOwn must imply no weird position inside the file');
+          assert(position === 0, 'canOwn must imply no weird position inside the file');
 #endif
-            node.contents = buffer.subarray(offset, offset + length);
-            node.usedBytes = length;
-            return length;
-          } else if (node.usedBytes === 0 && position === 0) { // If this is a simple first write to an empty file, do a fast set since we don't need to care about old data.
-            node.contents = buffer.slice(offset, offset + length);
-            node.usedBytes = length;
-            return length;
-          } else if (position + length <= node.usedBytes) { // Writing to an already allocated and used subrange of the file?
-            node.contents.set(buffer.subarray(offset, offset + length), position);
-            return length;
-          }
+          MEMFS_ASYNC.setFileData(node, buffer.subarray(offset, offset + length));
+          return length;
         }
 
-        // Appending to an existing file and we need to reallocate, or source data did not come as a typed array.
-        MEMFS_ASYNC.expandFileStorage(node, position+length);
-        if (node.contents.subarray && buffer.subarray) {
-          // Use typed array write which is available.
-          node.contents.set(buffer.subarray(offset, offset + length), position);
-        } else {
-          for (var i = 0; i < length; i++) {
-           node.contents[position + i] = buffer[offset + i]; // Or fall back to manual write if not.
-          }
+        var done = 0;
+        while (done < length) {
+          var index = Math.floor((position + done) / MEMFS_ASYNC.CHUNK_SIZE);
+          var start = position + done - index * MEMFS_ASYNC.CHUNK_SIZE;
+          var count = Math.min(MEMFS_ASYNC.CHUNK_SIZE - start, length - done);
+          var chunk = MEMFS_ASYNC.getChunk(node, index, start + count);
+          chunk.set(buffer.subarray(offset + done, offset + done + count), start);
+          done += count;
         }
         node.usedBytes = Math.max(node.usedBytes, position + length);
         return length;
@@ -330,7 +349,7 @@ mergeInto(LibraryManager.library, {
         return position;
       },
       allocate: function(stream, offset, length) {
-        MEMFS_ASYNC.expandFileStorage(stream.node, offset + length);
+        // Holes read as zeros, so only the size needs to change.
         stream.node.usedBytes = Math.max(stream.node.usedBytes, offset + length);
       },
       mmap: function(stream, address, length, position, prot, flags) {
@@ -343,22 +362,16 @@ mergeInto(LibraryManager.library, {
         }
         var ptr;
         var allocated;
-        var contents = stream.node.contents;
+        var index = Math.floor(position / MEMFS_ASYNC.CHUNK_SIZE);
+        var start = position - index * MEMFS_ASYNC.CHUNK_SIZE;
+        var chunk = stream.node.contents[index];
         // Only make a new copy when MAP_PRIVATE is specified.
-        if (!(flags & {{{ cDefine('MAP_PRIVATE') }}}) && contents.buffer === buffer) {
+        if (!(flags & {{{ cDefine('MAP_PRIVATE') }}}) && chunk && chunk.buffer === buffer && start + length <= chunk.length) {
           // We can't emulate MAP_SHARED when the file is not backed by the buffer
           // we're mapping to (e.g. the HEAP buffer).
           allocated = false;
-          ptr = contents.byteOffset;
+          ptr = chunk.byteOffset + start;
         } else {
-          // Try to avoid unnecessary slices.
-          if (position > 0 || position + length < contents.length) {
-            if (contents.subarray) {
-              contents = contents.subarray(position, position + length);
-            } else {
-              contents = Array.prototype.slice.call(contents, position, position + length);
-            }
-          }
           allocated = true;
           ptr = mmapAlloc(length);
           if (!ptr) {
@@ -367,7 +380,7 @@ mergeInto(LibraryManager.library, {
 #if CAN_ADDRESS_2GB
           ptr >>>= 0;
 #endif
-          HEAP8.set(contents, ptr);
+          MEMFS_ASYNC.stream_ops.read(stream, HEAP8, ptr, length, position);
         }
         return { ptr: ptr, allocated: allocated };
       },
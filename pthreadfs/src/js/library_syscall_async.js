@@ -168,26 +168,80 @@ var SyscallsLibrary = {
       }
       return 0;
     },
-    doReadv: async function(stream, iov, iovcnt, offset) {
-      var ret = 0;
+    // Buffers that are not adjacent in memory are copied into a single buffer
+    // of up to this many bytes, so that they are read or written at once.
+    GATHER_LIMIT: 64 * 1024,
+    // Returns the buffers of an iovec array as [ptr, len] pairs, with buffers
+    // that are adjacent in memory merged.
+    getIovecRuns: function(iov, iovcnt) {
+      var runs = [];
       for (var i = 0; i < iovcnt; i++) {
         var ptr = {{{ makeGetValue('iov', 'i*8', 'i32') }}};
         var len = {{{ makeGetValue('iov', 'i*8 + 4', 'i32') }}};
+        if (len == 0) continue;
+        var last = runs[runs.length - 1];
+        if (last && last[0] + last[1] == ptr) {
+          last[1] += len;
+        } else {
+          runs.push([ptr, len]);
+        }
+      }
+      return runs;
+    },
+    getRunsLength: function(runs) {
+      var total = 0;
+      for (var i = 0; i < runs.length; i++) {
+        total += runs[i][1];
+      }
+      return total;
+    },
+    doReadv: async function(stream, iov, iovcnt, offset) {
+      var runs = ASYNCSYSCALLS.getIovecRuns(iov, iovcnt);
+      var total = ASYNCSYSCALLS.getRunsLength(runs);
+      if (runs.length > 1 && total <= ASYNCSYSCALLS.GATHER_LIMIT) {
+        var buffer = new Uint8Array(total);
+        var ret = await PThreadFS.read(stream, buffer, 0, total, offset);
+        if (ret < 0) return -1;
+        var pos = 0;
+        for (var i = 0; i < runs.length && pos < ret; i++) {
+          var len = Math.min(runs[i][1], ret - pos);
+          HEAPU8.set(buffer.subarray(pos, pos + len), runs[i][0]);
+          pos += len;
+        }
+        return ret;
+      }
+      var ret = 0;
+      for (var i = 0; i < runs.length; i++) {
+        var ptr = runs[i][0];
+        var len = runs[i][1];
         var curr = await PThreadFS.read(stream, {{{ heapAndOffset('HEAP8', 'ptr') }}}, len, offset);
         if (curr < 0) return -1;
         ret += curr;
         if (curr < len) break; // nothing more to read
+        if (offset !== undefined) offset += curr;
       }
       return ret;
     },
     doWritev: async function(stream, iov, iovcnt, offset) {
+      var runs = ASYNCSYSCALLS.getIovecRuns(iov, iovcnt);
+      var total = ASYNCSYSCALLS.getRunsLength(runs);
+      if (runs.length > 1 && total <= ASYNCSYSCALLS.GATHER_LIMIT) {
+        var buffer = new Uint8Array(total);
+        var pos = 0;
+        for (var i = 0; i < runs.length; i++) {
+          buffer.set(HEAPU8.subarray(runs[i][0], runs[i][0] + runs[i][1]), pos);
+          pos += runs[i][1];
+        }
+        return await PThreadFS.write(stream, buffer, 0, total, offset);
+      }
       var ret = 0;
-      for (var i = 0; i < iovcnt; i++) {
-        var ptr = {{{ makeGetValue('iov', 'i*8', 'i32') }}};
-        var len = {{{ makeGetValue('iov', 'i*8 + 4', 'i32') }}};
+      for (var i = 0; i < runs.length; i++) {
+        var ptr = runs[i][0];
+        var len = runs[i][1];
         var curr = await PThreadFS.write(stream, {{{ heapAndOffset('HEAP8', 'ptr') }}}, len, offset);
         if (curr < 0) return -1;
         ret += curr;
+        if (offset !== undefined) offset += curr;
       }
       return ret;
     },
@@ -497,8 +551,10 @@ var SyscallsLibrary = {
     },
     fdatasync_async : async function(fd) {
       var stream = await ASYNCSYSCALLS.getStreamFromFD(fd);
-      //TODO(rstz): Consider implementing this, since Storage Foundation supports flush().
-      return 0; 
+      if (stream.stream_ops && stream.stream_ops.fsync) {
+        return await stream.stream_ops.fsync(stream);
+      }
+      return 0;
     },
     poll_async : async function(fds, nfds, timeout) {
       var nonzero = 0;
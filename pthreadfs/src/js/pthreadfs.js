@@ -52,10 +52,10 @@ function createWasiWrapper(name, args, wrappers) {
   if (args.length > 0) {
     full_args = full_args + ',' + args.join(',');
   }
-  let full_args_with_resume = full_args + ',resume';
+  let full_args_with_resume = full_args + ',call,resume';
   let wrapper = `function(${full_args_with_resume}) {`;
   wrapper += `_fd_${name}_async(${full_args}).then((res) => {`;
-  wrapper += 'wasmTable.get(resume)(res);});}'
+  wrapper += 'wasmTable.get(resume)(call, res);});}'
   wrappers[`__fd_${name}_async`] = eval('(' + wrapper + ')');
   // Additional backends must register a dependency here.
   wrappers[`__fd_${name}_async__deps`] = [`fd_${name}_async`, '$ASYNCSYSCALLS', '$FSAFS'];
@@ -63,14 +63,14 @@ function createWasiWrapper(name, args, wrappers) {
 
 function createSyscallWrapper(name, args, wrappers) {
   let full_args = '';
-  let full_args_with_resume = 'resume';
+  let full_args_with_resume = 'call, resume';
   if (args.length > 0) {
     full_args = args.join(',');
-    full_args_with_resume = full_args + ', resume';
+    full_args_with_resume = full_args + ', call, resume';
   }
   let wrapper = `function(${full_args_with_resume}) {`;
   wrapper += `_${name}_async(${full_args}).then((res) => {`;
-  wrapper += 'wasmTable.get(resume)(res);});}'
+  wrapper += 'wasmTable.get(resume)(call, res);});}'
   wrappers[`__sys_${name}_async`] = eval('(' + wrapper + ')');
   // Additional backends must register a dependency here.
   wrappers[`__sys_${name}_async__deps`] = [`${name}_async`, '$ASYNCSYSCALLS', '$FSAFS'];
@@ -84,13 +84,13 @@ for (x of SyscallsFunctions) {
 }
 
 SyscallWrappers['utime_sync'] =
-  function(folder_ref, resume) {
+  function(folder_ref, call, resume) {
   let folder = UTF8ToString(folder_ref);
 
   PThreadFS.init(folder).then(async () => {
     // Load packaged data added during --pre-js.
     await PThreadFS.loadAvailablePackages();
-    wasmTable.get(resume)();
+    wasmTable.get(resume)(call);
   });
 }
 
@@ -111,7 +111,7 @@ SyscallWrappers['utime_sync'] = function(path, times) {
   return setFileTime(path, time);
 };
 
-SyscallWrappers['utime_async'] = function(path, times, resume) {
+SyscallWrappers['utime_async'] = function(path, times, call, resume) {
   var time;
   if (times) {
     // NOTE: We don't keep track of access timestamps.
@@ -122,23 +122,23 @@ SyscallWrappers['utime_async'] = function(path, times, resume) {
   path = UTF8ToString(path);
   try {
     PThreadFS.utime(path, time, time).then(() => {
-      wasmTable.get(resume)(0);
+      wasmTable.get(resume)(call, 0);
     });
   } catch (e) {
     if (!(e instanceof PThreadFS.ErrnoError)) throw e + ' : ' + stackTrace();
     setErrNo(e.errno);
-    wasmTable.get(resume)(-1);
+    wasmTable.get(resume)(call, -1);
   }
 };
 
 SyscallWrappers['pthreadfs_init'] =
-  function(folder_ref, resume) {
+  function(folder_ref, call, resume) {
   let folder = UTF8ToString(folder_ref);
 
   PThreadFS.init(folder).then(async () => {
     // Load packaged data added during --pre-js.
     await PThreadFS.loadAvailablePackages();
-    wasmTable.get(resume)();
+    wasmTable.get(resume)(call);
   });
 }
 
@@ -1661,6 +1661,9 @@ FS.staticInit();` +
           // WARNING: Can't read binary files in V8's d8 or tracemonkey's js, as
           //          read() will try to parse UTF8.
           obj.contents = intArrayFromString(read_(obj.url), true);
+          if (obj.urlRange) {
+            obj.contents = obj.contents.slice(obj.urlRange[0], obj.urlRange[1]);
+          }
           obj.usedBytes = obj.contents.length;
         } catch (e) {
           throw new FS.ErrnoError({{{ cDefine('EIO') }}});
@@ -1672,7 +1675,11 @@ FS.staticInit();` +
     // Creates a file record for lazy-loading from a URL. XXX This requires a synchronous
     // XHR, which is not possible in browsers except in a web worker! Use preloading,
     // either --preload-file in emcc or FS.createPreloadedFile
-    createLazyFile: function(parent, name, url, canRead, canWrite) {
+    // If start and end are given, the file is only that byte range of the URL
+    // (which is how the file packager's lazy mode uses it).
+    createLazyFile: function(parent, name, url, canRead, canWrite, start, end) {
+      var hasRange = end !== undefined;
+      start = start || 0;
       // Lazy chunked Uint8Array (implements get and length from Uint8Array). Actual getting is abstracted away for eventual reuse.
       /** @constructor */
       function LazyUint8Array() {
@@ -1691,15 +1698,22 @@ FS.staticInit();` +
         this.getter = getter;
       };
       LazyUint8Array.prototype.cacheLength = function LazyUint8Array_cacheLength() {
-        // Find length
-        var xhr = new XMLHttpRequest();
-        xhr.open('HEAD', url, false);
-        xhr.send(null);
-        if (!(xhr.status >= 200 && xhr.status < 300 || xhr.status === 304)) throw new Error("Couldn't load " + url + ". Status: " + xhr.status);
-        var datalength = Number(xhr.getResponseHeader("Content-length"));
-        var header;
-        var hasByteServing = (header = xhr.getResponseHeader("Accept-Ranges")) && header === "bytes";
-        var usesGzip = (header = xhr.getResponseHeader("Content-Encoding")) && header === "gzip";
+        if (hasRange) {
+          // The length is known, and ranges are required anyhow
+          var datalength = end - start;
+          var hasByteServing = true;
+          var usesGzip = false;
+        } else {
+          // Find length
+          var xhr = new XMLHttpRequest();
+          xhr.open('HEAD', url, false);
+          xhr.send(null);
+          if (!(xhr.status >= 200 && xhr.status < 300 || xhr.status === 304)) throw new Error("Couldn't load " + url + ". Status: " + xhr.status);
+          var datalength = Number(xhr.getResponseHeader("Content-length"));
+          var header;
+          var hasByteServing = (header = xhr.getResponseHeader("Accept-Ranges")) && header === "bytes";
+          var usesGzip = (header = xhr.getResponseHeader("Content-Encoding")) && header === "gzip";
+        }
 
 #if SMALL_XHR_CHUNKS
         var chunkSize = 1024; // Chunk size in bytes
@@ -1717,7 +1731,7 @@ FS.staticInit();` +
           // TODO: Use mozResponseArrayBuffer, responseStream, etc. if available.
           var xhr = new XMLHttpRequest();
           xhr.open('GET', url, false);
-          if (datalength !== chunkSize) xhr.setRequestHeader("Range", "bytes=" + from + "-" + to);
+          if (datalength !== chunkSize || hasRange) xhr.setRequestHeader("Range", "bytes=" + (start + from) + "-" + (start + to));
 
           // Some hints to the browser that we want binary data.
           if (typeof Uint8Array != 'undefined') xhr.responseType = 'arraybuffer';
@@ -1728,7 +1742,10 @@ FS.staticInit();` +
           xhr.send(null);
           if (!(xhr.status >= 200 && xhr.status < 300 || xhr.status === 304)) throw new Error("Couldn't load " + url + ". Status: " + xhr.status);
           if (xhr.response !== undefined) {
-            return new Uint8Array(/** @type{Array<number>} */(xhr.response || []));
+            var data = new Uint8Array(/** @type{Array<number>} */(xhr.response || []));
+            // The server may have ignored the range and sent everything
+            if (hasRange && xhr.status !== 206) data = data.subarray(start + from, start + to + 1);
+            return data;
           } else {
             return intArrayFromString(xhr.responseText || '', true);
           }
@@ -1745,7 +1762,7 @@ FS.staticInit();` +
           return lazyArray.chunks[chunkNum];
         });
 
-        if (usesGzip || !datalength) {
+        if (usesGzip || (!datalength && !hasRange)) {
           // if the server uses gzip or doesn't supply the length, we have to download the whole file to get the (uncompressed) length
           chunkSize = datalength = 1; // this will force getter(0)/doXHR do download the whole file
           datalength = this.getter(0).length;
@@ -1782,6 +1799,7 @@ FS.staticInit();` +
         var properties = { isDevice: false, contents: lazyArray };
       } else {
         var properties = { isDevice: false, url: url };
+        if (hasRange) properties.urlRange = [start, end];
       }
 
       var node = FS.createFile(parent, name, properties, canRead, canWrite);
@@ -1793,6 +1811,7 @@ FS.staticInit();` +
       } else if (properties.url) {
         node.contents = null;
         node.url = properties.url;
+        node.urlRange = properties.urlRange;
       }
       // Add a function that defers querying the file size until it is asked the first time.
       Object.defineProperties(node, {
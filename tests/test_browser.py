@@ -540,6 +540,12 @@ If manually bisecting:
     self.run_browser('page.html', 'You should see |load me right before|.', '/report_result?1')
     self.run_browser('page.html', 'You should see |load me right before|.', '/report_result?2')
 
+    # with --chunk-size, the package is cached in content-addressed chunks
+    self.run_process([FILE_PACKAGER, 'somefile.data', '--use-preload-cache', '--indexedDB-name=testdb_chunked', '--chunk-size=16', '--preload', 'somefile.txt', '--js-output=' + 'somefile.js'])
+    self.compile_btest(['main.cpp', '--js-library', 'test.js', '--pre-js', 'somefile.js', '-o', 'page.html', '-s', 'FORCE_FILESYSTEM'])
+    self.run_browser('page.html', 'You should see |load me right before|.', '/report_result?1')
+    self.run_browser('page.html', 'You should see |load me right before|.', '/report_result?2')
+
   def test_multifile(self):
     # a few files inside a directory
     ensure_dir('subdirr/moar')
@@ -17,6 +17,7 @@ import re
 import select
 import shlex
 import shutil
+import struct
 import subprocess
 import sys
 import time
@@ -2142,6 +2143,19 @@ int f() {
     actual = read_file(name + '.js.jsopt.js')
     self.assertIdentical(expected, actual)
 
+  def test_js_optimizer_chunkify_balanced(self):
+    from tools import js_optimizer
+    # one huge function and many small ones: the huge function should get a
+    # chunk of its own, and the small ones should be spread evenly on the rest
+    funcs = [('big', 'function big(){%s}' % ('x' * 10000))]
+    funcs += [('f%d' % i, 'function f%d(){%s}' % (i, 'x' * (i % 50))) for i in range(300)]
+    chunks = js_optimizer.chunkify_balanced(funcs, 4)
+    self.assertEqual(len(chunks), 4)
+    self.assertEqual(sum(len(c) for c in chunks), len(funcs))
+    self.assertEqual(chunks[0], [funcs[0][1]])
+    sizes = [js_optimizer.chunk_size_of(c) for c in chunks[1:]]
+    self.assertLess(max(sizes) - min(sizes), 60)
+
   def test_m_mm(self):
     create_file('foo.c', '#include <emscripten.h>')
     for opt in ['M', 'MM']:
@@ -2460,8 +2474,155 @@ int f() {
     assert metadata['files'][1]['start'] == len('data1') and metadata['files'][1]['end'] == len('data1') + len('data2') and metadata['files'][1]['filename'] == '/subdir/data2.txt'
     assert metadata['remote_package_size'] == len('data1') + len('data2')
 
-    # can only assert the uuid format is correct, the uuid's value is expected to differ in between invocation
+    # the uuid is derived from the package contents
     uuid.UUID(metadata['package_uuid'], version=4)
+    create_file('data1.txt', 'data3')
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'data1.txt', '--preload', 'subdir/data2.txt', '--js-output=immutable.js', '--separate-metadata'])
+    self.assertNotEqual(metadata['package_uuid'], json.loads(read_file('immutable.js.metadata'))['package_uuid'])
+
+  def test_file_packager_manifest(self):
+    ensure_dir('subdir')
+    create_file('data1.txt', 'data1')
+    create_file('subdir/data2.txt', 'data2')
+    cmd = [FILE_PACKAGER, 'test.data', '--preload', 'data1.txt', 'subdir', '--manifest=test.manifest', '--js-output=test.js']
+    self.run_process(cmd)
+    manifest = json.loads(read_file('test.manifest'))
+    self.assertEqual([f['dstpath'] for f in manifest['files']], ['/data1.txt', '/subdir/data2.txt'])
+    orig_timestamp = os.path.getmtime('test.data')
+    orig_js = read_file('test.js')
+
+    # nothing changed: the data file is left alone and the package uuid is stable
+    time.sleep(1.0)
+    self.run_process(cmd)
+    self.assertEqual(orig_timestamp, os.path.getmtime('test.data'))
+    self.assertTextDataIdentical(orig_js, read_file('test.js'))
+
+    # a changed file is rewritten, and the result matches a fresh build
+    create_file('subdir/data2.txt', 'data2 changed')
+    self.run_process(cmd)
+    self.assertEqual(read_binary('test.data'), b'data1data2 changed')
+    self.assertNotEqual(orig_js, read_file('test.js'))
+    self.run_process([FILE_PACKAGER, 'fresh.data', '--preload', 'data1.txt', 'subdir', '--js-output=fresh.js'])
+    self.assertEqual(read_binary('test.data'), read_binary('fresh.data'))
+
+  def test_file_packager_duplicates(self):
+    ensure_dir('subdir')
+    create_file('data1.txt', 'data1')
+    create_file('subdir/copy.txt', 'data1')
+    create_file('subdir/data2.txt', 'data2')
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'data1.txt', 'subdir', '--js-output=test.js', '--separate-metadata'])
+    # identical files are stored once, and share their range
+    self.assertEqual(read_binary('test.data'), b'data1data2')
+    files = {f['filename']: (f['start'], f['end']) for f in json.loads(read_file('test.js.metadata'))['files']}
+    self.assertEqual(files['/data1.txt'], files['/subdir/copy.txt'])
+    self.assertEqual(files['/subdir/data2.txt'], (5, 10))
+
+    # writing to one of them does not affect the other
+    create_file('main.c', r'''
+      #include <stdio.h>
+      int main() {
+        FILE *f = fopen("subdir/copy.txt", "r+");
+        fwrite("DATA", 1, 4, f);
+        fclose(f);
+        char buf[6] = {0};
+        f = fopen("data1.txt", "r");
+        fread(buf, 1, 5, f);
+        fclose(f);
+        printf("|%s|\n", buf);
+        return 0;
+      }
+    ''')
+    self.run_process([EMCC, 'main.c', '--preload-file', 'data1.txt', '--preload-file', 'subdir'])
+    self.assertContained('|data1|', self.run_js('a.out.js', engine=config.NODE_JS))
+
+  def test_file_packager_chunk_size(self):
+    create_file('data.txt', 'a' * 1000 + 'b' * 1000 + 'a' * 500)
+    err = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'data.txt', '--chunk-size=1000'])
+    self.assertContained('--chunk-size must be positive, and requires --use-preload-cache', err)
+    err = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'data.txt', '--use-preload-cache', '--chunk-size=1k'])
+    self.assertContained('--chunk-size requires a number of bytes', err)
+
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'data.txt', '--use-preload-cache', '--chunk-size=1000', '--js-output=test.js', '--separate-metadata'])
+    metadata = json.loads(read_file('test.js.metadata'))
+    self.assertEqual(metadata['chunk_size'], 1000)
+    # chunks are addressed by their content
+    chunks = metadata['chunks']
+    self.assertEqual(len(chunks), 3)
+    self.assertNotEqual(chunks[0], chunks[1])
+    self.assertNotEqual(chunks[0], chunks[2])
+    create_file('data.txt', 'a' * 1000 + 'b' * 1000 + 'a' * 1000)
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'data.txt', '--use-preload-cache', '--chunk-size=1000', '--js-output=test.js', '--separate-metadata'])
+    new_chunks = json.loads(read_file('test.js.metadata'))['chunks']
+    self.assertEqual(new_chunks[:2], chunks[:2])
+    self.assertEqual(new_chunks[2], chunks[0])
+
+  def test_file_packager_lazy(self):
+    ensure_dir('subdir')
+    create_file('big.txt', 'big')
+    create_file('subdir/config.txt', 'config')
+    err = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'big.txt', '--prefetch', '/subdir/*'])
+    self.assertContained('--prefetch requires --lazy', err)
+    err = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'big.txt', '--lazy', '--lz4'])
+    self.assertContained('--lazy is incompatible with', err)
+
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'big.txt', 'subdir', '--lazy', '--prefetch', '/subdir/*', '--js-output=test.js', '--separate-metadata'])
+    self.assertContained("Module['FS_createLazyFile']", read_file('test.js'))
+    metadata = json.loads(read_file('test.js.metadata'))
+    # prefetched files are moved to the start of the package
+    self.assertEqual(metadata['files'][0]['filename'], '/subdir/config.txt')
+    self.assertEqual(metadata['prefetch_size'], len('config'))
+    self.assertEqual(read_file('test.data'), 'configbig')
+
+  def test_file_packager_binary_metadata(self):
+    ensure_dir('subdir')
+    create_file('data1.txt', 'data1')
+    create_file('subdir/data2☃.ogg', 'data2')
+    err = self.expect_fail([FILE_PACKAGER, 'test.data', '--preload', 'data1.txt', '--binary-metadata'])
+    self.assertContained('--binary-metadata requires --separate-metadata', err)
+
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'data1.txt', 'subdir', '--js-output=json.js', '--separate-metadata'])
+    self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'data1.txt', 'subdir', '--js-output=binary.js', '--separate-metadata', '--binary-metadata'])
+    self.assertContained('decodeMetadata(xhr.response)', read_file('binary.js'))
+    expected = json.loads(read_file('json.js.metadata'))
+
+    # decode the format documented in encode_binary_metadata
+    data = read_binary('binary.js.metadata')
+    magic, version, count, extra_size = struct.unpack_from('<4I', data)
+    self.assertEqual(magic, 0x4b504d45)
+    self.assertEqual(count, 2)
+    metadata = json.loads(data[16:16 + extra_size])
+    offset = 16 + extra_size
+    starts = struct.unpack_from('<%dI' % count, data, offset)
+    ends = struct.unpack_from('<%dI' % count, data, offset + 4 * count)
+    name_ends = struct.unpack_from('<%dI' % count, data, offset + 8 * count)
+    audio = data[offset + 12 * count:offset + 13 * count]
+    names = data[offset + 13 * count:].decode('utf-8').encode('utf-16-le')
+    metadata['files'] = []
+    name_start = 0
+    for i in range(count):
+      metadata['files'].append({
+        'filename': names[2 * name_start:2 * name_ends[i]].decode('utf-16-le'),
+        'start': starts[i],
+        'end': ends[i],
+        'audio': audio[i],
+      })
+      name_start = name_ends[i]
+    self.assertEqual(metadata, expected)
+
+  def test_file_packager_directory_tree(self):
+    for i in range(20):
+      ensure_dir('tree/dir%d/sub' % i)
+      create_file('tree/dir%d/sub/data.txt' % i, 'data')
+    out = self.run_process([FILE_PACKAGER, 'test.data', '--preload', 'tree'], stdout=PIPE, stderr=PIPE).stdout
+    # the tree is created by a single loop over a list of (parent, name) pairs
+    self.assertEqual(out.count("Module['FS_createPath']"), 1)
+    tree = json.loads(re.search(r'var dirTree = (\[.*\]);', out).group(1))
+    pairs = list(zip(tree[::2], tree[1::2]))
+    self.assertEqual(pairs[0], (-1, 'tree'))
+    self.assertEqual(len(pairs), 1 + 20 * 2)
+    for i in range(20):
+      index = pairs.index((0, 'dir%d' % i))
+      self.assertIn((index, 'sub'), pairs[index + 1:])
 
   def test_file_packager_unicode(self):
     unicode_name = 'unicode…☃'
@@ -7783,6 +7944,21 @@ end
   def test_closure_externs(self):
     self.run_process([EMCC, test_file('hello_world.c'), '--closure=1', '--pre-js', test_file('test_closure_externs_pre_js.js'), '--closure-args', '--externs "' + test_file('test_closure_externs.js') + '"'])
 
+  @with_env_modify({'EMCC_CLOSURE_CACHE': '1', 'EMCC_DEBUG': '1'})
+  def test_closure_cache(self):
+    # Use a unique pre-js so that the first link is never a cache hit
+    create_file('pre.js', 'var closureCacheTestId = "%s";' % self.id())
+    cmd = [EMCC, test_file('hello_world.c'), '-O2', '--closure=1', '--pre-js', 'pre.js']
+    err = self.run_process(cmd, stderr=PIPE).stderr
+    self.assertNotContained('closure compiler: using cached output', err)
+    expected = read_file('a.out.js')
+    err = self.run_process(cmd, stderr=PIPE).stderr
+    self.assertContained('closure compiler: using cached output', err)
+    self.assertEqual(expected, read_file('a.out.js'))
+    self.assertContained('hello, world!', self.run_js('a.out.js'))
+    # Cache entries are renamed into place, no partial files are left behind
+    self.assertEqual([], [f for f in os.listdir(shared.Cache.get_path('closure')) if f.endswith('.tmp')])
+
   # Tests that it is possible to enable the Closure compiler via --closure=1 even if any of the input files reside in a path with unicode characters.
   def test_closure_cmdline_utf8_chars(self):
     test = "☃ äö Ć € ' 🦠.c"
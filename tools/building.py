@@ -5,6 +5,7 @@
 
 from .toolchain_profiler import ToolchainProfiler
 
+import hashlib
 import json
 import logging
 import os
@@ -14,6 +15,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 from subprocess import PIPE
 
 from . import diagnostics
@@ -30,7 +32,7 @@ from .shared import asmjs_mangle, DEBUG
 from .shared import TEMP_DIR
 from .shared import CANONICAL_TEMP_DIR, LLVM_DWARFDUMP, demangle_c_symbol_name
 from .shared import get_emscripten_temp_dir, exe_suffix, is_c_symbol
-from .utils import WINDOWS
+from .utils import WINDOWS, safe_ensure_dirs
 from .settings import settings
 
 logger = logging.getLogger('building')
@@ -41,6 +43,8 @@ binaryen_checked = False
 EXPECTED_BINARYEN_VERSION = 101
 # cache results of nm - it can be slow to run
 nm_cache = {}
+# cache results of `closure --version`, which launches a full node/java process
+closure_version_cache = {}
 # Stores the object files contained in different archive files passed as input
 ar_contents = {}
 _is_ar_cache = {}
@@ -735,7 +739,13 @@ def get_closure_compiler():
   return cmd
 
 
+# Returns the `--version` output of the closure compiler, or False if it failed
+# and allowed_to_fail is set.
 def check_closure_compiler(cmd, args, env, allowed_to_fail):
+  key = tuple(cmd + args)
+  if key in closure_version_cache:
+    return closure_version_cache[key]
+
   try:
     output = run_process(cmd + args + ['--version'], stdout=PIPE, env=env).stdout
   except Exception as e:
@@ -749,7 +759,22 @@ def check_closure_compiler(cmd, args, env, allowed_to_fail):
       return False
     exit_with_error('unrecognized closure compiler --version output (%s):\n%s' % (str(cmd), output))
 
-  return True
+  closure_version_cache[key] = output
+  return output
+
+
+def get_closure_cache_key(version, args, inputs):
+  """Hashes everything that can affect the closure output: the compiler
+  version, the command line flags and the contents (not the temp file names)
+  of all JS inputs and externs."""
+  h = hashlib.sha256()
+  h.update(version.encode())
+  for arg in args:
+    h.update(arg.encode() + b'\0')
+  for filename in inputs:
+    with open(filename, 'rb') as f:
+      h.update(hashlib.sha256(f.read()).digest())
+  return h.hexdigest()
 
 
 @ToolchainProfiler.profile_block('closure_compiler')
@@ -775,11 +800,11 @@ def closure_compiler(filename, pretty, advanced=True, extra_closure_args=None):
 
   closure_cmd = get_closure_compiler()
 
-  native_closure_compiler_works = check_closure_compiler(closure_cmd, user_args, env, allowed_to_fail=True)
-  if not native_closure_compiler_works and not any(a.startswith('--platform') for a in user_args):
+  closure_version = check_closure_compiler(closure_cmd, user_args, env, allowed_to_fail=True)
+  if not closure_version and not any(a.startswith('--platform') for a in user_args):
     # Run with Java Closure compiler as a fallback if the native version does not work
     user_args.append('--platform=java')
-    check_closure_compiler(closure_cmd, user_args, env, allowed_to_fail=False)
+    closure_version = check_closure_compiler(closure_cmd, user_args, env, allowed_to_fail=False)
 
   # Closure externs file contains known symbols to be extern to the minification, Closure
   # should not minify these symbol names.
@@ -846,12 +871,21 @@ def closure_compiler(filename, pretty, advanced=True, extra_closure_args=None):
     shutil.copyfile(filename, safe_filename)
     return os.path.relpath(safe_filename, tempfiles.tmpdir)
 
+  # Flags and input files that determine the output, used for the closure cache
+  # below. The temp file names passed to closure differ on each run, so the
+  # cache key is built from the original externs instead.
+  key_args = closure_cmd + args + [str(pretty), str(settings.IGNORE_CLOSURE_COMPILER_ERRORS)]
+  key_inputs = CLOSURE_EXTERNS + [filename]
+
   for e in CLOSURE_EXTERNS:
     args += ['--externs', move_to_safe_7bit_ascii_filename(e)]
 
   for i in range(len(user_args)):
     if user_args[i] == '--externs':
+      key_inputs.append(user_args[i + 1])
       user_args[i + 1] = move_to_safe_7bit_ascii_filename(user_args[i + 1])
+    elif i == 0 or user_args[i - 1] != '--externs':
+      key_args.append(user_args[i])
 
   # Specify output file relative to the temp directory to avoid specifying non-7-bit-ASCII path names.
   args += ['--js_output_file', os.path.relpath(outfile, tempfiles.tmpdir)]
@@ -865,6 +899,17 @@ def closure_compiler(filename, pretty, advanced=True, extra_closure_args=None):
   cmd = closure_cmd + args + user_args
   logger.debug('closure compiler: ' + ' '.join(cmd))
 
+  # With EMCC_CLOSURE_CACHE=1, the output of closure is stored in the emscripten
+  # cache, so that relinking with identical JS can skip running closure.
+  cached_output = None
+  if int(os.environ.get('EMCC_CLOSURE_CACHE', '0')) and not config.FROZEN_CACHE:
+    cache_key = get_closure_cache_key(closure_version, key_args, key_inputs)
+    cached_output = shared.Cache.get_path(os.path.join('closure', cache_key + '.js'))
+    if os.path.exists(cached_output):
+      logger.debug('closure compiler: using cached output ' + cached_output)
+      shutil.copyfile(cached_output, outfile)
+      return outfile
+
   # Closure compiler does not work if any of the input files contain characters outside the
   # 7-bit ASCII range. Therefore make sure the command line we pass does not contain any such
   # input files by passing all input filenames relative to the cwd. (user temp directory might
@@ -918,6 +963,20 @@ def closure_compiler(filename, pretty, advanced=True, extra_closure_args=None):
     if settings.CLOSURE_WARNINGS == 'error':
       exit_with_error('closure compiler produced warnings and -s CLOSURE_WARNINGS=error enabled')
 
+  # Only cache clean results, so that warnings keep being reported on every
+  # link.
+  if cached_output and not proc.stderr.strip():
+    # Cache hits are read without the cache lock, so the entry is written to a
+    # temporary file first and then renamed into place, which is atomic.
+    safe_ensure_dirs(os.path.dirname(cached_output))
+    fd, temp_output = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cached_output))
+    os.close(fd)
+    try:
+      shutil.copyfile(outfile, temp_output)
+      os.replace(temp_output, cached_output)
+    finally:
+      try_delete(temp_output)
+
   return outfile
 
 
@@ -1515,13 +1574,16 @@ def run_wasm_opt(*args, **kwargs):
 
 
 save_intermediate_counter = 0
+save_intermediate_lock = threading.Lock()
 
 
 def save_intermediate(src, dst):
   if DEBUG:
     global save_intermediate_counter
-    dst = 'emcc-%d-%s' % (save_intermediate_counter, dst)
-    save_intermediate_counter += 1
+    # This is also called from emcc's helper threads, e.g. for wasm-opt.
+    with save_intermediate_lock:
+      dst = 'emcc-%d-%s' % (save_intermediate_counter, dst)
+      save_intermediate_counter += 1
     dst = os.path.join(CANONICAL_TEMP_DIR, dst)
     logger.debug('saving debug copy %s' % dst)
     shutil.copyfile(src, dst)
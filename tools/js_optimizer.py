@@ -9,6 +9,9 @@ import sys
 import subprocess
 import re
 import json
+import heapq
+import itertools
+import math
 import shutil
 
 __rootpath__ = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -30,6 +33,17 @@ ACORN_OPTIMIZER = path_from_root('tools', 'acorn-optimizer.js')
 NUM_CHUNKS_PER_CORE = 3
 MIN_CHUNK_SIZE = int(os.environ.get('EMCC_JSOPT_MIN_CHUNK_SIZE') or 512 * 1024) # configuring this is just for debugging purposes
 MAX_CHUNK_SIZE = int(os.environ.get('EMCC_JSOPT_MAX_CHUNK_SIZE') or 5 * 1024 * 1024)
+# when the throughput of a set of passes is known from previous runs, chunks are
+# made big enough to keep each optimizer process busy for at least this long, so
+# that node startup time does not dominate
+MIN_CHUNK_SECONDS = 0.5
+# per-pass throughput (bytes per second of optimizer CPU time) measured on
+# previous runs
+THROUGHPUT_CACHE = 'js_optimizer_throughput.json'
+# the recorded throughput is only updated when a run measures one that differs
+# by more than this fraction, so that most runs neither lock the cache nor write
+# to it
+THROUGHPUT_TOLERANCE = 0.25
 
 WINDOWS = sys.platform.startswith('win')
 
@@ -40,6 +54,18 @@ func_sig_json = re.compile(r'\["defun", ?"([_\w$]+)",')
 import_sig = re.compile(r'(var|const) ([_\w$]+ *=[^;]+);')
 
 
+# Yields the (start, end) offsets of the parts of js that begin with
+# 'function ', without building a copy of the whole string.
+def func_spans(js):
+  start = js.find('function ')
+  while start >= 0:
+    end = js.find('function ', start + len('function '))
+    if end < 0:
+      end = len(js)
+    yield start, end
+    start = end if end < len(js) else -1
+
+
 def split_funcs(js, just_split=False):
   if just_split:
     return [('(json)', line) for line in js.splitlines()]
@@ -47,9 +73,9 @@ def split_funcs(js, just_split=False):
   # which is important for deterministic builds (as which functions
   # are in each chunk may differ, so we need to split them up and combine
   # them all together later and sort them deterministically)
-  parts = ['function ' + part for part in js.split('function ')[1:]]
   funcs = []
-  for func in parts:
+  for start, end in func_spans(js):
+    func = js[start:end]
     m = func_sig.search(func)
     if not m:
       continue
@@ -59,6 +85,42 @@ def split_funcs(js, just_split=False):
   return funcs
 
 
+# Like split_funcs, but for an optimizer output file, and without keeping the
+# function bodies in memory. Returns a list of (size, ident, file_index, offset,
+# length) tuples, where offset and length locate the function in the file in
+# bytes. If sort is set, the list is in the same order as the final output, so
+# that the outputs of all chunks can be combined with a k-way merge.
+def index_funcs(out_file, file_index, sort):
+  with open(out_file, 'rb') as f:
+    js = f.read().decode('utf-8')
+  index = []
+  offset = 0
+  last = 0
+  for start, end in func_spans(js):
+    offset += len(js[last:start].encode('utf-8'))
+    func = js[start:end]
+    length = len(func.encode('utf-8'))
+    m = func_sig.search(func)
+    if m:
+      index.append((len(func), m.group(1), file_index, offset, length))
+    offset += length
+    last = end
+  if sort:
+    index.sort(key=func_sort_key, reverse=True)
+  return index
+
+
+# sort functions by size, to make diffing easier and to improve aot times
+def func_sort_key(entry):
+  return (entry[0], entry[1])
+
+
+def read_indexed_func(files, entry):
+  f = files[entry[2]]
+  f.seek(entry[3])
+  return f.read(entry[4]).decode('utf-8')
+
+
 class Minifier:
   """minification support. We calculate minification of
   globals here, then pass that into the parallel acorn-optimizer.js runners which
@@ -143,7 +205,69 @@ def chunkify(funcs, chunk_size):
   if curr:
     chunks.append(curr)
     curr = None
-  return [''.join(func[1] for func in chunk) for chunk in chunks] # remove function names
+  return [[func[1] for func in chunk] for chunk in chunks] # remove function names
+
+
+# Given a set of functions of form (ident, text), and a number of chunks,
+# distributes the functions so that all chunks have about the same amount of
+# work. This is longest-processing-time-first scheduling: functions are handed
+# out largest first, each to the chunk with the least work so far, which avoids
+# a single straggler chunk. The order of functions in the output is not
+# preserved, so this is only used when the output is sorted afterwards.
+@ToolchainProfiler.profile_block('chunkify_balanced')
+def chunkify_balanced(funcs, num_chunks):
+  chunks = [[] for i in range(num_chunks)]
+  loads = [(0, i) for i in range(num_chunks)]
+  for func in sorted(funcs, key=lambda x: (len(x[1]), x[0]), reverse=True):
+    load, i = heapq.heappop(loads)
+    chunks[i].append(func)
+    heapq.heappush(loads, (load + len(func[1]), i))
+  chunks = [[func[1] for func in chunk] for chunk in chunks]
+  # start the biggest chunks first
+  chunks.sort(key=chunk_size_of, reverse=True)
+  return chunks
+
+
+# Chunks are lists of function texts, which are written out one by one rather
+# than joined, to avoid another copy of all the code in memory.
+def chunk_size_of(chunk):
+  return sum(len(func) for func in chunk)
+
+
+def get_throughput_key(passes):
+  return ' '.join(passes)
+
+
+def read_throughputs():
+  try:
+    return json.loads(utils.read_file(shared.Cache.get_path(THROUGHPUT_CACHE)))
+  except (OSError, ValueError):
+    return {}
+
+
+def get_min_chunk_size(passes):
+  if os.environ.get('EMCC_JSOPT_MIN_CHUNK_SIZE'):
+    return MIN_CHUNK_SIZE
+  throughput = read_throughputs().get(get_throughput_key(passes))
+  if not throughput:
+    return MIN_CHUNK_SIZE
+  return min(MAX_CHUNK_SIZE, int(throughput * MIN_CHUNK_SECONDS))
+
+
+def record_throughput(passes, throughput):
+  if config.FROZEN_CACHE:
+    return
+  key = get_throughput_key(passes)
+  recorded = read_throughputs().get(key)
+  if recorded and abs(throughput - recorded) <= recorded * THROUGHPUT_TOLERANCE:
+    return
+  with shared.Cache.lock():
+    throughputs = read_throughputs()
+    # smooth out noise from individual runs
+    if key in throughputs:
+      throughput = (throughputs[key] + throughput) / 2
+    throughputs[key] = throughput
+    utils.write_file(shared.Cache.get_path(THROUGHPUT_CACHE), json.dumps(throughputs, indent=2, sort_keys=True))
 
 
 def run_on_js(filename, passes, extra_info=None, just_split=False, just_concat=False):
@@ -259,17 +383,22 @@ EMSCRIPTEN_FUNCS();
     # top of the file, so avoid breaking the JS into chunks
     cores = shared.get_num_cores()
 
+    sort_output = not just_concat and not os.environ.get('EMCC_NO_OPT_SORT')
+
     if not just_split:
       intended_num_chunks = int(round(cores * NUM_CHUNKS_PER_CORE))
-      chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, total_size / intended_num_chunks))
-      chunks = chunkify(funcs, chunk_size)
+      chunk_size = min(MAX_CHUNK_SIZE, max(get_min_chunk_size(passes), total_size / intended_num_chunks))
+      if sort_output and total_size:
+        chunks = chunkify_balanced(funcs, int(math.ceil(total_size / chunk_size)))
+      else:
+        chunks = chunkify(funcs, chunk_size)
     else:
       # keep same chunks as before
-      chunks = [f[1] for f in funcs]
+      chunks = [[f[1]] for f in funcs]
 
-    chunks = [chunk for chunk in chunks if len(chunk)]
+    chunks = [chunk for chunk in chunks if chunk_size_of(chunk)]
     if DEBUG and len(chunks):
-      print('chunkification: num funcs:', len(funcs), 'actual num chunks:', len(chunks), 'chunk size range:', max(map(len, chunks)), '-', min(map(len, chunks)), file=sys.stderr)
+      print('chunkification: num funcs:', len(funcs), 'actual num chunks:', len(chunks), 'chunk size range:', max(map(chunk_size_of, chunks)), '-', min(map(chunk_size_of, chunks)), file=sys.stderr)
     funcs = None
 
     if len(chunks):
@@ -282,14 +411,23 @@ EMSCRIPTEN_FUNCS();
         def write_chunk(chunk, i):
           temp_file = temp_files.get('.jsfunc_%d.js' % i).name
           with open(temp_file, 'w') as f:
-            f.write(chunk)
+            f.writelines(chunk)
             f.write(serialized_extra_info)
           return temp_file
         filenames = [write_chunk(chunks[i], i) for i in range(len(chunks))]
+        chunks = None
     else:
       filenames = []
 
   with ToolchainProfiler.profile_block('run_optimizer'):
+    # index the functions in the outputs as soon as each chunk finishes, while
+    # the other chunks are still being optimized
+    indexes = [None] * len(filenames)
+
+    def on_chunk_done(i, out_file):
+      if not just_concat:
+        indexes[i] = index_funcs(out_file, i, sort_output)
+
     if len(filenames):
       commands = [config.NODE_JS + [ACORN_OPTIMIZER, f] + passes for f in filenames]
 
@@ -300,7 +438,15 @@ EMSCRIPTEN_FUNCS();
             saved = 'input' + str(int(saved.replace('input', '').replace('.txt', '')) + 1) + '.txt'
           shutil.copyfile(filename, os.path.join(shared.get_emscripten_temp_dir(), saved))
 
-      filenames = shared.run_multiple_processes(commands, route_stdout_to_temp_files_suffix='js_opt.jo.js')
+      start_times = os.times()
+      filenames = shared.run_multiple_processes(commands, route_stdout_to_temp_files_suffix='js_opt.jo.js', on_complete=on_chunk_done)
+      end_times = os.times()
+      # the CPU time of the optimizer processes only, not of indexing their
+      # outputs here (this is 0 where the platform does not report it)
+      worker_time = (end_times.children_user + end_times.children_system -
+                     start_times.children_user - start_times.children_system)
+      if not just_split and worker_time > 0:
+        record_throughput(passes, total_size / worker_time)
 
     for filename in filenames:
       temp_files.note(filename)
@@ -361,27 +507,33 @@ EMSCRIPTEN_FUNCS();
 
   with ToolchainProfiler.profile_block('sort_or_concat'):
     if not just_concat:
-      # sort functions by size, to make diffing easier and to improve aot times
-      funcses = []
-      for out_file in filenames:
-        funcses.append(split_funcs(utils.read_file(out_file), False))
-      funcs = [item for sublist in funcses for item in sublist]
-      funcses = None
-      if not os.environ.get('EMCC_NO_OPT_SORT'):
-        funcs.sort(key=lambda x: (len(x[1]), x[0]), reverse=True)
-
-      if 'last' in passes and len(funcs):
-        count = funcs[0][1].count('\n')
-        if count > 3000:
-          print('warning: Output contains some very large functions (%s lines in %s), consider building source files with -Os or -Oz)' % (count, funcs[0][0]), file=sys.stderr)
-
-      for func in funcs:
-        f.write(func[1])
-      funcs = None
+      # each chunk's index is already sorted, so merge them rather than
+      # loading and sorting all the functions at once
+      if sort_output:
+        entries = heapq.merge(*indexes, key=func_sort_key, reverse=True)
+      else:
+        entries = itertools.chain(*indexes)
+
+      files = [open(out_file, 'rb') for out_file in filenames]
+      try:
+        first = True
+        for entry in entries:
+          func = read_indexed_func(files, entry)
+          if first and 'last' in passes:
+            count = func.count('\n')
+            if count > 3000:
+              print('warning: Output contains some very large functions (%s lines in %s), consider building source files with -Os or -Oz)' % (count, entry[1]), file=sys.stderr)
+          first = False
+          f.write(func)
+      finally:
+        for out in files:
+          out.close()
+      indexes = None
     else:
       # just concat the outputs
       for out_file in filenames:
-        f.write(utils.read_file(out_file))
+        with open(out_file) as out:
+          shutil.copyfileobj(out, f)
 
   with ToolchainProfiler.profile_block('write_post'):
     f.write('\n')
@@ -139,19 +139,39 @@ console.log = printErr;
 var lz4 = arguments_[0];
 var input = arguments_[1];
 var output = arguments_[2];
+// Optionally, only compress the byte range [start, end) of the input. This
+// lets the file packager compress a large package in parallel pieces.
+var start = arguments_[3];
+var end = arguments_[4];
 
 load(lz4);
 
-var data = readBinary(input);
+var data;
+if (start !== undefined) {
+  start = parseInt(start);
+  end = parseInt(end);
+  data = new Uint8Array(end - start);
+  var fd = nodeFS['openSync'](input, 'r');
+  var pos = 0;
+  while (pos < data.length) {
+    var bytesRead = nodeFS['readSync'](fd, data, pos, data.length - pos, start + pos);
+    assert(bytesRead > 0, 'unexpected end of input');
+    pos += bytesRead;
+  }
+  nodeFS['closeSync'](fd);
+  data = data.buffer;
+} else {
+  data = readBinary(input);
+}
 if (!(data instanceof ArrayBuffer)) {
   printErr('converting to ArrayBuffer');
   data = new Uint8Array(data).buffer;
 }
 
-var start = Date.now();
+var startTime = Date.now();
 var compressedData = MiniLZ4.compressPackage(data);
 nodeFS['writeFileSync'](output, Buffer.from(compressedData['data']));
 compressedData['data'] = null;
-printErr('compressed in ' + (Date.now() - start) + ' ms');
+printErr('compressed in ' + (Date.now() - startTime) + ' ms');
 print(JSON.stringify(compressedData));
 
@@ -133,7 +133,9 @@ def returncode_to_str(code):
 # bool 'check': If True (default), raises an exception if any of the subprocesses failed with a nonzero exit code.
 # string 'route_stdout_to_temp_files_suffix': if not None, all stdouts are instead written to files, and an array of filenames is returned.
 # bool 'pipe_stdout': If True, an array of stdouts is returned, for each subprocess.
-def run_multiple_processes(commands, env=os.environ.copy(), route_stdout_to_temp_files_suffix=None, pipe_stdout=False, check=True, cwd=None):
+# callable 'on_complete': if not None, called as on_complete(index, output) as soon as each subprocess finishes,
+#                          where output is the temp file name or stdout string that is returned for it.
+def run_multiple_processes(commands, env=os.environ.copy(), route_stdout_to_temp_files_suffix=None, pipe_stdout=False, check=True, cwd=None, on_complete=None):
   # By default, avoid using Python multiprocessing library due to a large amount of bugs it has on Windows (#8013, #718, #13785, etc.)
   # Use EM_PYTHON_MULTIPROCESSING=1 environment variable to enable it. It can be faster, but may not work on Windows.
   if int(os.getenv('EM_PYTHON_MULTIPROCESSING', '0')):
@@ -141,7 +143,11 @@ def run_multiple_processes(commands, env=os.environ.copy(), route_stdout_to_temp
     global multiprocessing_pool
     if not multiprocessing_pool:
       multiprocessing_pool = multiprocessing.Pool(processes=get_num_cores())
-    return multiprocessing_pool.map(mp_run_process, [(cmd, env, route_stdout_to_temp_files_suffix, pipe_stdout, check, cwd) for cmd in commands], chunksize=1)
+    results = multiprocessing_pool.map(mp_run_process, [(cmd, env, route_stdout_to_temp_files_suffix, pipe_stdout, check, cwd) for cmd in commands], chunksize=1)
+    if on_complete:
+      for i, result in enumerate(results):
+        on_complete(i, result)
+    return results
 
   std_outs = []
 
@@ -202,6 +208,14 @@ def run_multiple_processes(commands, env=os.environ.copy(), route_stdout_to_temp
             logger.error(err)
 
           raise Exception('Subprocess %d/%d failed (%s)! (cmdline: %s)' % (idx + 1, len(commands), returncode_to_str(finished_process.returncode), shlex_join(commands[idx])))
+        if on_complete:
+          if pipe_stdout:
+            on_complete(idx, out)
+          elif route_stdout_to_temp_files_suffix:
+            # temp files are recorded in spawn order, so idx is their position
+            on_complete(idx, std_outs[idx][1])
+          else:
+            on_complete(idx, None)
         num_completed += 1
 
   # If processes finished out of order, sort the results to the order of the input.
@@ -764,34 +778,38 @@ def safe_copy(src, dst):
   shutil.copy(src, dst)
 
 
-def read_and_preprocess(filename, expand_macros=False):
-  temp_dir = get_emscripten_temp_dir()
-  # Create a settings file with the current settings to pass to the JS preprocessor
+def read_and_preprocess(filename, expand_macros=False, settings_dict=None):
+  # Create a settings file with the current settings to pass to the JS preprocessor.
+  # Callers on helper threads pass a copy of the settings in settings_dict.
+  if settings_dict is None:
+    settings_dict = settings.dict()
 
   settings_str = ''
-  for key, value in settings.dict().items():
+  for key, value in settings_dict.items():
     assert key == key.upper()  # should only ever be uppercase keys in settings
     jsoned = json.dumps(value, sort_keys=True)
     settings_str += f'var {key} = {jsoned};\n'
 
-  settings_file = os.path.join(temp_dir, 'settings.js')
-  with open(settings_file, 'w') as f:
-    f.write(settings_str)
-
-  # Run the JS preprocessor
-  # N.B. We can't use the default stdout=PIPE here as it only allows 64K of output before it hangs
-  # and shell.html is bigger than that!
-  # See https://thraxil.org/users/anders/posts/2008/03/13/Subprocess-Hanging-PIPE-is-your-enemy/
-  dirname, filename = os.path.split(filename)
-  if not dirname:
-    dirname = None
-  stdout = os.path.join(temp_dir, 'stdout')
-  args = [settings_file, filename]
-  if expand_macros:
-    args += ['--expandMacros']
-
-  run_js_tool(path_from_root('tools/preprocessor.js'), args, True, stdout=open(stdout, 'w'), cwd=dirname)
-  out = utils.read_file(stdout)
+  # Use temp files of our own, since this may run on several threads at once.
+  temp_files = configuration.get_temp_files()
+  with temp_files.get_file('.settings.js') as settings_file, temp_files.get_file('.stdout') as stdout:
+    with open(settings_file, 'w') as f:
+      f.write(settings_str)
+
+    # Run the JS preprocessor
+    # N.B. We can't use the default stdout=PIPE here as it only allows 64K of output before it hangs
+    # and shell.html is bigger than that!
+    # See https://thraxil.org/users/anders/posts/2008/03/13/Subprocess-Hanging-PIPE-is-your-enemy/
+    dirname, filename = os.path.split(filename)
+    if not dirname:
+      dirname = None
+    args = [settings_file, filename]
+    if expand_macros:
+      args += ['--expandMacros']
+
+    with open(stdout, 'w') as f:
+      run_js_tool(path_from_root('tools/preprocessor.js'), args, True, stdout=f, cwd=dirname)
+    out = utils.read_file(stdout)
 
   return out
 